@@ -0,0 +1,266 @@
+"""
+Benchmark of the analysis pipeline on synthetic workdirs (see benchmarks.synthetic), fully offline
+
+Each stage of the analysis is timed on a freshly generated workdir: loading the trials, scoring them with an empty and
+then a full score cache, the near-duplicate index (built, then loaded), and the code similarity clustering. Timings are
+the median over --repeat runs. Peak memory per stage is measured in one extra run under tracemalloc (which slows
+things down too much to time at the same time), and only covers this process, not evaluation workers.
+
+Results are written as JSON, and can be compared against an earlier report to catch regressions:
+    python -m benchmarks.analysis_benchmark --trials 1000 --out baseline.json
+    python -m benchmarks.analysis_benchmark --trials 1000 --out current.json --compare baseline.json
+Comparing exits with status 1 if any stage got slower (or used more memory) by more than --tolerance.
+"""
+
+from dataclasses import asdict, fields
+from datetime import datetime
+from pathlib import Path
+from statistics import median
+from typing import Any, Callable
+import importlib.metadata
+import tempfile
+import tracemalloc
+import platform
+import warnings
+import argparse
+import resource
+import shutil
+import json
+import time
+import os
+
+import matplotlib.pyplot as plt
+
+from experiments.analysis_utils import Analyzer, evaluator_key
+from experiments.near_duplicates import NearDuplicateIndex, update_workdir_index, index_filename
+from experiments.trial_store import open_trial_store
+from experiments.rate_limit import set_rate_limits
+from experiments.utils import redirect_output
+from .synthetic import SyntheticConfig, SyntheticWorkdir, generate_workdir
+
+
+report_version = 1
+
+# stage timings shorter than this are too noisy to call a regression
+min_regression_seconds = 0.05
+
+
+def run_stages(synthetic: SyntheticWorkdir, workers: int = 1, dedupe_threshold: float = 0.8, trace_memory: bool = False) -> tuple[dict[str, dict], dict[str, Any]]:
+    """
+    Run every stage of the analysis once on a generated workdir.
+    Returns ({stage: {'seconds', 'peak_mb'}}, {cache hit rates and evaluator accuracy})
+    """
+    workdir = synthetic.workdir
+    analyzer = Analyzer(
+        workdir=workdir,
+        task_variant='(synthetic)',
+        evaluate_trial_fn=synthetic.evaluate_trial_fn,
+        reference_code=synthetic.reference_code,
+        similarity='ast',
+        workers=workers,
+        warmup_fn=synthetic.warmup_fn,
+        llm_cache_path=None,
+    )
+    evaluator = evaluator_key(synthetic.evaluate_trial_fn)
+    stages: dict[str, dict] = {}
+    stats: dict[str, Any] = {}
+
+    def measure(name: str, fn: Callable[[], Any]) -> Any:
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = fn()
+        stages[name] = {'seconds': time.perf_counter() - start}
+        if trace_memory:
+            stages[name]['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        return result
+
+    def score_hit_rate(since: float, total: int) -> float:
+        evaluated = len(open_trial_store(workdir).scored_since(evaluator, since))
+        return 1 - evaluated / total if total else 1.0
+
+    def index_hit_rate(trials: dict[str, list[str]]) -> float:
+        path = workdir/index_filename
+        index = NearDuplicateIndex.load(path) if path.exists() else NearDuplicateIndex()
+        return sum(index.is_current(name, code_chunks) for name, code_chunks in trials.items()) / len(trials) if trials else 1.0
+
+    trials = measure('load_trials', lambda: open_trial_store(workdir).code())
+
+    for stage in ('evaluate_cold', 'evaluate_warm'):
+        since = time.time()
+        _, scores, successful = measure(stage, analyzer.identify_solutions)
+        stats[f'{stage}_hit_rate'] = score_hit_rate(since, len(trials))
+    measure('evaluate_cached_only', lambda: analyzer.identify_solutions(cached_only=True))
+    stats['successful'] = len(successful)
+    stats['expected_successful'] = sum(synthetic.expected.values())
+    stats['evaluator_mismatches'] = sum(scores[name].success != expected for name, expected in synthetic.expected.items() if name in scores)
+
+    for stage in ('near_duplicates_cold', 'near_duplicates_warm'):
+        stats[f'{stage}_hit_rate'] = index_hit_rate(trials)
+        families = measure(stage, lambda: update_workdir_index(workdir, trials).families(dedupe_threshold, keys=trials))
+    stats['families'] = len(families)
+
+    measure('code_clusters', lambda: analyzer.plot_code_clusters(synthetic.reference_code, trials, successful))
+    plt.close('all')
+    analyzer.dedupe_threshold = dedupe_threshold
+    measure('code_clusters_deduped', lambda: analyzer.plot_code_clusters(synthetic.reference_code, trials, successful))
+    plt.close('all')
+
+    return stages, stats
+
+
+def workdir_stats(workdir: Path) -> dict[str, Any]:
+    store = open_trial_store(workdir)
+    code = store.code()
+    return {
+        'trials': len(code),
+        'chunks': sum(len(chunks) for chunks in code.values()),
+        'code_bytes': sum(len(chunk.encode()) for chunks in code.values() for chunk in chunks),
+        'csv_files': len([*workdir.glob('trial_*.csv')]),
+        'csv_bytes': sum(path.stat().st_size for path in workdir.glob('trial_*.csv')),
+    }
+
+
+def environment() -> dict[str, Any]:
+    versions = {}
+    for package in ('numpy', 'pandas', 'scipy', 'scikit-learn', 'matplotlib'):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(), **versions}
+
+
+def run_benchmark(config: SyntheticConfig, repeat: int = 3, workers: int = 1, dedupe_threshold: float = 0.8, memory: bool = True, root: Path|None = None, log_path: Path|None = None) -> dict:
+    """
+    Generate and analyze a workdir `repeat` times (plus once more for memory) and build the report.
+    Workdirs are created in `root` (a temporary directory by default, which is removed afterwards)
+    """
+    # imported lazily by the analyzer, and the first run shouldn't be charged for it
+    import sklearn.decomposition
+
+    temporary = root is None
+    root = Path(tempfile.mkdtemp(prefix='analysis_benchmark_') if temporary else root).resolve()
+    log_path = log_path or root/'analysis.log'
+    runs: list[dict[str, dict]] = []
+    try:
+        for i in range(repeat + memory):
+            trace_memory = memory and i == repeat
+            workdir = root/f'run_{i}'
+            if trace_memory:
+                tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                synthetic = generate_workdir(workdir, config)
+                generate_seconds = time.perf_counter() - start
+                # the analyzer reports progress as it goes, which isn't wanted in the middle of the benchmark output
+                with redirect_output(log_path):
+                    stages, stats = run_stages(synthetic, workers, dedupe_threshold, trace_memory)
+            finally:
+                if trace_memory:
+                    tracemalloc.stop()
+            if not trace_memory:
+                stages = {'generate': {'seconds': generate_seconds}, **stages}
+            runs.append(stages)
+            print(f'run {i}{" (memory)" if trace_memory else ""}: ' + ', '.join(f'{name} {stage["seconds"]:.2f}s' for name, stage in stages.items()))
+
+        timed, traced = runs[:repeat], runs[repeat:]
+        report_stages = {
+            name: {'seconds': median(run[name]['seconds'] for run in timed), 'runs': [run[name]['seconds'] for run in timed]}
+            for name in timed[0]
+        }
+        for name, stage in (traced[0].items() if traced else ()):
+            report_stages[name]['peak_mb'] = stage['peak_mb']
+
+        return {
+            'version': report_version,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'config': {**asdict(config), 'id_columns': [*config.id_columns], 'repeat': repeat, 'workers': workers, 'dedupe_threshold': dedupe_threshold},
+            'environment': environment(),
+            'workdir': workdir_stats(root/'run_0'),
+            'stages': report_stages,
+            'stats': stats,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        }
+    finally:
+        if temporary:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def compare_reports(baseline: dict, current: dict, tolerance: float = 0.2) -> list[str]:
+    """print how each stage changed since the baseline, returning the stages that regressed by more than `tolerance`"""
+    compared_keys = [f.name for f in fields(SyntheticConfig)] + ['workers', 'dedupe_threshold']
+    differences = [key for key in compared_keys if baseline['config'].get(key) != current['config'].get(key)]
+    if differences:
+        print(f'WARNING: the reports were made with different configs ({", ".join(differences)}), so the comparison is not like for like')
+
+    regressions = []
+    print(f'{"stage":<24}{"baseline":>10}{"current":>10}{"change":>9}{"peak MB":>18}')
+    for name, stage in current['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            print(f'{name:<24}{"-":>10}{stage["seconds"]:>9.2f}s')
+            continue
+        change = stage['seconds'] / before['seconds'] - 1 if before['seconds'] else 0.0
+        memory = ''
+        if 'peak_mb' in stage and 'peak_mb' in before:
+            memory = f'{before["peak_mb"]:.0f} -> {stage["peak_mb"]:.0f}'
+            if before['peak_mb'] and stage['peak_mb'] / before['peak_mb'] - 1 > tolerance:
+                regressions.append(f'{name} (memory)')
+        print(f'{name:<24}{before["seconds"]:>9.2f}s{stage["seconds"]:>9.2f}s{change:>+9.0%}{memory:>18}')
+        if change > tolerance and stage['seconds'] - before['seconds'] > min_regression_seconds:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    defaults = SyntheticConfig()
+    parser = argparse.ArgumentParser(description='time each stage of the analysis pipeline on synthetic workdirs')
+    parser.add_argument('--case', choices=['gdc', 'cbio'], default=defaults.case, help='which evaluator the synthetic trials are scored with')
+    parser.add_argument('--trials', type=int, default=defaults.trials, help='number of trials in the workdir')
+    parser.add_argument('--chunks-per-trial', type=int, default=defaults.chunks_per_trial, help='average code chunks per trial')
+    parser.add_argument('--chunk-lines', type=int, default=defaults.chunk_lines, help='average statements per code chunk')
+    parser.add_argument('--csv-rows', type=int, default=defaults.csv_rows, help='rows in each trial csv')
+    parser.add_argument('--reference-ids', type=int, default=defaults.reference_ids, help='ids in the reference solution')
+    parser.add_argument('--fraction-correct', type=float, default=defaults.fraction_correct, help='fraction of trials with a correct csv')
+    parser.add_argument('--fraction-missing', type=float, default=defaults.fraction_missing, help='fraction of trials with no (or an empty) csv')
+    parser.add_argument('--families', type=int, default=defaults.families, help='number of distinct solutions the trial code varies from')
+    parser.add_argument('--id-columns', nargs='+', default=None, help='names the id column is given, e.g. sampleId "Sample ID" (default: a mix of the ones the evaluator has to handle)')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (the report has the median)')
+    parser.add_argument('--workers', type=int, default=1, help="processes the analyzer evaluates trials with")
+    parser.add_argument('--dedupe-threshold', type=float, default=0.8, help='similarity threshold for the near-duplicate stages')
+    parser.add_argument('--no-memory', action='store_true', help='skip the extra run that measures peak memory')
+    parser.add_argument('--keep', type=Path, default=None, help='generate the workdirs here and keep them, rather than in a temporary directory')
+    parser.add_argument('--out', type=Path, default=Path('analysis_benchmark.json'), help='where to write the report')
+    parser.add_argument('--compare', type=Path, default=None, help='an earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fractional slowdown (or memory increase) of a stage that counts as a regression')
+    args = parser.parse_args()
+
+    config = SyntheticConfig(
+        case=args.case, trials=args.trials, chunks_per_trial=args.chunks_per_trial, chunk_lines=args.chunk_lines,
+        csv_rows=args.csv_rows, reference_ids=args.reference_ids, fraction_correct=args.fraction_correct,
+        fraction_missing=args.fraction_missing, families=args.families, id_columns=args.id_columns, seed=args.seed,
+    )
+
+    # offline: no plots shown, no rate limits database
+    plt.switch_backend('Agg')
+    warnings.filterwarnings('ignore', message='.*non-interactive.*')
+    set_rate_limits('off')
+
+    report = run_benchmark(config, args.repeat, args.workers, args.dedupe_threshold, memory=not args.no_memory, root=args.keep)
+    args.out.write_text(json.dumps(report, indent=4))
+    stats = report['stats']
+    print(f'{stats["successful"]}/{report["workdir"]["trials"]} trials successful ({stats["expected_successful"]} expected, {stats["evaluator_mismatches"]} mismatches) in {stats["families"]} near-duplicate families')
+    print(f'Wrote {args.out}')
+
+    if args.compare is not None:
+        regressions = compare_reports(json.loads(args.compare.read_text()), report, args.tolerance)
+        if regressions:
+            print(f'Regressions beyond {args.tolerance:.0%}: {", ".join(regressions)}')
+            raise SystemExit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""
+Synthetic workdirs for benchmarking the analysis pipeline without any real trials
+
+A generated workdir is laid out like one from run_trials (trials.db with every trial's code chunks, plus the
+trial_N.csv each trial saved), along with a reference.csv of the ids a correct trial has to find. Trials are drawn from
+a number of families of similar code (like the near-duplicates real runs produce), and their csvs vary the things the
+evaluators have to cope with: which column the ids are in and what it's called, ids only found in free text, partial
+or extra ids, empty files and missing files.
+
+Each trial's metadata records whether it was generated to be correct, so evaluator results can be checked as well as timed.
+"""
+
+from dataclasses import dataclass, field
+from functools import cache, partial
+from pathlib import Path
+from typing import Any, Callable, Literal
+import random
+import uuid
+import numpy as np
+import pandas as pd
+
+from experiments.trial_store import TrialStore, store_filename
+from experiments.id_matching import MultiPatternScanner
+from experiments.gdc_analysis import GDCScore, score_gdc_csv, get_gdc_reference_code
+from experiments.cbio_analysis import CBioScore, score_cbio_csv, get_cbio_reference_code
+
+
+reference_filename = 'reference.csv'
+
+# column names trials put their ids under. The cbio evaluator only recognizes the first 4
+default_id_columns = {
+    'gdc': ('id', 'ssm_id', 'ssm_info'),
+    'cbio': ('sample_id', 'SampleID', 'sampleId', 'Sample ID', 'Sample'),
+}
+cbio_recognized_columns = {'sample_id', 'SampleID', 'sampleId', 'Sample ID'}
+
+
+@dataclass
+class SyntheticConfig:
+    """
+    Shape of a synthetic workdir
+
+    Args:
+        case ('gdc'|'cbio'): which evaluator the trials are scored with (and so what the ids look like)
+        trials (int): number of trials
+        chunks_per_trial (int): average number of code chunks per trial
+        chunk_lines (int): average number of statements per code chunk
+        csv_rows (int): rows in each trial's csv
+        reference_ids (int): number of ids in the reference solution
+        fraction_correct (float): fraction of trials whose csv has exactly the reference ids
+        fraction_missing (float): fraction of trials that never saved a csv (or saved an empty one)
+        fraction_errors (float): fraction of code chunks followed by a captured error
+        families (int): number of distinct solutions the trials' code is variations of
+        mutation_rate (float): fraction of statements changed in each trial relative to its family's code
+        id_columns (tuple[str, ...], optional): names the id column is given, chosen at random per trial. 'ssm_info'
+            (gdc) hides the ids inside free text. Defaults to `default_id_columns` for the case
+        extra_columns (int): other columns in each csv (numbers and text the evaluators have to look through)
+        seed (int): random seed. The same config always generates the same workdir
+    """
+    case: Literal['gdc', 'cbio'] = 'cbio'
+    trials: int = 100
+    chunks_per_trial: int = 4
+    chunk_lines: int = 20
+    csv_rows: int = 200
+    reference_ids: int = 100
+    fraction_correct: float = 0.3
+    fraction_missing: float = 0.1
+    fraction_errors: float = 0.2
+    families: int = 10
+    mutation_rate: float = 0.2
+    id_columns: tuple[str, ...]|None = None
+    extra_columns: int = 4
+    seed: int = 0
+
+    def __post_init__(self):
+        if self.case not in default_id_columns:
+            raise ValueError(f'unknown case {self.case!r}, expected one of {", ".join(default_id_columns)}')
+        if self.id_columns is None:
+            self.id_columns = default_id_columns[self.case]
+        self.id_columns = tuple(self.id_columns)
+
+
+@dataclass
+class SyntheticWorkdir:
+    """a generated workdir, and what the analyzer needs to score it"""
+    workdir: Path
+    config: SyntheticConfig
+    evaluate_trial_fn: Callable[[str, list[str]], Any]
+    warmup_fn: Callable[[], Any]
+    reference_code: str
+    expected: dict[str, bool] = field(default_factory=dict) # trial name -> whether the evaluator should call it a success
+
+
+# --- scoring against a synthetic reference --- #
+
+@cache
+def load_reference_ids(reference_path: Path) -> frozenset[str]:
+    return frozenset(pd.read_csv(reference_path)['id'].astype(str))
+
+@cache
+def _reference_scanner(reference_path: Path) -> MultiPatternScanner:
+    return MultiPatternScanner(load_reference_ids(reference_path))
+
+def evaluate_synthetic_gdc_trial(trial_name: str, code_chunks: list[str], data_dir: Path, reference_path: Path) -> GDCScore:
+    solution_ids = set(load_reference_ids(reference_path))
+    return score_gdc_csv(data_dir/f'{trial_name}.csv', len(solution_ids), solution_ids, _reference_scanner(reference_path))
+
+def evaluate_synthetic_cbio_trial(trial_name: str, code_chunks: list[str], data_dir: Path, reference_path: Path) -> CBioScore:
+    return score_cbio_csv(data_dir/f'{trial_name}.csv', set(load_reference_ids(reference_path)))
+
+
+# --- code generation --- #
+
+# statements a trial might run. {v}/{w} are variables, {n} a number, {s} a string, {f} a field name
+_statements = [
+    "{v} = requests.get(BASE_URL + '/{s}', params={{'size': {n}, 'fields': '{f}'}})",
+    "{v} = requests.post(BASE_URL + '/{s}/fetch', json={{'ids': {w}, 'projection': 'DETAILED'}})",
+    "{v} = {w}.json()['data']['hits']",
+    "{v} = {w}.json()",
+    "{v} = pd.DataFrame({w})",
+    "{v} = pd.json_normalize({w})",
+    "{v} = {w}[{w}['{f}'] == '{s}']",
+    "{v} = {w}.merge({w}, on='{f}', how='inner')",
+    "{v} = {w}.drop_duplicates(subset=['{f}'])",
+    "{v} = [{x}['{f}'] for {x} in {w} if {x}.get('{s}')]",
+    "{v} = {{{x}['{f}']: {x} for {x} in {w}}}",
+    "{v} = len({w})",
+    "print(f'found {{len({w})}} {s}')",
+    "{v}.to_csv('{s}.csv', index=False)",
+    "if {w}.status_code != 200:\n    raise ValueError({w}.text)",
+    "for {x} in {w}:\n    {v}.append({x}['{f}'])",
+    "for {x} in range(0, {n}, {m}):\n    {v}.extend({w}[{x}:{x} + {m}])",
+    "def {g}({x}):\n    {y} = requests.get(f'{{BASE_URL}}/{s}/{{{x}}}')\n    return {y}.json()",
+    "{v} = [{g}({x}) for {x} in {w}]",
+    "{v} = {w}.groupby('{f}').size().reset_index(name='count')",
+    "{v} = {w}.rename(columns={{'{f}': '{s}'}})",
+    "{v} = json.dumps({{'op': 'in', 'content': {{'field': '{f}', 'value': [{w}]}}}})",
+]
+_words = ['cases', 'samples', 'studies', 'ssm_occurrences', 'mutations', 'genes', 'projects', 'patients', 'profiles', 'molecular-data']
+_fields = ['case_id', 'sample_id', 'study_id', 'gene.symbol', 'ssm.consequence.transcript.gene.symbol', 'entrezGeneId', 'patientId', 'disease_type', 'value']
+_variables = ['data', 'df', 'response', 'hits', 'results', 'ids', 'rows', 'table', 'records', 'out']
+_header = 'import requests\nimport pandas as pd\nimport json\n\nBASE_URL = "https://api.example.org"'
+
+
+def _statement(rng: random.Random, variables: list[str]) -> str:
+    template = rng.choice(_statements)
+    v = rng.choice(variables)
+    return template.format(
+        v=v, w=rng.choice(variables), x=rng.choice('ijkxyz'), y=rng.choice(['resp', 'r', 'result']), g=rng.choice(['fetch', 'get_one', 'lookup']),
+        n=rng.choice([100, 500, 1000, 10000]), m=rng.choice([50, 100, 250]), s=rng.choice(_words), f=rng.choice(_fields),
+    )
+
+
+def _family_code(rng: random.Random, config: SyntheticConfig) -> list[str]:
+    """the statements of one family's solution"""
+    variables = rng.sample(_variables, 6)
+    return [_statement(rng, variables) for _ in range(config.chunks_per_trial * config.chunk_lines)]
+
+
+def _trial_chunks(rng: random.Random, family: list[str], config: SyntheticConfig) -> tuple[list[str], list[str]]:
+    """a variation on a family's code, split into chunks (and errors), along with each chunk's kind"""
+    statements = [_statement(rng, _variables) if rng.random() < config.mutation_rate else statement for statement in family]
+    # some trials get further than others
+    statements = statements[:max(1, int(len(statements) * rng.uniform(0.5, 1.5)))]
+
+    chunks, kinds = [], []
+    i = 0
+    while i < len(statements):
+        n = max(1, round(rng.gauss(config.chunk_lines, config.chunk_lines / 4)))
+        chunks.append('\n'.join(([_header] if not chunks else []) + statements[i:i + n]) + '\n')
+        kinds.append('code')
+        if rng.random() < config.fraction_errors:
+            chunks.append(f"Error: KeyError: '{rng.choice(_fields)}'")
+            kinds.append('error')
+        i += n
+    return chunks, kinds
+
+
+# --- csv generation --- #
+
+def _new_id(rng: random.Random, case: str) -> str:
+    if case == 'gdc':
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+    return f'TCGA-{rng.choice("ABCDEFGH")}{rng.choice("ABCDEFGH")}-{rng.randrange(10000):04d}-{rng.randrange(1, 20):02d}'
+
+
+def _write_trial_csv(path: Path, rng: random.Random, np_rng: np.random.Generator, ids: list[str], id_column: str, config: SyntheticConfig):
+    # repeat the ids to fill the rows, as results with several rows per id do
+    num_rows = max(config.csv_rows, len(ids)) if ids else 0
+    values = np.array(ids, dtype=object)[np_rng.integers(0, len(ids), num_rows)] if ids else np.array([], dtype=object)
+    values[:len(ids)] = ids
+    np_rng.shuffle(values)
+    if id_column == 'ssm_info':
+        # only findable by searching the raw text
+        values = np.array([f'chr{np_rng.integers(1, 23)}:g.{np_rng.integers(1e6, 1e8)}A>G ssm={id}' for id in values], dtype=object)
+    columns = {id_column: values}
+    for j in range(config.extra_columns):
+        if j % 2 == 0:
+            columns[f'value_{j}'] = np_rng.normal(size=len(values)).round(4)
+        else:
+            columns[f'label_{j}'] = np_rng.choice(_words, size=len(values))
+    pd.DataFrame(columns).to_csv(path, index=False)
+
+
+def generate_workdir(workdir: Path, config: SyntheticConfig) -> SyntheticWorkdir:
+    """generate a synthetic workdir (which must not already have a trial store) from the config"""
+    workdir = Path(workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    if (workdir/store_filename).exists():
+        raise FileExistsError(f'{workdir} already has a trial store')
+    rng = random.Random(config.seed)
+    np_rng = np.random.default_rng(config.seed)
+
+    reference_ids = [_new_id(rng, config.case) for _ in range(config.reference_ids)]
+    pd.DataFrame({'id': reference_ids}).to_csv(workdir/reference_filename, index=False)
+    families = [_family_code(rng, config) for _ in range(config.families)]
+
+    store = TrialStore(workdir/store_filename)
+    expected = {}
+    for i in range(config.trials):
+        name = f'trial_{i}'
+        family = rng.randrange(config.families)
+        outcome = rng.random()
+        id_column = rng.choice(config.id_columns)
+        correct = outcome < config.fraction_correct
+        missing = not correct and outcome < config.fraction_correct + config.fraction_missing
+
+        store.start_trial(name, variant='synthetic', metadata={'synthetic': {'family': family, 'correct': correct, 'missing': missing, 'id_column': id_column}})
+        for chunk, kind in zip(*_trial_chunks(rng, families[family], config)):
+            store.add_chunk(name, chunk, kind)
+        store.finish_trial(name)
+
+        if missing:
+            # either nothing was saved, or an empty file was
+            if rng.random() < 0.5:
+                (workdir/f'{name}.csv').write_text('')
+        elif correct:
+            _write_trial_csv(workdir/f'{name}.csv', rng, np_rng, reference_ids, id_column, config)
+        else:
+            # some of the right ids (well short of the cbio pass threshold), and some wrong ones
+            found = rng.sample(reference_ids, rng.randrange(max(1, int(len(reference_ids) * 0.9))))
+            wrong = [_new_id(rng, config.case) for _ in range(rng.randrange(1, max(2, len(reference_ids) // 2)))]
+            _write_trial_csv(workdir/f'{name}.csv', rng, np_rng, found + wrong, id_column, config)
+        expected[name] = correct and (config.case == 'gdc' or id_column in cbio_recognized_columns)
+
+    reference_path = workdir/reference_filename
+    evaluate = evaluate_synthetic_gdc_trial if config.case == 'gdc' else evaluate_synthetic_cbio_trial
+    return SyntheticWorkdir(
+        workdir=workdir,
+        config=config,
+        evaluate_trial_fn=partial(evaluate, data_dir=workdir, reference_path=reference_path),
+        warmup_fn=partial(load_reference_ids, reference_path),
+        reference_code=get_gdc_reference_code() if config.case == 'gdc' else get_cbio_reference_code(),
+        expected=expected,
+    )
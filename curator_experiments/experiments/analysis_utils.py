@@ -5,18 +5,154 @@ import matplotlib.pyplot as plt
 from adhoc_api.uaii import OpenAIAgent
 from pathlib import Path
 import json
-from dataclasses import dataclass
-from time import sleep
-from .utils import timeout
+from dataclasses import dataclass, asdict
+from .utils import timeout, TimeoutException
+from .code_similarity import rank_code_spread
+from .near_duplicates import update_workdir_index, expand_family_rankings
+from .trial_store import open_trial_store, TrialStore
+from .llm_cache import LLMCache, cache_key, default_cache_path
+from .tracing import trial_latencies, categories as span_categories
+from .rate_limit import RateLimiter, rate_limiter_from_env, limit_uaii_agent, model_provider
 
-from typing import Callable
-import yaml
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Generator, Iterable, Literal, get_type_hints
+import hashlib
+import inspect
+import textwrap
+import ast
+
+
+# bump the version whenever the ranking prompt changes, so old cached responses aren't used
+ranking_model = 'o3-mini'
+ranking_prompt_version = 1
 
 
 @dataclass
 class Score:
     success: bool
 
+
+def trial_content_hash(data_path: Path, code_chunks: list[str]) -> str:
+    """hash of everything a trial's score depends on: the csv it produced (if any) and the code it ran"""
+    digest = hashlib.sha256()
+    if data_path.exists():
+        with data_path.open('rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        digest.update(b'<no file>')
+    for chunk in code_chunks:
+        digest.update(b'\0')
+        digest.update(chunk.encode())
+    return digest.hexdigest()
+
+
+def _unwrap(evaluate_trial_fn: Callable) -> Callable:
+    # e.g. partial(evaluate_gdc_trial, data_dir=...) when trials are scored while they run
+    while isinstance(evaluate_trial_fn, partial):
+        evaluate_trial_fn = evaluate_trial_fn.func
+    return evaluate_trial_fn
+
+
+# scoring code is anything defined in this project (rather than a library) that an evaluation function uses
+_project_root = Path(__file__).resolve().parents[1]
+
+def _project_object(obj: Any) -> bool:
+    try:
+        return Path(inspect.getfile(obj)).resolve().is_relative_to(_project_root)
+    except (TypeError, OSError):
+        return False
+
+
+def scoring_sources(evaluate_trial_fn: Callable) -> list[str]:
+    """
+    source of an evaluation function and of the functions and classes it uses (directly or through each other) that
+    are defined in this project, e.g. the score_*_csv helpers. Values it reads (e.g. the module's `workdir`) aren't included
+    """
+    sources: dict[str, str] = {}
+    queue = [_unwrap(evaluate_trial_fn)]
+    while queue:
+        obj = inspect.unwrap(queue.pop())
+        # by file rather than module name, which is __main__ when the analysis is run directly
+        path = Path(inspect.getfile(obj)).resolve()
+        key = f'{path.relative_to(_project_root) if path.is_relative_to(_project_root) else path}:{obj.__qualname__}'
+        if key in sources:
+            continue
+        sources[key] = source = inspect.getsource(obj)
+        scope = getattr(obj, '__globals__', None) or vars(inspect.getmodule(obj))
+        for node in ast.walk(ast.parse(textwrap.dedent(source))):
+            used = scope.get(node.id) if isinstance(node, ast.Name) else None
+            if used is not None and callable(used):
+                used = inspect.unwrap(used)
+                if (inspect.isfunction(used) or inspect.isclass(used)) and _project_object(used):
+                    queue.append(used)
+    return [sources[key] for key in sorted(sources)]
+
+
+def evaluator_key(evaluate_trial_fn: Callable) -> str:
+    """
+    identifies an evaluation function, including the source of the scoring code it uses (see `scoring_sources`) so
+    that edits to it invalidate old scores, but edits elsewhere in its module (e.g. which workdir to analyze) don't.
+    Bound arguments of a partial aren't part of the key, so scores saved while the trials ran are found by the analysis
+    """
+    evaluate_trial_fn = _unwrap(evaluate_trial_fn)
+    # not the module name, since that is __main__ when the analysis is run directly
+    name = evaluate_trial_fn.__qualname__
+    try:
+        sources = scoring_sources(evaluate_trial_fn)
+    except (OSError, TypeError, SyntaxError):
+        return name
+    return f'{name}:{hashlib.sha256(chr(0).join(sources).encode()).hexdigest()[:16]}'
+
+
+def score_type(evaluate_trial_fn: Callable) -> type[Score]:
+    """the Score dataclass an evaluation function returns"""
+    return get_type_hints(_unwrap(evaluate_trial_fn)).get('return', Score)
+
+
+def load_score(store: TrialStore, trial: str, evaluator: str, content_hash: str, score_type: type[Score]) -> Score|None:
+    """the score saved for a trial, if there is one and the trial hasn't changed since"""
+    cached = store.get_score(trial, evaluator)
+    if cached is None or cached[0] != content_hash:
+        return None
+    try:
+        return score_type(**cached[1])
+    except TypeError:
+        # the score dataclass has changed shape since this was saved
+        return None
+
+
+def _init_evaluation_worker(warmup_fn: Callable[[], Any]|None):
+    if warmup_fn is not None:
+        warmup_fn()
+
+def _safe_evaluate(evaluate_trial_fn: Callable[[str, list[str]], Score], trial: str, code_chunks: list[str]) -> tuple[Score|None, str|None]:
+    # one bad trial shouldn't take down the rest of the batch
+    try:
+        return evaluate_trial_fn(trial, code_chunks), None
+    except Exception as e:
+        return None, f'{e.__class__.__name__}: {e}'
+
+
+def merge_group_scores(group_scores: list[dict[str, float]], anchors: list[str]) -> dict[str, float]:
+    """
+    Merge the scores from several groups ranked separately. Each group's scores are shifted by how much lower/higher
+    that group scored the anchors than the groups did on average. Anchors get their average score across groups
+    """
+    anchor_scores = {anchor: [scores[anchor] for scores in group_scores if anchor in scores] for anchor in anchors}
+    anchor_means = {anchor: np.mean(values) for anchor, values in anchor_scores.items() if values}
+
+    merged: dict[str, float] = {anchor: float(mean) for anchor, mean in anchor_means.items()}
+    for scores in group_scores:
+        offsets = [anchor_means[anchor] - scores[anchor] for anchor in anchor_means if anchor in scores]
+        offset = float(np.mean(offsets)) if offsets else 0.0
+        for name, score in scores.items():
+            if name not in anchor_means:
+                merged[name] = float(np.clip(score + offset, 0, 100))
+    return merged
+
+
 class Analyzer:
 
     def __init__(
@@ -24,51 +160,130 @@ class Analyzer:
         workdir: Path,
         task_variant: str,
         evaluate_trial_fn: Callable[[str, list[str]], Score],
-        reference_code: str
+        reference_code: str,
+        similarity: Literal['ast', 'llm'] = 'ast',
+        dedupe_threshold: float|None = None,
+        workers: int = 1,
+        warmup_fn: Callable[[], Any]|None = None,
+        ranking_batch_size: int|None = None,
+        ranking_anchors: int = 3,
+        ranking_workers: int = 4,
+        llm_cache_path: Path|None = default_cache_path,
+        rate_limiter: RateLimiter|None = None
     ):
         self.workdir = workdir
         self.task_variant = task_variant
         self.evaluate_trial_fn = evaluate_trial_fn
         self.reference_code = reference_code
+        self.similarity = similarity # how to score code similarity: locally by comparing ASTs, or by asking an LLM
+        self.dedupe_threshold = dedupe_threshold # if set, only rank one trial per family of near-duplicates (minhash similarity >= threshold)
+        self.workers = workers # number of processes to evaluate trials with
+        self.warmup_fn = warmup_fn # run once in each worker process before evaluating, e.g. to load the (cached) reference solution
+        self.ranking_batch_size = ranking_batch_size # if set, LLM rankings of more trials than this are split into groups (see tournament_rank_trials)
+        self.ranking_anchors = ranking_anchors # number of trials included in every group to calibrate scores across groups
+        self.ranking_workers = ranking_workers # number of groups to rank concurrently
+        self.llm_cache = LLMCache(llm_cache_path) if llm_cache_path is not None else None # cache of LLM ranking responses, shared across workdirs
+        self.rate_limiter = rate_limiter or rate_limiter_from_env() # shared with anything else talking to the same provider (e.g. a sweep)
     
     # def identify_solutions(self):
-    def identify_solutions(self) -> tuple[dict[str, list[str]], dict[str, Score], list[str]]:
+    def identify_solutions(self, cached_only: bool = False) -> tuple[dict[str, list[str]], dict[str, Score], list[str]]:
+        """
+        Score every trial against the reference.
+        Scores are cached in the workdir's trial store, and a trial is only re-evaluated if its code or csv has changed.
+        With `cached_only`, the cached scores are used as-is without looking at any csvs (trials never scored are skipped)
+        Trials scored while they ran (see experiments.online_scoring) are already cached, so this is mostly aggregation
+        """
         # load all the trials
-        code_path = self.workdir/'captured_code.yaml'
-        trials: dict = yaml.safe_load(code_path.open())
-        # replace any NoneTypes with []
-        trials: dict[str, list[str]] = {k: v if v is not None else [] for k, v in trials.items()}
+        store = open_trial_store(self.workdir)
+        trials: dict[str, list[str]] = store.code()
+        evaluator = evaluator_key(self.evaluate_trial_fn)
+        trial_score_type = score_type(self.evaluate_trial_fn)
 
         # save the score of each trial
         scores: dict[str, Score] = {}
 
-        # save a list of the trials that are correct
-        successful_trials: list[str] = []
+        skipped: list[str] = []
+        if cached_only:
+            for trial, score in store.scores(evaluator).items():
+                try:
+                    scores[trial] = trial_score_type(**score)
+                except TypeError:
+                    # the score dataclass has changed shape since this was saved
+                    continue
+            skipped = [trial for trial in trials if trial not in scores]
+            if skipped:
+                shown = ', '.join(skipped[:10]) + (f', ... ({len(skipped) - 10} more)' if len(skipped) > 10 else '')
+                print(f'WARNING: skipping {len(skipped)}/{len(trials)} trials with no usable cached score from {evaluator}: {shown}. Run without cached_only to score them')
+            trials = {trial: code_chunks for trial, code_chunks in trials.items() if trial in scores}
+
+        # find the trials that need (re-)evaluating
+        pending: dict[str, str] = {} # trial name -> content hash
+        if not cached_only:
+            for trial, code_chunks in trials.items():
+                content_hash = trial_content_hash(self.workdir/f'{trial}.csv', code_chunks)
+                score = load_score(store, trial, evaluator, content_hash, trial_score_type)
+                if score is None:
+                    pending[trial] = content_hash
+                else:
+                    scores[trial] = score
+            print(f'evaluating {len(pending)} trials ({len(trials) - len(pending)} unchanged trials loaded from cache)')
 
         # compare each of the trials to the reference
-        for trial, code_chunks in tqdm(trials.items(), desc='Analyzing trials', total=len(trials)):
-            score = self.evaluate_trial_fn(trial, code_chunks)
-            scores[trial] = score
-            if score.success:
-                successful_trials.append(trial)
+        for trial, score in self.evaluate_trials({trial: trials[trial] for trial in pending}):
+            if score is not None:
+                store.put_score(trial, evaluator, pending[trial], asdict(score))
+                scores[trial] = score
+
+        # keep everything in trial order
+        scores = {trial: scores[trial] for trial in trials if trial in scores}
+        successful_trials = [trial for trial, score in scores.items() if score.success]
             
         # print number of successful trials out of total
-        print(f'success rate: {len(successful_trials)}/{len(trials)}')
+        print(f'success rate: {len(successful_trials)}/{len(trials)}' + (f' ({len(skipped)} trials skipped, not scored)' if skipped else ''))
         
         return trials, scores, successful_trials
 
+    def evaluate_trials(self, trials: dict[str, list[str]]) -> Generator[tuple[str, Score|None], None, None]:
+        """
+        Run the evaluation function on each trial, yielding (trial name, score) in order.
+        Trials where the evaluation raises an error are reported and yield a score of None.
+        With more than one worker, trials are evaluated in a process pool, so the evaluation function must be picklable
+        """
+        names = list(trials)
+        if self.workers <= 1 or len(names) <= 1:
+            results = (_safe_evaluate(self.evaluate_trial_fn, name, code_chunks) for name, code_chunks in trials.items())
+            yield from self._report(names, results)
+            return
+
+        # a few chunks per worker keeps the workers evenly loaded without paying for a round trip on every trial
+        chunksize = max(1, len(names) // (self.workers * 4))
+        with ProcessPoolExecutor(self.workers, initializer=_init_evaluation_worker, initargs=(self.warmup_fn,)) as pool:
+            results = pool.map(partial(_safe_evaluate, self.evaluate_trial_fn), names, trials.values(), chunksize=chunksize)
+            yield from self._report(names, results)
+
+    @staticmethod
+    def _report(names: list[str], results: Iterable[tuple[Score|None, str|None]]) -> Generator[tuple[str, Score|None], None, None]:
+        for name, (score, error) in tqdm(zip(names, results), desc='Analyzing trials', total=len(names)):
+            if error is not None:
+                print(f'WARNING: failed to evaluate {name}: {error}')
+            yield name, score
+
 
     def have_llm_rank_code_spread(self, reference: str, trials: dict[str, list[str]], N:int=10):
-        # check if the cache file exists
+        # the saved rankings are only reused if they were made from the same reference and trials.
+        # Otherwise individual ranking calls that didn't change are still served by the LLM cache
         cache_path = self.workdir/'code_clusters_cache.json'
+        key = cache_key(model=ranking_model, prompt_version=ranking_prompt_version, reference=reference, trials=sorted(trials.items()), N=N)
         if cache_path.exists():
             with cache_path.open('r') as f:
-                all_rankings = json.load(f)
-            print(f"Loaded LLM rankings for {self.workdir.stem} from cache")
-            return all_rankings
+                cached = json.load(f)
+            if isinstance(cached, dict) and cached.get('key') == key:
+                print(f"Loaded LLM rankings for {self.workdir.stem} from cache")
+                return cached['rankings']
+            print(f'Trials of {self.workdir.stem} changed since the cached rankings were made')
 
         # get the primary list of rankings
-        print(f'No cache found. Generating code spread rankings for {self.workdir.stem} ...')
+        print(f'Generating code spread rankings for {self.workdir.stem} ...')
         primary_ranking = self.measure_code_spread_trial(reference, trials)
 
         # select N other evenly spaced trials from the primary ranking
@@ -80,20 +295,41 @@ class Analyzer:
             try:
                 with timeout(300):
                     secondary_ranking = self.measure_code_spread_trial(secondary_reference, trials)
-            except Exception as e:
+            except (Exception, TimeoutException) as e:
                 print(f"Error measuring secondary reference {secondary_reference}: {e}")
                 continue
             all_secondary_rankings.append(secondary_ranking)
-            sleep(5) # to avoid hitting the API too hard
         
         # save all rankings to a cache file
         all_rankings = [primary_ranking] + all_secondary_rankings
-        cache_path = self.workdir/'code_clusters_cache.json'
         with cache_path.open('w') as f:
-            json.dump(all_rankings, f, indent=4)
+            json.dump({'key': key, 'rankings': all_rankings}, f, indent=4)
         
         return all_rankings
 
+    def near_duplicate_families(self, trials: dict[str, list[str]]) -> list[list[str]]:
+        index = update_workdir_index(self.workdir, trials)
+        families = index.families(self.dedupe_threshold, keys=trials)
+        print(f'{len(trials)} trials in {len(families)} near-duplicate families')
+        return families
+
+    def rank_code_spread(self, reference_name: str, trials: dict[str, list[str]], N:int=10) -> list[list[tuple[int, str, float]]]:
+        # rank a single representative per family of near-duplicates, and give the rest of the family the same result
+        families = None
+        if self.dedupe_threshold is not None:
+            families = self.near_duplicate_families({name: code for name, code in trials.items() if name != reference_name})
+            trials = {**{family[0]: trials[family[0]] for family in families}, reference_name: trials[reference_name]}
+
+        if self.similarity == 'llm':
+            reference = '\n\n############\n\n'.join(trials[reference_name])
+            all_rankings = self.have_llm_rank_code_spread(reference, trials, N)
+        else:
+            all_rankings = rank_code_spread(reference_name, trials, N)
+
+        if families is not None:
+            all_rankings = [expand_family_rankings(rankings, families) for rankings in all_rankings]
+        return all_rankings
+
     def plot_code_clusters(self, reference: str, trials: dict[str, list[str]], solution_trials:list[str], N:int=10):
         # Include the reference in the trials
         reference_trial_number = len(trials)
@@ -102,8 +338,8 @@ class Analyzer:
         reference_name = f'trial_{reference_trial_number}'
         trials = {**trials, reference_name: [reference]}
         
-        # collect the rankings from the llm (or load from cache)
-        all_rankings = self.have_llm_rank_code_spread(reference, trials, N)
+        # collect the similarity rankings (from the llm/cache, or computed locally)
+        all_rankings = self.rank_code_spread(reference_name, trials, N)
 
         # dictionaries for building the feature vectors
         rank_feature_dict: dict[str, list[int]] = defaultdict(list)
@@ -191,10 +427,10 @@ class Analyzer:
         plt.savefig(self.workdir/f'score_pca.png')
         plt.show()
 
-    def plot_results(self):
+    def plot_results(self, cached_only: bool = False):
         # analyzer = Analyzer(workdir=workdir, task_variant=task_variant)
 
-        trials, scores, successful_trials = self.identify_solutions()
+        trials, scores, successful_trials = self.identify_solutions(cached_only)
         successful_trial_names = set(successful_trials) # for easy lookup
 
         # print out a map from each result to the frequency of the result
@@ -249,6 +485,8 @@ class Analyzer:
         plt.savefig(self.workdir/'correct_histogram.png')
         plt.show()
 
+        self.plot_latency(scores)
+
 
         # make a single unified plot
         # correct_num_rows = [score.correct_num_rows for score in scores.values()]
@@ -274,8 +512,34 @@ class Analyzer:
 
 
 
+    def plot_latency(self, scores: dict[str, Score]):
+        """how long successful and unsuccessful trials took, and where the time went (from the spans recorded while they ran)"""
+        latencies = trial_latencies(open_trial_store(self.workdir))
+        names = [name for name in scores if 'trial' in latencies.get(name, {})]
+        if not names:
+            print('No timing spans recorded for these trials')
+            return
+
+        totals = np.array([latencies[name]['trial'] for name in names])
+        success = np.array([scores[name].success for name in names])
+        for outcome, label in ((True, 'successful'), (False, 'unsuccessful')):
+            group = [name for name, s in zip(names, success) if s == outcome]
+            if not group:
+                continue
+            means = ', '.join(f'{category} {np.mean([latencies[name][category] for name in group]):.1f}s' for category in span_categories)
+            print(f'{len(group)} {label} trials: mean {np.mean(totals[success == outcome]):.1f}s ({means})')
+        if 0 < success.sum() < len(success):
+            # point-biserial correlation, i.e. pearson's with success as 0/1
+            print(f'correlation of trial latency with success: {np.corrcoef(totals, success)[0, 1]:.2f}')
+
+        plt.boxplot([totals[success], totals[~success]], tick_labels=['successful', 'unsuccessful'])
+        plt.ylabel('Trial Latency (s)')
+        plt.title(f'Trial Latency by Outcome {self.task_variant}')
+        plt.savefig(self.workdir/'latency_vs_success.png')
+        plt.show()
+
     def measure_code_spread(self, reference: str, trials: dict[str, list[str]], n_repeats: int = 10) -> list[tuple[int, str, float]]:
-        all_rankings = [self.measure_code_spread_trial(reference, trials) for _ in tqdm(range(n_repeats), desc='Collecting Code Spread Trials', total=n_repeats)]
+        all_rankings = [self.measure_code_spread_trial(reference, trials, sample=i) for i in tqdm(range(n_repeats), desc='Collecting Code Spread Trials', total=n_repeats)]
 
         rank_map = defaultdict(list)
         for rankings in all_rankings:
@@ -310,16 +574,57 @@ class Analyzer:
 
         return averages
 
-    def measure_code_spread_trial(self, reference: str, trials: dict[str, list[str]]) -> list[tuple[int, str, float]]:
+    def measure_code_spread_trial(self, reference: str, trials: dict[str, list[str]], sample: int = 0) -> list[tuple[int, str, float]]:
+        if self.ranking_batch_size is None or len(trials) <= self.ranking_batch_size:
+            return self.llm_rank_trials(reference, trials, sample)
+        return self.tournament_rank_trials(reference, trials, sample)
+
+    def tournament_rank_trials(self, reference: str, trials: dict[str, list[str]], sample: int = 0) -> list[tuple[int, str, float]]:
+        """
+        Rank a large number of trials by splitting them into fixed-size groups that are ranked concurrently.
+        Every group also contains the same few anchor trials, and the scores the anchors get in each group are used
+        to put all the groups on a common scale before merging them into a single ranking
+        """
+        names = list(trials)
+        anchors = names[:self.ranking_anchors]
+        rest = names[self.ranking_anchors:]
+        group_size = self.ranking_batch_size - len(anchors)
+        if group_size < 1:
+            raise ValueError(f'ranking_batch_size ({self.ranking_batch_size}) must be larger than ranking_anchors ({self.ranking_anchors})')
+        groups = [anchors + rest[i:i+group_size] for i in range(0, len(rest), group_size)]
+
+        def rank_group(group: list[str]) -> dict[str, float]:
+            try:
+                ranking = self.llm_rank_trials(reference, {name: trials[name] for name in group}, sample)
+            except Exception as e:
+                print(f'WARNING: failed to rank a group of {len(group)} trials: {e}')
+                return {}
+            # ignore any names the LLM made up, and any repeats
+            scores = {}
+            for _, name, score in ranking:
+                if name in group and name not in scores:
+                    scores[name] = score
+            return scores
+
+        with ThreadPoolExecutor(self.ranking_workers) as pool:
+            group_scores = list(tqdm(pool.map(rank_group, groups), desc='Ranking trial groups', total=len(groups)))
+
+        scores = merge_group_scores(group_scores, anchors)
+        order = sorted(scores, key=lambda name: -scores[name]) # stable, so ties stay in trial order
+        return [(rank, name, round(scores[name], 2)) for rank, name in enumerate(order)]
+
+    def llm_rank_trials(self, reference: str, trials: dict[str, list[str]], sample: int = 0) -> list[tuple[int, str, float]]:
+        """
+        have the LLM rank every trial against the reference in a single prompt.
+        `sample` distinguishes repeated calls with the same inputs, which are otherwise served from the cache
+        """
         # convert the trials to one string per trial:
         trials = {trial: '\n\n############\n\n'.join(code_chunks) for trial, code_chunks in trials.items()}
         trial_joiner = '\n\n' + '-'*80 + '\n\n'
         trials_str = trial_joiner.join([f"{trial}:\n```\n{code}\n```" for trial, code in trials.items()])
         # print(trials_str)
 
-        # agent = ClaudeAgent(model='claude-3-5-sonnet-latest', system_prompt='you are a python expert helping to analyze code')
-        agent = OpenAIAgent(model='o3-mini', system_prompt='you are a python expert helping to analyze code')
-        res = agent.message(f'''\
+        prompt = f'''\
 I have reference code for solving a task to collect data from GDC.
 Additionally I have a large collection of attempts/trials to solve the same problem, where each trial may or may not correctly solve the problem.
 
@@ -353,7 +658,18 @@ and here are each of the trials:
 {trials_str}
                         
 Please output your rankings and scores. Be sure to rank every trial exactly once. Please do not include any other text or formatting in your output.
-    ''')
+    '''
+        # identical calls (e.g. the same batch of trials when re-running the analysis) are served from the cache
+        key = cache_key(model=ranking_model, prompt_version=ranking_prompt_version, reference=reference, trials=sorted(trials.items()), sample=sample)
+        res = self.llm_cache.get(key) if self.llm_cache is not None else None
+        cached = res is not None
+        if not cached:
+            # agent = ClaudeAgent(model='claude-3-5-sonnet-latest', system_prompt='you are a python expert helping to analyze code')
+            agent = OpenAIAgent(model=ranking_model, system_prompt='you are a python expert helping to analyze code')
+            if self.rate_limiter is not None:
+                limit_uaii_agent(agent, self.rate_limiter, model_provider(ranking_model))
+            res = agent.message(prompt)
+
         rankings = []
         lines = [*filter(lambda x: x.strip(), res.splitlines())]
         for i, line in enumerate(lines):
@@ -361,4 +677,8 @@ Please output your rankings and scores. Be sure to rank every trial exactly once
             rankings.append((i, trial.strip(), float(score.strip())))
             # print(f"{i}: {trial} - {score}")  #DEBUG printout
 
+        # only cache responses that could be parsed
+        if not cached and self.llm_cache is not None:
+            self.llm_cache.put(key, res)
+
         return rankings
\ No newline at end of file
@@ -3,6 +3,7 @@ from functools import cache
 import pandas as pd
 from dataclasses import dataclass
 from .analysis_utils import Score, Analyzer
+from .id_matching import best_matching_column
 
 import pdb
 
@@ -19,7 +20,8 @@ def main():
         workdir=workdir,
         task_variant=task_variant,
         evaluate_trial_fn=evaluate_cbio_trial,
-        reference_code=get_cbio_reference_code()
+        reference_code=get_cbio_reference_code(),
+        warmup_fn=get_cbio_reference,
     )
     analyzer.plot_results()
 
@@ -39,11 +41,15 @@ def get_cbio_reference_code() -> str:
         return (here / 'cbio_reference_solution.py').read_text()
 
 
-def evaluate_cbio_trial(trial_name: str, code_chunks: list[str], pass_threshold=0.95) -> CBioScore:
+def evaluate_cbio_trial(trial_name: str, code_chunks: list[str], pass_threshold=0.95, data_dir: Path|None = None) -> CBioScore:
     reference, solution_ids = get_cbio_reference()
 
-    data_path = workdir/f'{trial_name}.csv'
-        
+    data_path = (data_dir or workdir)/f'{trial_name}.csv'
+    return score_cbio_csv(data_path, solution_ids, pass_threshold)
+
+
+def score_cbio_csv(data_path: Path, solution_ids: set, pass_threshold=0.95) -> CBioScore:
+    """score a trial's csv against the reference sample ids (the benchmarks call this with synthetic references)"""
     # see if a file was even created
     if not data_path.exists():
         return CBioScore(False, 0)
@@ -67,15 +73,9 @@ def evaluate_cbio_trial(trial_name: str, code_chunks: list[str], pass_threshold=
         trial_ids = set(data[column_name].tolist())
     except KeyError:
         # search for the best matching column
-        best_column = None
-        best_match_count = 0
-        for column in data.columns:
-            match_count = sum(1 for id in solution_ids if id in data[column].astype(str).tolist())
-            if match_count > best_match_count:
-                best_match_count = match_count
-                best_column = column
+        best_column = best_matching_column(data, solution_ids)
         if best_column is not None:
-            trial_ids = set(data[best_column].astype(str).tolist())
+            trial_ids = set(data[best_column.column].astype(str).tolist())
         else:
             trial_ids = set()
 
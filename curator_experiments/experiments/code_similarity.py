@@ -0,0 +1,135 @@
+"""
+Local structural code similarity, used in place of asking an LLM to rank how similar each trial's code is to the reference.
+
+Each trial's code chunks are parsed into ASTs, names bound by the code itself and all literals are normalized away,
+and every (non-leaf) subtree is hashed bottom-up. Two trials are compared by the Jaccard similarity of their sets of
+subtree hashes, which is computed for all pairs at once as a sparse matrix product.
+"""
+
+import ast
+import hashlib
+import numpy as np
+from scipy import sparse
+
+
+def parse_chunks(code_chunks: list[str]) -> list[ast.Module]:
+    """parse each chunk, skipping anything that isn't python (e.g. captured error messages)"""
+    trees = []
+    for chunk in code_chunks:
+        try:
+            trees.append(ast.parse(chunk))
+        except (SyntaxError, ValueError):
+            continue
+    return trees
+
+
+def bound_names(trees: list[ast.Module]) -> set[str]:
+    """names the code defines itself (variables, functions, classes, arguments). Everything else (modules, builtins) is kept as-is"""
+    names = set()
+    for tree in trees:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+                names.add(node.id)
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.add(node.name)
+            elif isinstance(node, ast.arg):
+                names.add(node.arg)
+    return names
+
+
+def _label(node: ast.AST, local_names: set[str]) -> str:
+    kind = type(node).__name__
+    if isinstance(node, ast.Name):
+        return f'{kind}:{"VAR" if node.id in local_names else node.id}'
+    if isinstance(node, ast.Constant):
+        return f'{kind}:{type(node.value).__name__}'
+    if isinstance(node, ast.Attribute):
+        return f'{kind}:{node.attr}'
+    if isinstance(node, ast.keyword):
+        return f'{kind}:{node.arg}'
+    if isinstance(node, ast.alias):
+        return f'{kind}:{node.name}'
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return f'{kind}:{getattr(node, "module", None)}'
+    return kind
+
+
+def stable_hash(text: str) -> int:
+    # stable across processes (unlike hash()), so fingerprints can be persisted
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+
+
+def subtree_hashes(code_chunks: list[str]) -> set[int]:
+    """Fingerprint of a trial: the set of hashes of every non-leaf subtree in its normalized ASTs"""
+    trees = parse_chunks(code_chunks)
+    local_names = bound_names(trees)
+    hashes: set[int] = set()
+
+    def visit(node: ast.AST) -> int:
+        children = [visit(child) for child in ast.iter_child_nodes(node) if not isinstance(child, ast.expr_context)]
+        h = stable_hash(f'{_label(node, local_names)}({",".join(map(str, children))})')
+        if children:
+            hashes.add(h)
+        return h
+
+    for tree in trees:
+        visit(tree)
+    return hashes
+
+
+class CodeSimilarity:
+    """
+    Pairwise structural similarity between a set of trials
+
+    Args:
+        trials (dict[str, list[str]]): map from trial name to the code chunks of that trial
+
+    Attributes:
+        names (list[str]): trial names, in the order of the matrix rows/columns
+        matrix (np.ndarray): (n, n) similarity scores from 0 (nothing in common) to 100 (structurally identical)
+    """
+    def __init__(self, trials: dict[str, list[str]]):
+        self.names = list(trials.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+        fingerprints = [subtree_hashes(code_chunks) for code_chunks in trials.values()]
+        self.matrix = jaccard_matrix(fingerprints) * 100
+
+    def ranking(self, name: str) -> list[tuple[int, str, float]]:
+        """(rank, name, score) for every trial, from most to least similar to the given trial"""
+        scores = self.matrix[self.index[name]]
+        order = np.argsort(-scores, kind='stable')
+        return [(rank, self.names[i], round(float(scores[i]), 2)) for rank, i in enumerate(order)]
+
+
+def jaccard_matrix(fingerprints: list[set[int]]) -> np.ndarray:
+    """dense (n, n) matrix of jaccard similarities between sets"""
+    vocab: dict[int, int] = {}
+    rows, cols = [], []
+    for row, fingerprint in enumerate(fingerprints):
+        for h in fingerprint:
+            rows.append(row)
+            cols.append(vocab.setdefault(h, len(vocab)))
+    membership = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(fingerprints), max(len(vocab), 1))
+    )
+    intersection = (membership @ membership.T).toarray()
+    sizes = np.asarray(membership.sum(axis=1)).ravel()
+    union = sizes[:, None] + sizes[None, :] - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.where(union > 0, intersection / union, 0.0)
+    # a trial is always identical to itself, even if it has no parseable code
+    np.fill_diagonal(similarity, 1.0)
+    return similarity
+
+
+def rank_code_spread(reference_name: str, trials: dict[str, list[str]], N: int = 10) -> list[list[tuple[int, str, float]]]:
+    """
+    Same output as Analyzer.have_llm_rank_code_spread: a primary ranking of all trials against the reference,
+    followed by rankings against N-1 other trials evenly spaced along the primary ranking
+    """
+    similarity = CodeSimilarity(trials)
+    primary_ranking = similarity.ranking(reference_name)
+    selections = np.linspace(0, len(primary_ranking)-1, N).astype(int)[1:]
+    secondary_rankings = [similarity.ranking(primary_ranking[i][1]) for i in selections]
+    return [primary_ranking] + secondary_rankings
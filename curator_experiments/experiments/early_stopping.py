@@ -0,0 +1,135 @@
+"""
+Stopping rules for ending a run of trials once its success rate is known well enough
+
+After each trial is scored (with the same evaluator the analysis uses), the running success count is fed to a rule:
+- 'ci': stop once the Wilson score interval for the success rate is narrower than a given width. e.g. 0/30 successes
+  gives [0%, 11%] at 95% confidence, which is plenty to call a variant a failure
+- 'sprt': Wald's sequential probability ratio test between a low (p0) and a high (p1) success rate. Stops as soon as
+  the evidence favors one with the given error rates, which typically takes far fewer trials than a fixed-size run
+"""
+
+from collections import deque
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Iterable, Literal
+import threading
+import math
+
+
+def wilson_interval(successes: int, n: int, confidence: float = 0.95) -> tuple[float, float]:
+    """confidence interval for a success rate, which (unlike the normal approximation) behaves at 0% and 100%"""
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = successes / n
+    center = (p + z*z / (2*n)) / (1 + z*z / n)
+    half_width = z / (1 + z*z / n) * math.sqrt(p * (1 - p) / n + z*z / (4*n*n))
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+@dataclass
+class StoppingRule:
+    """
+    Decides when enough trials have been scored
+
+    Args:
+        method ('ci'|'sprt'): which test to use (see module docstring)
+        min_trials (int): never stop before this many trials have been scored
+        confidence (float): for 'ci', the confidence level of the interval
+        max_width (float): for 'ci', stop once the interval is at most this wide
+        p0 (float): for 'sprt', the success rate of the "low" hypothesis
+        p1 (float): for 'sprt', the success rate of the "high" hypothesis
+        alpha (float): for 'sprt', the chance of deciding 'high' when the rate is really p0
+        beta (float): for 'sprt', the chance of deciding 'low' when the rate is really p1
+    """
+    method: Literal['ci', 'sprt'] = 'ci'
+    min_trials: int = 10
+    confidence: float = 0.95
+    max_width: float = 0.2
+    p0: float = 0.2
+    p1: float = 0.6
+    alpha: float = 0.05
+    beta: float = 0.05
+
+    def __post_init__(self):
+        if self.method == 'sprt' and not 0 < self.p0 < self.p1 < 1:
+            raise ValueError(f'sprt needs 0 < p0 < p1 < 1, got p0={self.p0}, p1={self.p1}')
+        self.successes = 0
+        self.n = 0
+        self.llr = 0.0 # log likelihood ratio of p1 over p0
+
+    def update(self, success: bool) -> str|None:
+        """record the outcome of a trial. Returns why to stop, or None to keep going"""
+        self.n += 1
+        self.successes += int(success)
+        if self.method == 'sprt':
+            self.llr += math.log(self.p1 / self.p0) if success else math.log((1 - self.p1) / (1 - self.p0))
+        return self.decision()
+
+    def decision(self) -> str|None:
+        if self.n < self.min_trials:
+            return None
+        if self.method == 'ci':
+            low, high = wilson_interval(self.successes, self.n, self.confidence)
+            if high - low <= self.max_width:
+                return f'{self.confidence:.0%} interval [{low:.0%}, {high:.0%}] is within {self.max_width:.0%}'
+            return None
+        if self.llr >= math.log((1 - self.beta) / self.alpha):
+            return f'success rate is at least {self.p1:.0%} (sprt)'
+        if self.llr <= math.log(self.beta / (1 - self.alpha)):
+            return f'success rate is at most {self.p0:.0%} (sprt)'
+        return None
+
+    def summary(self) -> str:
+        low, high = wilson_interval(self.successes, self.n, self.confidence)
+        return f'{self.successes}/{self.n} successful ({self.confidence:.0%} interval [{low:.0%}, {high:.0%}])'
+
+
+class InOrderStopping:
+    """
+    Feeds trial outcomes to a stopping rule in trial order, holding back any that come in before an earlier trial's.
+    Trials running in parallel are scored as they finish, and quick failures tend to finish first, so a rule fed in
+    the order trials finish would see a biased sample (and could stop on it)
+
+    Args:
+        rule (StoppingRule): the rule to feed
+        trials (Iterable[int]): indices of the trials the outcomes will be for, in order
+    """
+    def __init__(self, rule: StoppingRule, trials: Iterable[int]):
+        self.rule = rule
+        self._order = deque(trials)
+        self._held: dict[int, bool|None] = {}
+        self._lock = threading.Lock()
+
+    def update(self, i: int, success: bool|None) -> str|None:
+        """
+        record the outcome of trial `i` (None if it wasn't scored, e.g. it was interrupted). Returns why to stop the
+        first time the rule is satisfied, or None to keep going
+        """
+        with self._lock:
+            if self.rule.decision() is not None:
+                return None
+            self._held[i] = success
+            while self._order and self._order[0] in self._held:
+                outcome = self._held.pop(self._order.popleft())
+                if outcome is not None and (reason := self.rule.update(outcome)) is not None:
+                    return reason
+            return None
+
+
+def add_stopping_arguments(parser):
+    """command line options for early stopping, shared by run_trials and sweep"""
+    parser.add_argument('--early-stop', choices=['ci', 'sprt'], default=None, help='stop a run of trials once its success rate is known well enough (scored as each trial finishes)')
+    parser.add_argument('--min-trials', type=int, default=10, help='never stop early before this many trials have been scored')
+    parser.add_argument('--ci-width', type=float, default=0.2, help="for --early-stop ci, stop once the success rate's confidence interval is at most this wide")
+    parser.add_argument('--confidence', type=float, default=0.95, help='for --early-stop ci, the confidence level of the interval')
+    parser.add_argument('--sprt', type=float, nargs=2, default=(0.2, 0.6), metavar=('P0', 'P1'), help='for --early-stop sprt, the low and high success rates to decide between')
+    parser.add_argument('--sprt-errors', type=float, nargs=2, default=(0.05, 0.05), metavar=('ALPHA', 'BETA'), help='for --early-stop sprt, the chance of wrongly deciding high/low')
+
+def stopping_rule_from_args(args) -> StoppingRule|None:
+    if args.early_stop is None:
+        return None
+    return StoppingRule(
+        args.early_stop, min_trials=args.min_trials, confidence=args.confidence, max_width=args.ci_width,
+        p0=args.sprt[0], p1=args.sprt[1], alpha=args.sprt_errors[0], beta=args.sprt_errors[1]
+    )
@@ -3,6 +3,7 @@ import pandas as pd
 from dataclasses import dataclass
 from functools import cache
 from .analysis_utils import Score, Analyzer
+from .id_matching import ids_in_any_column, MultiPatternScanner
 
 
 
@@ -30,7 +31,8 @@ def main():
         workdir=workdir,
         task_variant=task_variant,
         evaluate_trial_fn=evaluate_gdc_trial,
-        reference_code=get_gdc_reference_code()
+        reference_code=get_gdc_reference_code(),
+        warmup_fn=get_gdc_reference,
     )
     analyzer.plot_results()
 
@@ -45,6 +47,11 @@ def get_gdc_reference() -> tuple[pd.DataFrame, set]:
 
     return reference, solution_ids
 
+@cache
+def get_gdc_id_scanner() -> MultiPatternScanner:
+    _, solution_ids = get_gdc_reference()
+    return MultiPatternScanner(solution_ids)
+
 def get_gdc_reference_code() -> str:
         """Return a stripped version of the reference solution"""
         reference_code_path = here / 'gdc_reference_solution.py'
@@ -54,11 +61,16 @@ def get_gdc_reference_code() -> str:
         return reference_code
 
 
-def evaluate_gdc_trial(trial_name: str, code_chunks: list[str]) -> GDCScore:
+def evaluate_gdc_trial(trial_name: str, code_chunks: list[str], data_dir: Path|None = None) -> GDCScore:
     reference, solution_ids = get_gdc_reference()
 
-    data_path = workdir/f'{trial_name}.csv'
-        
+    # trials being scored while they run (rather than by the analysis) live somewhere other than the module's workdir
+    data_path = (data_dir or workdir)/f'{trial_name}.csv'
+    return score_gdc_csv(data_path, len(reference), solution_ids, get_gdc_id_scanner())
+
+
+def score_gdc_csv(data_path: Path, reference_rows: int, solution_ids: set, id_scanner: MultiPatternScanner) -> GDCScore:
+    """score a trial's csv against the reference ids (the benchmarks call this with synthetic references)"""
     # see if a file was even created
     if not data_path.exists():
         return GDCScore(False, 0, False, False, False)
@@ -70,16 +82,18 @@ def evaluate_gdc_trial(trial_name: str, code_chunks: list[str]) -> GDCScore:
         return GDCScore(False, 0, False, False, True)
         
     # see if csv has correct number of rows or any data at all
-    correct_num_rows = len(data) == len(reference)
+    correct_num_rows = len(data) == reference_rows
     any_data = len(data) > 0
     
     # check how many ids are correct
     try:
         trial_ids = set(data['id'].tolist())
     except KeyError:
-        # no id column, so just check the raw text from the file
-        raw_text = data_path.read_text()
-        trial_ids = set([id for id in solution_ids if id in raw_text])
+        # no id column. If every id shows up as a value somewhere in the table, the raw text check below can only agree
+        trial_ids = ids_in_any_column(data, solution_ids)
+        if trial_ids != solution_ids:
+            # otherwise just check the raw text from the file
+            trial_ids = id_scanner.scan(data_path)
 
     # see if the ids are correct. (jaccard score i.e. IoU)
     correct_ids = len(solution_ids.intersection(trial_ids)) / len(solution_ids.union(trial_ids))
@@ -0,0 +1,286 @@
+"""
+Record/replay layer for the external APIs the trials talk to (GDC and cBioPortal)
+
+A local HTTP server sits in front of the real APIs. In record mode it forwards each request upstream and saves the
+request/response pair to an on-disk content-addressed store. In replay mode it serves responses straight out of the
+store (optionally with injected latency) without touching the network.
+
+Requests made with the `requests` library to any of the routed hosts are redirected to the local server, so
+neither the agent's code nor the reference solutions need to change. e.g. to run a reference solution offline:
+    python -m experiments.http_replay replay experiments/gdc_reference_solution.py
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Literal, Generator
+import threading
+import hashlib
+import base64
+import random
+import runpy
+import json
+import time
+import os
+
+from .rate_limit import rate_limiter_from_env, retry_after_seconds
+
+
+here = Path(__file__).parent
+default_store_dir = here / '../../http_store'
+
+# hosts that get routed through the local server
+HOSTS = ('api.gdc.cancer.gov', 'www.cbioportal.org')
+
+# environment variable used to hand the server address to trial processes
+SERVER_ENV_VAR = 'CURATOR_HTTP_SERVER'
+
+Mode = Literal['live', 'record', 'replay']
+
+
+def _normalize_value(value: str) -> str:
+    """canonicalize JSON values (e.g. GDC `filters`) so key order/whitespace don't change the key"""
+    try:
+        return json.dumps(json.loads(value), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        return value
+
+def _normalize_body(body: bytes) -> bytes:
+    if not body:
+        return b''
+    try:
+        return json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+    except ValueError:
+        pass
+    try:
+        return urlencode(sorted(parse_qsl(body.decode(), keep_blank_values=True, strict_parsing=True))).encode()
+    except ValueError:
+        return body
+
+def request_key(method: str, url: str, body: bytes|None) -> str:
+    """content address of a request: method + URL (with sorted, canonicalized query params) + normalized body"""
+    parts = urlsplit(url)
+    query = sorted((k, _normalize_value(v)) for k, v in parse_qsl(parts.query, keep_blank_values=True))
+    normalized_url = f'{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path}?{urlencode(query)}'
+    digest = hashlib.sha256()
+    digest.update(method.upper().encode())
+    digest.update(b'\n')
+    digest.update(normalized_url.encode())
+    digest.update(b'\n')
+    digest.update(_normalize_body(body or b''))
+    return digest.hexdigest()
+
+
+class HttpStore:
+    """On-disk store of request/response pairs, addressed by `request_key`"""
+    def __init__(self, root: Path):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f'{key}.json'
+
+    def get(self, key: str) -> dict|None:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        record = json.loads(path.read_text())
+        record['content'] = base64.b64decode(record['content'])
+        return record
+
+    def put(self, key: str, method: str, url: str, body: bytes|None, status: int, headers: dict[str, str], content: bytes):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        record = {
+            'method': method,
+            'url': url,
+            'body': (body or b'').decode(errors='replace'),
+            'status': status,
+            'headers': headers,
+            'content': base64.b64encode(content).decode(),
+            'recorded_at': time.time(),
+        }
+        # write then rename so concurrent readers never see a partial record
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_text(json.dumps(record))
+        tmp_path.replace(path)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.root.glob('*/*.json'))
+
+
+# headers that describe the transfer rather than the content, and so shouldn't be recorded/forwarded
+_hop_headers = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'host', 'accept-encoding'}
+
+class HttpReplayServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the routed APIs. Requests arrive as http://<server>/<host>/<path>?<query>
+
+    Args:
+        store (HttpStore): where request/response pairs are kept
+        mode ('record'|'replay'): record forwards to the real API and saves the response, replay only serves from the store
+        latency (float): seconds of delay added to every replayed response
+        jitter (float): up to this many extra seconds of random delay added to every replayed response
+        port (int): port to listen on. Defaults to 0 (any free port)
+    """
+    daemon_threads = True
+
+    def __init__(self, store: HttpStore, mode: Literal['record', 'replay'], latency: float = 0.0, jitter: float = 0.0, port: int = 0):
+        super().__init__(('127.0.0.1', port), _ReplayHandler)
+        self.store = store
+        self.mode = mode
+        self.latency = latency
+        self.jitter = jitter
+        self.hits = 0
+        self.misses = 0
+        # requests forwarded upstream count against the same shared limits as live requests from the trials
+        self.limiter = rate_limiter_from_env() if mode == 'record' else None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    server: HttpReplayServer
+
+    def _handle(self):
+        host, _, path = self.path.lstrip('/').partition('/')
+        url = f'https://{host}/{path}'
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        key = request_key(self.command, url, body)
+
+        if self.server.mode == 'record':
+            try:
+                status, headers, content = self._forward(url, body)
+            except URLError as e:
+                # couldn't reach the API at all. Nothing worth recording
+                self._respond(502, {'Content-Type': 'application/json'}, json.dumps({'error': str(e)}).encode())
+                return
+            self.server.store.put(key, self.command, url, body, status, headers, content)
+        else:
+            record = self.server.store.get(key)
+            if record is None:
+                self.server.misses += 1
+                message = json.dumps({'error': f'no recorded response for {self.command} {url}'}).encode()
+                self._respond(404, {'Content-Type': 'application/json'}, message)
+                return
+            self.server.hits += 1
+            status, headers, content = record['status'], record['headers'], record['content']
+            delay = self.server.latency + random.uniform(0, self.server.jitter)
+            if delay > 0:
+                time.sleep(delay)
+
+        self._respond(status, headers, content)
+
+    def _forward(self, url: str, body: bytes, max_retries: int = 3) -> tuple[int, dict[str, str], bytes]:
+        if self.server.limiter is None:
+            return self._send_upstream(url, body)
+        # throttled responses are retried rather than recorded, since they'd be replayed as if they were the API's answer
+        for attempt in range(max_retries + 1):
+            with self.server.limiter.limit(urlsplit(url).hostname) as permit:
+                status, headers, content = self._send_upstream(url, body)
+                permit.status = status
+                permit.retry_after = retry_after_seconds(headers)
+            if status != 429 or attempt == max_retries:
+                return status, headers, content
+
+    def _send_upstream(self, url: str, body: bytes) -> tuple[int, dict[str, str], bytes]:
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in _hop_headers}
+        request = Request(url, data=body or None, headers=headers, method=self.command)
+        try:
+            with urlopen(request) as response:
+                status, response_headers, content = response.status, response.headers, response.read()
+        except HTTPError as e:
+            # error responses are part of the API's behavior, so they get recorded too
+            status, response_headers, content = e.code, e.headers, e.read()
+        return status, {k: v for k, v in response_headers.items() if k.lower() not in _hop_headers}, content
+
+    def _respond(self, status: int, headers: dict[str, str], content: bytes):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def route_requests(server_url: str, hosts: tuple[str, ...] = HOSTS):
+    """Redirect every `requests` call to one of the given hosts through the local server (for this process)"""
+    from requests.adapters import HTTPAdapter
+
+    original_send = getattr(HTTPAdapter.send, '_original_send', HTTPAdapter.send)
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname in hosts:
+            request.url = f'{server_url}/{parts.netloc}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+        return original_send(self, request, **kwargs)
+    send._original_send = original_send
+    HTTPAdapter.send = send
+
+def unroute_requests():
+    from requests.adapters import HTTPAdapter
+    HTTPAdapter.send = getattr(HTTPAdapter.send, '_original_send', HTTPAdapter.send)
+
+def route_requests_from_env():
+    """Route requests if a parent process started a replay server (see `serve_http`)"""
+    server_url = os.environ.get(SERVER_ENV_VAR)
+    if server_url:
+        route_requests(server_url)
+
+
+@contextmanager
+def serve_http(mode: Mode, store_dir: Path = default_store_dir, latency: float = 0.0, jitter: float = 0.0) -> Generator[HttpReplayServer|None, None, None]:
+    """
+    Run a record/replay server in the background for the duration of the context.
+    Requests from this process and any child processes started inside the context are routed through it.
+    In 'live' mode nothing is changed and None is yielded.
+    """
+    if mode == 'live':
+        yield None
+        return
+
+    server = HttpReplayServer(HttpStore(store_dir), mode, latency=latency, jitter=jitter)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    os.environ[SERVER_ENV_VAR] = server.url
+    route_requests(server.url)
+    print(f'HTTP {mode} server for {", ".join(HOSTS)} running at {server.url} (store: {store_dir})')
+    try:
+        yield server
+    finally:
+        unroute_requests()
+        os.environ.pop(SERVER_ENV_VAR, None)
+        server.shutdown()
+        server.server_close()
+        if mode == 'replay':
+            print(f'HTTP replay: {server.hits} hits, {server.misses} misses')
+
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='run a python script with its GDC/cBioPortal requests recorded or replayed')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('script', type=Path)
+    parser.add_argument('--store', type=Path, default=default_store_dir, help='directory of recorded responses')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of delay added to each replayed response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds of random delay per replayed response')
+    args = parser.parse_args()
+
+    with serve_http(args.mode, args.store, args.latency, args.jitter):
+        runpy.run_path(str(args.script), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Vectorized matching of a trial's csv columns against the set of IDs in a reference solution
+
+Each column is reduced to its distinct values and looked up against the reference IDs with a single hash-based `isin`,
+so the cost is linear in the size of the csv no matter how many IDs there are. Values are compared as strings (same as
+`str` of each cell), but numeric columns are matched against only the IDs that a number of that dtype could print as.
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable
+import numpy as np
+import pandas as pd
+import mmap
+
+
+@dataclass
+class ColumnMatch:
+    column: str
+    found: set[str] = field(repr=False)  # reference IDs that appear as a value in the column
+    match_rate: float                     # fraction of the reference IDs found in the column
+
+    @property
+    def matches(self) -> int:
+        return len(self.found)
+
+
+def match_columns(data: pd.DataFrame, ids: set) -> list[ColumnMatch]:
+    """how many of the reference IDs appear in each column of `data` (compared as strings), in column order"""
+    reference = sorted(str(id) for id in ids)
+    typed_references: dict[np.dtype, tuple[pd.Index, np.ndarray]] = {}
+    results = []
+    for column in data.columns:
+        values = data[column]
+        if values.dtype.kind in 'iuf':
+            # numeric columns are matched numerically rather than converting every value to a string
+            if values.dtype not in typed_references:
+                typed_references[values.dtype] = _typed_reference(reference, values.dtype)
+            typed, typed_ids = typed_references[values.dtype]
+            found = typed_ids[typed.isin(values.unique())]
+        else:
+            # dedupe before converting to strings, since most columns have far fewer distinct values than rows
+            found = np.asarray(reference, dtype=object)[pd.Index(reference).isin(pd.Series(values.unique()).astype(str))]
+        results.append(ColumnMatch(str(column), set(found), len(found) / len(reference) if reference else 0.0))
+    return results
+
+
+def _typed_reference(reference: list[str], dtype: np.dtype) -> tuple[pd.Index, np.ndarray]:
+    """the reference IDs that are exactly how some value of a numeric dtype prints, and those values"""
+    values, ids = [], []
+    for id in reference:
+        try:
+            value = dtype.type(id)
+        except (ValueError, OverflowError):
+            continue
+        if pd.Series([value], dtype=dtype).astype(str).iloc[0] == id:
+            values.append(value)
+            ids.append(id)
+    return pd.Index(np.array(values, dtype=dtype)), np.asarray(ids, dtype=object)
+
+
+def best_matching_column(data: pd.DataFrame, ids: set) -> ColumnMatch|None:
+    """the column containing the most reference IDs (the first one on ties), or None if no column contains any"""
+    best = None
+    for match in match_columns(data, ids):
+        if match.matches > 0 and (best is None or match.matches > best.matches):
+            best = match
+    return best
+
+
+def ids_in_any_column(data: pd.DataFrame, ids: set) -> set[str]:
+    """every reference ID that appears as a value anywhere in `data`"""
+    return set().union(*(match.found for match in match_columns(data, ids)))
+
+
+class MultiPatternScanner:
+    """
+    Finds which of a fixed set of strings occur anywhere in a file, without reading the whole file into memory
+
+    The file is memory-mapped and scanned a chunk at a time, stopping as soon as every pattern has been seen.
+    Up to `direct_search_limit` patterns are each searched for directly. Beyond that, every window of each pattern length in
+    the chunk gets a rolling hash (computed with numpy rather than byte by byte), and only windows whose hash belongs
+    to some pattern are compared, so a single pass over the chunk covers all patterns at once.
+    Results are the same as `{p for p in patterns if p in path.read_text()}` for utf-8 files.
+
+    Args:
+        patterns (Iterable[str]): the strings to look for
+        chunk_size (int): bytes scanned at a time
+        direct_search_limit (int): up to this many patterns are searched for one at a time instead of hashed
+    """
+    def __init__(self, patterns: Iterable[str], chunk_size: int = 1 << 20, direct_search_limit: int = 100):
+        self.patterns = {pattern.encode(): pattern for pattern in patterns if pattern}
+        self.chunk_size = chunk_size
+        self.direct_search_limit = direct_search_limit
+        self.max_length = max(map(len, self.patterns), default=0)
+
+        # pattern hashes grouped by length, sorted for lookup with searchsorted
+        self.hashes: dict[int, np.ndarray] = {}
+        self.filters: dict[int, np.ndarray] = {}
+        by_length: dict[int, list[bytes]] = defaultdict(list)
+        for pattern in self.patterns:
+            by_length[len(pattern)].append(pattern)
+        for length, group in by_length.items():
+            self.hashes[length] = np.unique(np.array([_polynomial_hash(pattern) for pattern in group], dtype=np.uint64))
+            self.filters[length] = np.zeros(1 << (64 - int(_filter_shift)), dtype=bool)
+            self.filters[length][self.hashes[length] >> _filter_shift] = True
+        self._powers: tuple[np.ndarray, np.ndarray]|None = None
+
+    def scan(self, path: Path) -> set[str]:
+        """the patterns that occur somewhere in the file at `path`"""
+        if not self.patterns or path.stat().st_size == 0:
+            return set()
+        found: set[bytes] = set()
+        with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start in range(0, len(data), self.chunk_size):
+                end = min(start + self.chunk_size, len(data))
+                remaining = [pattern for pattern in self.patterns if pattern not in found]
+                if len(remaining) <= self.direct_search_limit:
+                    # matches may run past the end of the chunk, but have to start inside it
+                    found.update(pattern for pattern in remaining if data.find(pattern, start, min(end + len(pattern) - 1, len(data))) != -1)
+                else:
+                    found.update(self._hash_scan(data, start, end))
+                if len(found) == len(self.patterns):
+                    break
+        return {self.patterns[pattern] for pattern in found}
+
+    def _hash_scan(self, data: mmap.mmap, start: int, end: int) -> set[bytes]:
+        """patterns that start somewhere in data[start:end]"""
+        window_end = min(end + self.max_length - 1, len(data))
+        window = np.frombuffer(data, dtype=np.uint8, count=window_end - start, offset=start).astype(np.uint64)
+        powers, inverse_powers = self._get_powers()
+        n = len(window)
+
+        # prefix[i] is the hash of window[:i]. Arithmetic is mod 2^64, where the (odd) base has an inverse, which
+        # turns the usual sequential recurrence into a cumulative sum
+        prefix = np.zeros(n + 1, dtype=np.uint64)
+        prefix[1:] = powers[1:n+1] * np.cumsum(window * inverse_powers[1:n+1])
+
+        found = set()
+        for length, hashes in self.hashes.items():
+            num_starts = min(end - start, n - length + 1)
+            if num_starts <= 0:
+                continue
+            window_hashes = prefix[length:length+num_starts] - prefix[:num_starts] * powers[length]
+            # cheap filter on the top bits of the hash first, then an exact check of whatever gets through
+            hits = np.flatnonzero(self.filters[length][window_hashes >> _filter_shift])
+            candidates = np.minimum(np.searchsorted(hashes, window_hashes[hits]), len(hashes) - 1)
+            hits = hits[hashes[candidates] == window_hashes[hits]]
+
+            # short patterns can hit all over the place, but one confirmed hit per distinct hash is all that's needed.
+            # Further hits with the same hash are only checked if the first turns out to be a hash collision
+            hit_hashes = window_hashes[hits]
+            order = np.argsort(hit_hashes, kind='stable')
+            for group in np.split(hits[order], np.flatnonzero(np.diff(hit_hashes[order])) + 1):
+                for i in group:
+                    candidate = data[start + i:start + i + length]
+                    if candidate in self.patterns:
+                        found.add(candidate)
+                        break
+        return found
+
+    def _get_powers(self) -> tuple[np.ndarray, np.ndarray]:
+        # base^i and base^-i for every offset in a chunk, computed once per scanner
+        if self._powers is None:
+            n = self.chunk_size + self.max_length
+            powers = np.ones(n + 1, dtype=np.uint64)
+            inverse_powers = np.ones(n + 1, dtype=np.uint64)
+            powers[1:] = np.cumprod(np.full(n, _base, dtype=np.uint64))
+            inverse_powers[1:] = np.cumprod(np.full(n, _inverse_base, dtype=np.uint64))
+            self._powers = powers, inverse_powers
+        return self._powers
+
+
+_base = 0x100000001B3 # any odd number works
+_filter_shift = np.uint64(64 - 22)
+_inverse_base = pow(_base, -1, 1 << 64)
+
+def _polynomial_hash(pattern: bytes) -> int:
+    h = 0
+    for byte in pattern:
+        h = (h * _base + byte) % (1 << 64)
+    return h
@@ -0,0 +1,96 @@
+"""
+On-disk cache of LLM responses, shared across workdirs
+
+Each response is addressed by a hash of everything that went into the call (model, prompt version, inputs), so a
+call is only ever made again if something about it changed. The cache is bounded in size, evicting the least
+recently used responses first.
+"""
+
+from pathlib import Path
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+
+
+here = Path(__file__).parent
+default_cache_path = here / '../../llm_cache.db'
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+'''
+
+
+def cache_key(**parts) -> str:
+    """hash of the (json serializable) inputs of a call"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class LLMCache:
+    """
+    Size-bounded LRU cache of LLM responses in an SQLite database. Safe to use from multiple threads and processes.
+
+    Args:
+        path (Path): the database file. Created if it doesn't exist
+        max_bytes (int): responses are evicted, least recently used first, once their total size exceeds this
+    """
+    def __init__(self, path: Path = default_cache_path, max_bytes: int = 256 * 2**20):
+        self.path = Path(path).resolve()
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._connection().executescript(_schema)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> str|None:
+        conn = self._connection()
+        row = conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, response: str):
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                '''INSERT INTO responses (key, response, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET response=excluded.response, size=excluded.size, last_used=excluded.last_used''',
+                (key, response, len(response.encode()), now, now)
+            )
+            self._evict(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn: sqlite3.Connection):
+        total, = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
@@ -0,0 +1,237 @@
+"""
+Record/replay layer for the LLM calls made during a trial (the archytas ReAct agent and the AdhocApi drafter)
+
+In record mode every call is made as usual, and its request/response is saved to an on-disk trace store under the
+trial it belongs to. In replay mode the responses are served back from the store, in the same order they were
+recorded, without touching the network. Together with the http record/replay layer (see http_replay.py) this lets a
+whole run of trials be re-executed offline in seconds, e.g. to iterate on the harness or the analyzers:
+    python -m experiments.run_trials --llm replay --http replay
+"""
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from archytas.react import ReActAgent
+from adhoc_api.tool import AdhocApi, APISpec, DrafterConfig
+from contextlib import contextmanager
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Literal, Generator
+import threading
+import asyncio
+import hashlib
+import json
+import os
+
+
+here = Path(__file__).parent
+default_trace_dir = here / '../../llm_traces'
+
+# environment variables used to hand the mode/store to trial processes
+MODE_ENV_VAR = 'CURATOR_LLM_MODE'
+TRACES_ENV_VAR = 'CURATOR_LLM_TRACES'
+
+Mode = Literal['live', 'record', 'replay']
+Source = Literal['agent', 'drafter']
+
+# keys the LLM clients insist on having set, even though nothing is sent in replay mode
+_dummy_keys = ('OPENAI_API_KEY', 'GEMINI_API_KEY', 'ANTHROPIC_API_KEY')
+
+
+class TraceMissError(Exception):
+    """raised in replay mode when a trial makes a call that wasn't recorded"""
+
+
+def request_hash(request: Any) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class TraceStore:
+    """On-disk store of LLM calls, one file per call: <root>/<variant>/<trial>/<source>-<index>.json"""
+    def __init__(self, root: Path):
+        self.root = Path(root).resolve()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, variant: str, trial: str, source: Source, index: int) -> Path:
+        return self.root / variant / trial / f'{source}-{index:04d}.json'
+
+    def get(self, variant: str, trial: str, source: Source, index: int) -> dict|None:
+        path = self._path(variant, trial, source, index)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())
+
+    def put(self, variant: str, trial: str, source: Source, index: int, request_hash: str, response: Any):
+        path = self._path(variant, trial, source, index)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write then rename so concurrent readers never see a partial record
+        tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp_path.write_text(json.dumps({'request_hash': request_hash, 'response': response}))
+        tmp_path.replace(path)
+
+    def clear_trial(self, variant: str, trial: str):
+        """remove any previous recording of a trial, so a re-recording doesn't end up mixed with an old one"""
+        for path in (self.root / variant / trial).glob('*.json'):
+            path.unlink()
+
+
+class TrialTrace:
+    """
+    Records or replays the LLM calls of a single trial. Calls from each source are numbered in the order they are made
+
+    Args:
+        store (TraceStore): where calls are kept
+        mode ('record'|'replay'): record makes the real calls and saves them, replay only serves from the store
+        variant (str): the API variant the trial was run against (e.g. its cache_key)
+        trial (str): name of the trial, e.g. trial_3
+    """
+    def __init__(self, store: TraceStore, mode: Literal['record', 'replay'], variant: str, trial: str):
+        self.store = store
+        self.mode = mode
+        self.variant = variant
+        self.trial = trial
+        self.counts: dict[Source, int] = defaultdict(int)
+        self.diverged = 0
+        if mode == 'record':
+            store.clear_trial(variant, trial)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    def _next_index(self, source: Source) -> int:
+        index = self.counts[source]
+        self.counts[source] += 1
+        return index
+
+    def record(self, source: Source, request: Any, response: Any):
+        self.store.put(self.variant, self.trial, source, self._next_index(source), request_hash(request), response)
+
+    def replay(self, source: Source, request: Any) -> Any:
+        index = self._next_index(source)
+        record = self.store.get(self.variant, self.trial, source, index)
+        if record is None:
+            raise TraceMissError(f'no recorded {source} call #{index} for {self.variant}/{self.trial}')
+        # requests can legitimately differ (e.g. tool output containing timestamps), so this is only tracked, not an error
+        if record['request_hash'] != request_hash(request):
+            self.diverged += 1
+        return record['response']
+
+    def summary(self) -> str:
+        calls = ', '.join(f'{count} {source}' for source, count in self.counts.items()) or 'no'
+        diverged = f' ({self.diverged} with a different request than recorded)' if self.diverged else ''
+        return f'LLM {self.mode}: {calls} calls{diverged}'
+
+
+def instrument_agent(agent: ReActAgent, trace: TrialTrace):
+    """record/replay every call the ReAct agent makes to its model"""
+    original_ainvoke = agent.model.ainvoke
+
+    async def ainvoke(input: list[BaseMessage], **kwargs):
+        request = [message_to_dict(message) for message in input]
+        if trace.replaying:
+            # archytas post-processes each response in a background task, and breaks if the previous one is still
+            # pending when the next response arrives. Live calls always take long enough, replayed ones don't
+            if agent.post_execute_task is not None:
+                await asyncio.wait([agent.post_execute_task])
+                await asyncio.sleep(0) # let the task's done callback run
+            return messages_from_dict([trace.replay('agent', request)])[0]
+        result = await original_ainvoke(input, **kwargs)
+        # saved before archytas post-processes (and mutates) the result
+        trace.record('agent', request, message_to_dict(result))
+        return result
+
+    agent.model.ainvoke = ainvoke
+
+
+class _DrafterProxy:
+    """stands in for the drafter agent AdhocApi uses for an API, recording or replaying its messages"""
+    def __init__(self, make_agent, trace: TrialTrace):
+        self._make_agent = make_agent
+        self._agent = None
+        self.trace = trace
+
+    @property
+    def agent(self):
+        # only created when actually needed, since setting up a drafter may itself make requests (e.g. gemini caching)
+        if self._agent is None:
+            self._agent = self._make_agent()
+        return self._agent
+
+    def message(self, message: str, stream: bool = False, **kwargs) -> str:
+        if stream:
+            raise NotImplementedError('streaming drafter responses cannot be recorded')
+        if self.trace.replaying:
+            return self.trace.replay('drafter', message)
+        response = self.agent.message(message, **kwargs)
+        self.trace.record('drafter', message, response)
+        return response
+
+    def clear_messages(self):
+        if self._agent is not None:
+            self._agent.clear_messages()
+
+    def __getattr__(self, name: str):
+        return getattr(self.agent, name)
+
+
+def instrument_adhoc_api(adhoc_api: AdhocApi, trace: TrialTrace):
+    """record/replay every message sent to the drafter agents of an AdhocApi instance"""
+    # instrumenting the same instance again (for the next trial) replaces the previous proxies
+    original_get_agent = getattr(adhoc_api._get_agent, '_original', adhoc_api._get_agent)
+    proxies: dict[str, _DrafterProxy] = {}
+
+    def get_agent(api: str):
+        if api not in proxies:
+            proxies[api] = _DrafterProxy(lambda: original_get_agent(api), trace)
+        return proxies[api]
+
+    get_agent._original = original_get_agent
+    adhoc_api._get_agent = get_agent
+
+
+def replay_api_spec(api: APISpec, drafter_config: DrafterConfig|list[DrafterConfig]) -> APISpec:
+    """
+    Pin the drafter model for an API, so AdhocApi doesn't count tokens against each candidate model (which makes
+    requests) to pick one. Only meant for replay mode, where the drafter is never actually called
+    """
+    if 'model_override' in api:
+        return api
+    config = drafter_config[0] if isinstance(drafter_config, list) else drafter_config
+    return {**api, 'model_override': config}
+
+
+def llm_mode_from_env() -> Mode:
+    return os.environ.get(MODE_ENV_VAR, 'live')
+
+def trace_from_env(variant: str, trial: str) -> TrialTrace|None:
+    """The trace for a trial if a parent process turned on recording/replay (see `llm_mode`)"""
+    mode = llm_mode_from_env()
+    if mode == 'live':
+        return None
+    return TrialTrace(TraceStore(Path(os.environ[TRACES_ENV_VAR])), mode, variant, trial)
+
+
+@contextmanager
+def llm_mode(mode: Mode, trace_dir: Path = default_trace_dir) -> Generator[None, None, None]:
+    """
+    Record or replay the LLM calls of every trial run inside the context (including in child processes).
+    In replay mode, placeholder API keys are set for any that are missing, since no requests are made
+    """
+    if mode == 'live':
+        yield
+        return
+
+    previous = {var: os.environ.get(var) for var in (MODE_ENV_VAR, TRACES_ENV_VAR, *_dummy_keys)}
+    os.environ[MODE_ENV_VAR] = mode
+    os.environ[TRACES_ENV_VAR] = str(Path(trace_dir).resolve())
+    if mode == 'replay':
+        for var in _dummy_keys:
+            os.environ.setdefault(var, 'replay')
+    print(f'LLM {mode} mode (traces: {trace_dir})')
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
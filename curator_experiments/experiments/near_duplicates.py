@@ -0,0 +1,277 @@
+"""
+MinHash/LSH index for finding families of near-duplicate trials
+
+Many trials end up re-emitting almost exactly the same code (e.g. the example from the docs), so work like similarity
+ranking only needs to be done once per family. Each trial is reduced to a MinHash signature over shingles of its
+normalized token stream, and signatures are bucketed with locality sensitive hashing so families can be found without
+comparing every pair of trials.
+
+The index is saved in each workdir, and indices from several workdirs can be merged to find families across runs:
+    python -m experiments.near_duplicates ../workdir_20250225_132405 ../workdir_20250228_134952
+"""
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable
+import tokenize
+import hashlib
+import io
+import numpy as np
+
+from .code_similarity import parse_chunks, bound_names, stable_hash
+from .trial_store import TrialStore, open_trial_store, store_filename
+
+
+index_filename = 'near_duplicates.npz'
+_prime = np.uint64((1 << 61) - 1)
+_max_hash = np.uint64((1 << 64) - 1)
+
+
+def code_tokens(code_chunks: list[str]) -> list[str]:
+    """token stream of all the python in a trial, with locally bound names and literals normalized"""
+    sources = [chunk for chunk in code_chunks if parse_chunks([chunk])]
+    local_names = bound_names(parse_chunks(sources))
+    tokens = []
+    for source in sources:
+        try:
+            for token in tokenize.generate_tokens(io.StringIO(source).readline):
+                if token.type == tokenize.NAME:
+                    tokens.append('VAR' if token.string in local_names else token.string)
+                elif token.type == tokenize.STRING:
+                    tokens.append('STR')
+                elif token.type == tokenize.NUMBER:
+                    tokens.append('NUM')
+                elif token.type == tokenize.OP:
+                    tokens.append(token.string)
+        except tokenize.TokenError:
+            continue
+    return tokens
+
+
+def code_hash(code_chunks: list[str]) -> str:
+    """hash of a trial's code, to tell when its signature is out of date"""
+    digest = hashlib.sha256()
+    for chunk in code_chunks:
+        digest.update(b'\0')
+        digest.update(chunk.encode())
+    return digest.hexdigest()
+
+
+def shingles(tokens: list[str], k: int = 5) -> set[int]:
+    """hashes of every run of k consecutive tokens"""
+    if len(tokens) < k:
+        return {stable_hash(' '.join(tokens))} if tokens else set()
+    return {stable_hash(' '.join(tokens[i:i+k])) for i in range(len(tokens) - k + 1)}
+
+
+class MinHasher:
+    """MinHash signatures using `num_perm` random universal hash functions (a*x + b mod p)"""
+    def __init__(self, num_perm: int = 128, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingles: set[int]) -> np.ndarray:
+        if not shingles:
+            return np.full(len(self.a), _max_hash, dtype=np.uint64)
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) & np.uint64(0xFFFFFFFF)
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _prime).min(axis=1)
+
+
+def estimate_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """estimated jaccard similarity between the sets behind two signatures"""
+    return float(np.mean(a == b))
+
+
+class NearDuplicateIndex:
+    """
+    LSH index over MinHash signatures of trials
+
+    Args:
+        num_perm (int): length of each signature
+        bands (int): number of LSH bands. With r = num_perm/bands rows per band, pairs above roughly (1/bands)^(1/r)
+            similarity are likely to share a bucket. The defaults put this at ~0.7
+        seed (int): seed for the hash functions. Indices can only be merged/queried against each other if these all match
+    """
+    def __init__(self, num_perm: int = 128, bands: int = 16, seed: int = 0):
+        if num_perm % bands != 0:
+            raise ValueError(f'num_perm ({num_perm}) must be divisible by bands ({bands})')
+        self.num_perm, self.bands, self.seed = num_perm, bands, seed
+        self.hasher = MinHasher(num_perm, seed)
+        self.keys: list[str] = []
+        self.signatures: list[np.ndarray] = []
+        self.hashes: dict[str, str] = {} # key -> hash of the code its signature was made from ('' if unknown)
+        self.buckets: dict[tuple[int, bytes], list[int]] = defaultdict(list)
+        self._key_index: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._key_index
+
+    def signature(self, code_chunks: list[str]) -> np.ndarray:
+        return self.hasher.signature(shingles(code_tokens(code_chunks)))
+
+    def _band_keys(self, signature: np.ndarray) -> list[tuple[int, bytes]]:
+        rows = self.num_perm // self.bands
+        return [(band, signature[band*rows:(band+1)*rows].tobytes()) for band in range(self.bands)]
+
+    def _insert(self, key: str, signature: np.ndarray, content_hash: str = ''):
+        if key in self._key_index:
+            return
+        i = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        self.hashes[key] = content_hash
+        self._key_index[key] = i
+        for band_key in self._band_keys(signature):
+            self.buckets[band_key].append(i)
+
+    def add(self, key: str, code_chunks: list[str]):
+        self._insert(key, self.signature(code_chunks), code_hash(code_chunks))
+
+    def is_current(self, key: str, code_chunks: list[str]) -> bool:
+        """whether the index has the key, signed from this code"""
+        return self.hashes.get(key) == code_hash(code_chunks)
+
+    def query(self, code_chunks: list[str], threshold: float = 0.8) -> list[tuple[str, float]]:
+        """trials in the index that are near-duplicates of the given code, most similar first"""
+        signature = self.signature(code_chunks)
+        candidates = {i for band_key in self._band_keys(signature) for i in self.buckets.get(band_key, [])}
+        matches = [(self.keys[i], estimate_similarity(signature, self.signatures[i])) for i in candidates]
+        return sorted([match for match in matches if match[1] >= threshold], key=lambda match: -match[1])
+
+    def families(self, threshold: float = 0.8, keys: Iterable[str]|None = None) -> list[list[str]]:
+        """
+        Group every trial (or just `keys`) into a family of near-duplicates (singletons included), largest family first.
+        Two trials are in the same family if a chain of near-duplicate pairs links them.
+        The first member of each family can be used as its representative.
+        """
+        included = [self._key_index[key] for key in keys] if keys is not None else range(len(self.keys))
+        members_of = set(included)
+        parent = {i: i for i in included}
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # only pairs that share a bucket are ever compared, and each of them only once
+        compared: set[tuple[int, int]] = set()
+        for members in self.buckets.values():
+            members = [i for i in members if i in members_of]
+            if len(members) < 2:
+                continue
+            # identical signatures are near-duplicates without comparing them
+            distinct: dict[bytes, int] = {}
+            for i in members:
+                first = distinct.setdefault(self.signatures[i].tobytes(), i)
+                if first != i:
+                    parent[find(i)] = find(first)
+            distinct_members = list(distinct.values())
+            for n, a in enumerate(distinct_members):
+                for b in distinct_members[n+1:]:
+                    pair = (min(a, b), max(a, b))
+                    if pair in compared or find(a) == find(b):
+                        continue
+                    compared.add(pair)
+                    if estimate_similarity(self.signatures[a], self.signatures[b]) >= threshold:
+                        parent[find(b)] = find(a)
+
+        groups: dict[int, list[str]] = defaultdict(list)
+        for i in included:
+            groups[find(i)].append(self.keys[i])
+        return sorted(groups.values(), key=len, reverse=True)
+
+    def merge(self, other: 'NearDuplicateIndex', prefix: str = ''):
+        """add every trial from another index (keys optionally prefixed, e.g. with the workdir name)"""
+        if (other.num_perm, other.bands, other.seed) != (self.num_perm, self.bands, self.seed):
+            raise ValueError('cannot merge indices built with different parameters')
+        for key, signature in zip(other.keys, other.signatures):
+            self._insert(f'{prefix}{key}', signature, other.hashes[key])
+
+    def save(self, path: Path):
+        signatures = np.stack(self.signatures) if self.signatures else np.empty((0, self.num_perm), dtype=np.uint64)
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                keys=np.array(self.keys, dtype=str),
+                hashes=np.array([self.hashes[key] for key in self.keys], dtype=str),
+                signatures=signatures,
+                params=np.array([self.num_perm, self.bands, self.seed]),
+            )
+
+    @classmethod
+    def load(cls, path: Path) -> 'NearDuplicateIndex':
+        data = np.load(path)
+        num_perm, bands, seed = (int(p) for p in data['params'])
+        index = cls(num_perm, bands, seed)
+        # indices saved before hashes were kept get every trial signed again
+        hashes = data['hashes'] if 'hashes' in data.files else [''] * len(data['keys'])
+        for key, signature, content_hash in zip(data['keys'], data['signatures'], hashes):
+            index._insert(str(key), signature, str(content_hash))
+        return index
+
+
+def update_workdir_index(workdir: Path, trials: dict[str, list[str]]) -> NearDuplicateIndex:
+    """
+    load the index saved in the workdir, bring it up to date with the given trials, and save it back: trials that are
+    new or whose code changed (e.g. re-run under the same name) are signed, other trials already in the index are kept
+    (so a subset of the trials can be passed), and trials no longer in the workdir's store are dropped
+    """
+    path = workdir/index_filename
+    saved = NearDuplicateIndex.load(path) if path.exists() else NearDuplicateIndex()
+    store_path = workdir/store_filename
+    stored = set(TrialStore(store_path).names()) if store_path.exists() else None
+    hashes = {name: code_hash(code_chunks) for name, code_chunks in trials.items()}
+    changed = {name for name, content_hash in hashes.items() if saved.hashes.get(name) != content_hash}
+    removed = {key for key in saved.keys if stored is not None and key not in stored and key not in trials}
+    if path.exists() and not changed and not removed:
+        return saved
+
+    # buckets can't drop members, so the index is rebuilt, reusing the signatures that are still current
+    index = NearDuplicateIndex(saved.num_perm, saved.bands, saved.seed)
+    for key, signature in zip(saved.keys, saved.signatures):
+        if key not in removed and key not in changed:
+            index._insert(key, signature, saved.hashes[key])
+    for name in trials:
+        if name in changed:
+            index.add(name, trials[name])
+    index.save(path)
+    return index
+
+
+def load_workdir_indices(workdirs: list[Path]) -> NearDuplicateIndex:
+    """merge the indices of several workdirs. Keys are prefixed with the workdir name, e.g. 'workdir_20250225_132405/trial_3'"""
+    combined = NearDuplicateIndex()
+    for workdir in workdirs:
+        trials = open_trial_store(workdir).code()
+        combined.merge(update_workdir_index(workdir, trials), prefix=f'{workdir.name}/')
+    return combined
+
+
+def expand_family_rankings(rankings: list[tuple[int, str, float]], families: list[list[str]]) -> list[tuple[int, str, float]]:
+    """give every member of a family the rank and score of its representative"""
+    members = {family[0]: family for family in families}
+    return [(rank, member, score) for rank, name, score in rankings for member in members.get(name, [name])]
+
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='find families of near-duplicate trials across one or more workdirs')
+    parser.add_argument('workdirs', type=Path, nargs='+')
+    parser.add_argument('--threshold', type=float, default=0.8, help='minimum estimated jaccard similarity for two trials to be in the same family')
+    args = parser.parse_args()
+
+    index = load_workdir_indices(args.workdirs)
+    families = index.families(args.threshold)
+    print(f'{len(index)} trials in {len(families)} families')
+    for family in families:
+        if len(family) > 1:
+            print(f'({len(family)}) {", ".join(family)}')
+
+
+if __name__ == '__main__':
+    main()
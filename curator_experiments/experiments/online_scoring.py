@@ -0,0 +1,79 @@
+"""
+Scoring trials as they finish, rather than in a separate analysis pass once the whole run is done
+
+Each finished trial is handed to a background thread, which scores it with the case's evaluation function and saves
+the score to the workdir's trial store under the same key the analysis uses. So scores can be watched while a run is
+going (e.g. by early stopping), and `Analyzer.identify_solutions` only has to evaluate trials that changed since.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable
+
+from .analysis_utils import Score, evaluator_key, trial_content_hash, score_type, load_score
+from .trial_store import TrialStore, store_filename
+
+
+def score_and_save(evaluate_trial_fn: Callable[[str, list[str]], Score], workdir: Path, name: str) -> Score|None:
+    """
+    Score a finished trial in `workdir` and save the score to its trial store (reusing the saved score if the trial
+    hasn't changed since it was scored). None if the evaluator itself failed
+    """
+    store = TrialStore(workdir/store_filename)
+    record = store.get(name)
+    evaluator = evaluator_key(evaluate_trial_fn)
+    content_hash = trial_content_hash(workdir/f'{name}.csv', record.code_chunks)
+    score = load_score(store, name, evaluator, content_hash, score_type(evaluate_trial_fn))
+    if score is not None:
+        return score
+    try:
+        score = evaluate_trial_fn(name, record.code_chunks)
+    except Exception as e:
+        print(f'Error evaluating {name}: {e}')
+        return None
+    store.put_score(name, evaluator, content_hash, asdict(score))
+    return score
+
+
+class OnlineScorer:
+    """
+    Scores trials in the background as they finish, so scoring never holds up the next trial.
+    With the default single worker, trials are scored (and `on_score` callbacks run) one at a time in the order submitted
+
+    Args:
+        workers (int): number of trials to score at once
+    """
+    def __init__(self, workers: int = 1):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scorer')
+
+    def submit(
+        self,
+        evaluate_trial_fn: Callable[[str, list[str]], Score],
+        workdir: Path,
+        name: str,
+        on_score: Callable[[str, Score|None], None]|None = None
+    ) -> Future:
+        """
+        Queue a finished trial for scoring. `on_score(name, score)` is called from the scoring thread once it's saved.
+        Returns a future of the score
+        """
+        def run() -> Score|None:
+            score = score_and_save(evaluate_trial_fn, Path(workdir), name)
+            if on_score is not None:
+                try:
+                    on_score(name, score)
+                except Exception as e:
+                    print(f'Error handling the score of {name}: {e}')
+            return score
+        return self._pool.submit(run)
+
+    def close(self):
+        """wait for every queued trial to be scored"""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> 'OnlineScorer':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
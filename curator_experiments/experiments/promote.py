@@ -0,0 +1,470 @@
+"""
+Promoting the successful trials of a run into a prebaked solution (see `solved_tasks.py` and `solution_registry`)
+
+The most central successful trial (by AST similarity to the others) is taken as the canonical solution. Its code is cut
+down to the chunks the saved output actually depends on, which drops failed attempts, retries that were redone later,
+and exploratory printing. String literals that come from the query (gene symbols, study ids, disease types, ...) and
+the output file name become parameters, and the result is written out as a function in `prebaked_solutions/promoted`
+with a registry entry, so later runs of the same kind of query can call it instead of drafting it again:
+    python -m experiments.promote ../workdir_20250225_132405 --case gdc_trial_2
+"""
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+import keyword
+import builtins
+import ast
+import re
+
+import numpy as np
+
+from .code_similarity import CodeSimilarity, parse_chunks
+from .solution_registry import SolutionRegistry, SolutionTemplate, default_registry_path, stopwords, solutions_root
+from .trial_store import TrialRecord, open_trial_store
+from .run_trials import query_suffix
+
+
+promoted_dir = solutions_root / 'prebaked_solutions/promoted'
+promoted_package = 'prebaked_solutions.promoted'
+
+# methods that write a trial's results somewhere
+output_methods = {'to_csv', 'to_parquet', 'to_excel', 'to_json', 'to_feather', 'to_pickle', 'savefig', 'write', 'writerow', 'writerows', 'dump'}
+
+# methods that change the object they're called on (pandas methods only with inplace=True)
+mutating_methods = {'append', 'extend', 'insert', 'update', 'pop', 'remove', 'clear', 'add', 'discard', 'setdefault', 'sort', 'reverse'}
+
+_builtin_names = set(dir(builtins))
+
+
+# --- cutting a trial down to what its output depends on --- #
+
+@dataclass
+class _ChunkNames:
+    defines: set[str]   # module level names bound by the chunk
+    modifies: set[str]  # names whose object the chunk changes in place (e.g. df['x'] = ..., rows.append(...))
+    reads: set[str]     # names the chunk uses from before it
+    writes_output: bool # when it runs, as opposed to only defining a function that does
+
+
+def _bound_names(statement: ast.stmt) -> tuple[set[str], set[str]]:
+    """(names bound, names changed in place) at module level by a statement"""
+    defines, modifies = set(), set()
+
+    def bind(target: ast.AST):
+        if isinstance(target, ast.Name):
+            defines.add(target.id)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for element in target.elts:
+                bind(element)
+        elif isinstance(target, ast.Starred):
+            bind(target.value)
+        elif isinstance(target, (ast.Subscript, ast.Attribute)):
+            base = target.value
+            while isinstance(base, (ast.Subscript, ast.Attribute)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                modifies.add(base.id)
+
+    def visit(statement: ast.stmt):
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            # whatever is bound inside is its own
+            defines.add(statement.name)
+            return
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            for alias in statement.names:
+                defines.add(alias.asname or alias.name.split('.')[0])
+        elif isinstance(statement, ast.Assign):
+            for target in statement.targets:
+                bind(target)
+        elif isinstance(statement, (ast.AugAssign, ast.AnnAssign, ast.For, ast.AsyncFor)):
+            bind(statement.target)
+        elif isinstance(statement, (ast.With, ast.AsyncWith)):
+            for item in statement.items:
+                if item.optional_vars is not None:
+                    bind(item.optional_vars)
+        elif isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call):
+            call = statement.value
+            if isinstance(call.func, ast.Attribute) and isinstance(call.func.value, ast.Name) \
+                    and (call.func.attr in mutating_methods or any(k.arg == 'inplace' for k in call.keywords)):
+                modifies.add(call.func.value.id)
+        # module level control flow still binds module level names
+        for field in ('body', 'orelse', 'finalbody'):
+            for child in getattr(statement, field, []):
+                visit(child)
+        for handler in getattr(statement, 'handlers', []):
+            if handler.name:
+                defines.add(handler.name)
+            for child in handler.body:
+                visit(child)
+
+    visit(statement)
+    return defines, modifies
+
+
+def _output_calls(node: ast.AST, output_functions: set[str]) -> bool:
+    """whether the code writes output, directly or by calling one of `output_functions`"""
+    for child in ast.walk(node):
+        if not isinstance(child, ast.Call):
+            continue
+        if isinstance(child.func, ast.Attribute) and child.func.attr in output_methods:
+            return True
+        if isinstance(child.func, ast.Name) and child.func.id in output_functions:
+            return True
+        if isinstance(child.func, ast.Name) and child.func.id == 'open':
+            mode = child.args[1] if len(child.args) > 1 else next((k.value for k in child.keywords if k.arg == 'mode'), None)
+            if isinstance(mode, ast.Constant) and isinstance(mode.value, str) and set(mode.value) & set('wax'):
+                return True
+    return False
+
+
+def _chunk_names(tree: ast.Module, output_functions: set[str]) -> _ChunkNames:
+    """`output_functions` (functions that write output when called) is updated with any the chunk defines"""
+    defines, modifies, reads = set(), set(), set()
+    writes_output = False
+    for statement in tree.body:
+        # a name is only read from an earlier chunk if this one hasn't bound it yet (e.g. `df = df[...]` reads df)
+        loads = {node.id for node in ast.walk(statement) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+        reads |= loads - defines - _builtin_names
+        statement_defines, statement_modifies = _bound_names(statement)
+        reads |= statement_modifies - defines
+        defines |= statement_defines
+        modifies |= statement_modifies
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if _output_calls(statement, output_functions):
+                output_functions.add(statement.name)
+        elif not isinstance(statement, ast.ClassDef) and _output_calls(statement, output_functions):
+            writes_output = True
+    return _ChunkNames(defines, modifies, reads, writes_output)
+
+
+def essential_chunks(record: TrialRecord) -> list[str]:
+    """
+    The code chunks the trial's output depends on, in order: the last chunk that writes the output, and (going back
+    from it) every earlier chunk that defines or changes something a kept chunk uses. Error chunks, chunks that don't
+    parse, and anything after the output was written are dropped. If nothing writes output, all the code is kept
+    """
+    chunks = [chunk for chunk, kind in zip(record.code_chunks, record.kinds) if kind == 'code' and parse_chunks([chunk])]
+    output_functions: set[str] = set()
+    names = [_chunk_names(parse_chunks([chunk])[0], output_functions) for chunk in chunks]
+    last = max((i for i, n in enumerate(names) if n.writes_output), default=None)
+    if last is None:
+        return chunks
+
+    keep = {last}
+    needed = set(names[last].reads)
+    for i in range(last - 1, -1, -1):
+        if names[i].defines & needed or names[i].modifies & needed:
+            keep.add(i)
+            needed = (needed - names[i].defines) | names[i].reads
+    return [chunk for i, chunk in enumerate(chunks) if i in keep]
+
+
+def medoid(trials: dict[str, list[str]]) -> str:
+    """the trial most similar to all the others"""
+    similarity = CodeSimilarity(trials)
+    return similarity.names[int(np.argmax(similarity.matrix.sum(axis=1)))]
+
+
+# --- parameterizing literals --- #
+
+@dataclass
+class Parameter:
+    name: str
+    value: Any          # the literal in the trial's code, used as the default
+    query_text: str|None  # where it came from in the query, if it did
+
+
+def _normalize(text: str) -> str:
+    """for matching literals against the query, e.g. '*lymphoblastic leukemia*' and 'aml_target_gdc' -> words"""
+    return ' '.join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def _in_query(value: Any, query: str) -> str|None:
+    """the part of the query a literal came from, if any"""
+    if not isinstance(value, str):
+        return None
+    words = _normalize(value)
+    if len(words) < 3 or words in stopwords:
+        return None
+    pattern = r'(?<![a-z0-9])' + r'[\s_\-]+'.join(map(re.escape, words.split())) + r'(?![a-z0-9])'
+    match = re.search(pattern, query, re.IGNORECASE)
+    return match.group(0) if match else None
+
+
+def _string_value(node: ast.AST) -> str|None:
+    """the value of a string literal (including f-strings without any placeholders)"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.JoinedStr) and all(isinstance(v, ast.Constant) for v in node.values):
+        return ''.join(v.value for v in node.values)
+    return None
+
+
+def _identifier(text: str, fallback: str = 'value') -> str:
+    name = re.sub(r'[^a-z0-9]+', '_', text.lower()).strip('_') or fallback
+    if name[0].isdigit() or keyword.iskeyword(name) or name in _builtin_names:
+        name = f'{fallback}_{name}'
+    return name
+
+
+def _name_from_context(node: ast.AST, parents: dict[ast.AST, ast.AST]) -> str:
+    parent = parents.get(node)
+    if isinstance(parent, ast.Assign) and len(parent.targets) == 1 and isinstance(parent.targets[0], ast.Name):
+        return _identifier(parent.targets[0].id)
+    if isinstance(parent, ast.keyword) and parent.arg:
+        return _identifier(parent.arg)
+    if isinstance(parent, ast.Dict):
+        keys = {key.value: value for key, value in zip(parent.keys, parent.values) if isinstance(key, ast.Constant) and isinstance(key.value, str)}
+        field = keys.get('field')
+        # GDC style filters, e.g. {'field': 'ssm.consequence.transcript.gene.symbol', 'value': [...]} -> gene_symbol
+        if isinstance(field, ast.Constant) and isinstance(field.value, str) and keys.get('value') is node:
+            parts = field.value.split('.')
+            generic = parts[-1] in ('symbol', 'id', 'name', 'type', 'code') and len(parts) > 1
+            return _identifier('_'.join(parts[-2:]) if generic else parts[-1])
+        key = next((k for k, v in keys.items() if v is node), None)
+        if key is not None:
+            return _identifier(key)
+    return 'value'
+
+
+def find_parameters(source: str, query: str, output_name: str|None = None) -> tuple[list[Parameter], list[tuple[ast.AST, str]]]:
+    """
+    String literals in the code that come from the query (whole lists of them where one is in the query), and the
+    output file name. Returns the parameters, and the text to replace each literal's node with
+    """
+    tree = ast.parse(source)
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    dict_keys = {id(key) for node in ast.walk(tree) if isinstance(node, ast.Dict) for key in node.keys if key is not None}
+    inside_fstrings = {id(child) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for child in ast.walk(node) if child is not node}
+
+    by_value: dict[Any, Parameter] = {}
+    names: set[str] = set()
+    replacements: list[tuple[ast.AST, str]] = []
+    claimed: set[int] = set()
+
+    def parameter(value: Any, node: ast.AST, query_text: str|None, name: str|None = None) -> Parameter:
+        key = tuple(value) if isinstance(value, list) else value
+        if key not in by_value:
+            name = name or _name_from_context(node, parents)
+            if isinstance(value, list) and not name.endswith('s'):
+                name = f'{name}s'
+            unique, n = name, 2
+            while unique in names:
+                unique, n = f'{name}_{n}', n + 1
+            names.add(unique)
+            by_value[key] = Parameter(unique, value, query_text)
+        return by_value[key]
+
+    def replace(node: ast.AST, parameter: Parameter):
+        # assigning the literal to the parameter's own name (e.g. `gene = 'JAK1'`) is dropped, since the parameter
+        # already is that variable (and `gene = gene` would fail inside a function)
+        parent = parents.get(node)
+        if isinstance(parent, ast.Assign) and len(parent.targets) == 1 and isinstance(parent.targets[0], ast.Name) and parent.targets[0].id == parameter.name:
+            replacements.append((parent, '' if parent in tree.body else 'pass'))
+        else:
+            replacements.append((node, parameter.name))
+
+    for node in ast.walk(tree):
+        if id(node) in claimed or id(node) in dict_keys or id(node) in inside_fstrings:
+            continue
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)) and not isinstance(getattr(node, 'ctx', None), ast.Store) \
+                and node.elts and all(isinstance(e, ast.Constant) and isinstance(e.value, str) for e in node.elts):
+            matched = [text for e in node.elts if (text := _in_query(e.value, query))]
+            if matched:
+                claimed.update(id(e) for e in node.elts)
+                replace(node, parameter([e.value for e in node.elts], node, ', '.join(matched)))
+        elif (value := _string_value(node)) is not None:
+            if output_name is not None and value == output_name:
+                replace(node, parameter(value, node, None, name='output_path'))
+            elif (text := _in_query(value, query)):
+                replace(node, parameter(value, node, text))
+    # the output file goes last, after what the query asked for
+    parameters = sorted(by_value.values(), key=lambda p: p.name == 'output_path')
+    return parameters, replacements
+
+
+def _replace_nodes(source: str, replacements: list[tuple[ast.AST, str]]) -> str:
+    lines = source.splitlines(keepends=True)
+    line_starts = np.cumsum([0] + [len(line) for line in lines])
+    def offset(line: int, col: int) -> int:
+        # ast columns are utf-8 byte offsets
+        return int(line_starts[line - 1]) + len(lines[line - 1].encode()[:col].decode(errors='ignore'))
+    spans = sorted(((offset(n.lineno, n.col_offset), offset(n.end_lineno, n.end_col_offset), text) for n, text in replacements), key=lambda span: span[0], reverse=True)
+    for start, end, text in spans:
+        source = source[:start] + text + source[end:]
+    return source
+
+
+def _as_function_body(source: str) -> str:
+    """
+    Module level code that works the same inside a function: `if __name__ == '__main__':` blocks (which would never
+    run there) are inlined, and module docstrings are dropped
+    """
+    tree = ast.parse(source)
+    lines = source.splitlines()
+    for node in reversed(tree.body):
+        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+            lines[node.lineno - 1:node.end_lineno] = []
+            continue
+        test = node.test if isinstance(node, ast.If) else None
+        if isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == '__name__' and not node.orelse:
+            body = lines[node.body[0].lineno - 1:node.body[-1].end_lineno]
+            indent = min(len(line) - len(line.lstrip()) for line in body if line.strip())
+            lines[node.lineno - 1:node.end_lineno] = [line[indent:] for line in body]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip('\n')
+
+
+# --- writing the template --- #
+
+def base_query(record: TrialRecord) -> str|None:
+    """the query the trial was given, without the instructions for saving its csv"""
+    if record.query is None:
+        return None
+    return record.query.removesuffix(query_suffix.format(name=f'{record.name}.csv'))
+
+
+def template_name(description: str) -> str:
+    words = [w for w in re.findall(r'[a-z0-9]+', re.sub(r'\{\w+\}', ' ', description.lower())) if w not in stopwords]
+    return _identifier('_'.join(words[:6]), fallback='solution')
+
+
+@dataclass
+class Promotion:
+    template: SolutionTemplate
+    trial: str
+    path: Path
+    code: str
+
+
+def promote_trials(
+    workdir: Path,
+    successful_trials: list[str],
+    api: str|None = None,
+    query: str|None = None,
+    name: str|None = None,
+    registry: SolutionRegistry|None = None,
+    duplicate_threshold: float = 0.9,
+) -> Promotion|None:
+    """
+    Turn the successful trials of a run into a prebaked solution, and register it.
+    None if there were no successful trials, or an existing template already has (almost) the same code
+
+    Args:
+        workdir (Path): the run's workdir
+        successful_trials (list[str]): names of the trials that solved the task (e.g. from `Analyzer.identify_solutions`)
+        api (str, optional): name of the API. Taken from the trials' metadata if None
+        query (str, optional): the task. Taken from the trials if None
+        name (str, optional): name of the template and function. Made from the query if None
+        registry (SolutionRegistry, optional): the registry to add it to. The default one if None
+        duplicate_threshold (float): AST similarity above which an existing template (of another name) counts as the same solution
+    """
+    if not successful_trials:
+        print('no successful trials to promote')
+        return None
+    store = open_trial_store(workdir)
+    records = {name: store.get(name) for name in successful_trials}
+    code = {trial: essential_chunks(record) for trial, record in records.items()}
+    trial = medoid(code)
+    record = records[trial]
+    api = api or record.metadata.get('api')
+    query = query or base_query(record)
+    if api is None or query is None:
+        raise ValueError(f'{trial} does not record its api/query, so it must be given')
+
+    source = _as_function_body('\n\n'.join(chunk.strip('\n') for chunk in code[trial]))
+    parameters, replacements = find_parameters(source, query, output_name=f'{trial}.csv')
+    # dropped assignments leave blank lines behind
+    source = re.sub(r'\n{3,}', '\n\n', _replace_nodes(source, replacements))
+
+    description = query
+    for parameter in parameters:
+        if parameter.query_text is not None:
+            for text in parameter.query_text.split(', '):
+                description = description.replace(text, f'{{{parameter.name}}}')
+    description = description.strip()
+    name = name or template_name(description)
+
+    if registry is None:
+        registry = SolutionRegistry(default_registry_path)
+    for match in registry.similar_code(code[trial], duplicate_threshold):
+        if match.template.name != name:
+            print(f'{trial} is the same solution as {match.template.name} (similarity {match.score}), not promoting it')
+            return None
+
+    module_code = _module_code(name, description, parameters, source, workdir, trial, len(successful_trials))
+    compile(module_code, f'{name}.py', 'exec')
+    promoted_dir.mkdir(parents=True, exist_ok=True)
+    (promoted_dir/'__init__.py').touch()
+    path = promoted_dir/f'{name}.py'
+    path.write_text(module_code)
+
+    template = SolutionTemplate(
+        name=name,
+        api=api,
+        description=description,
+        module=f'{promoted_package}.{name}',
+        function=name,
+        parameters={p.name: _parameter_description(p) for p in parameters},
+        examples=[query],
+        usage=f'{name}(' + ', '.join(f'{p.name}={_default(p)}' for p in parameters) + ')',
+    )
+    registry.add(template)
+    registry.save()
+    print(f'promoted {trial} (most central of {len(successful_trials)} successful trials) to {path}')
+    return Promotion(template, trial, path, module_code)
+
+
+def _parameter_description(parameter: Parameter) -> str:
+    return 'csv file to save the result to' if parameter.name == 'output_path' else f'e.g. {parameter.value!r}'
+
+
+def _default(parameter: Parameter) -> str:
+    if parameter.name == 'output_path':
+        return repr('result.csv')
+    # tuples, so the defaults can't be changed by a call
+    return repr(tuple(parameter.value)) if isinstance(parameter.value, list) else repr(parameter.value)
+
+
+def _module_code(name: str, description: str, parameters: list[Parameter], source: str, workdir: Path, trial: str, successful: int) -> str:
+    signature = ', '.join(f'{p.name}={_default(p)}' for p in parameters)
+    args = '\n'.join(f'        {p.name}: {_parameter_description(p)}' for p in parameters)
+    # list parameters are used as lists, like the literals they replaced
+    conversions = ''.join(f'    {p.name} = list({p.name})\n' for p in parameters if isinstance(p.value, list))
+    if conversions:
+        conversions += '\n'
+    body = '\n'.join(f'    {line}' if line.strip() else '' for line in source.splitlines())
+    return (
+        f'"""\n{description}\n\n'
+        f'Promoted by experiments.promote from {trial} of {workdir.resolve().name}, the most central of {successful} successful trials\n"""\n\n\n'
+        f'def {name}({signature}):\n'
+        f'    """\n    {description}\n' + (f'\n    Args:\n{args}\n' if parameters else '') + '    """\n'
+        f'{conversions}{body}\n'
+    )
+
+
+def main():
+    import argparse
+    from .run_trials import CASES, case_evaluator
+    from .online_scoring import score_and_save
+    parser = argparse.ArgumentParser(description='turn the successful trials of a run into a prebaked solution')
+    parser.add_argument('workdir', type=Path)
+    parser.add_argument('--case', choices=CASES, required=True, help='the case the trials ran, to score them with its evaluator')
+    parser.add_argument('--name', default=None, help='name of the template/function (default: made from the query)')
+    parser.add_argument('--api', default=None, help="the API's name, for trials that don't record it")
+    parser.add_argument('--query', default=None, help="the task, for trials that don't record it")
+    parser.add_argument('--registry', type=Path, default=default_registry_path)
+    args = parser.parse_args()
+
+    # scores saved during the run (or by the analysis) are reused
+    evaluate = case_evaluator(args.case, args.workdir)
+    store = open_trial_store(args.workdir)
+    successful = [name for name in store.names() if (score := score_and_save(evaluate, args.workdir, name)) is not None and score.success]
+    print(f'{len(successful)}/{len(store)} trials successful')
+    promotion = promote_trials(args.workdir, successful, args.api, args.query, args.name, SolutionRegistry(args.registry))
+    if promotion is not None:
+        print(promotion.code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+"""
+Shared rate limiting for every LLM provider and external API the experiments talk to
+
+Each provider (openai, anthropic, google) and API host (api.gdc.cancer.gov, www.cbioportal.org) gets a token bucket
+of requests per minute, plus one of LLM tokens per minute where that matters. Bucket state is kept in an SQLite
+database, so every process on the machine (trial workers, the record server, the analyzers) draws from the same budget.
+
+Limits adapt to what the provider actually tolerates: a 429 or 5xx response halves the allowed rate for that key (and
+pauses it for any Retry-After), and every successful request adds back a small fraction of the configured maximum.
+
+Current utilization can be watched while a run is going, to tune the concurrency to the max sustainable throughput:
+    python -m experiments.rate_limit
+    python -m experiments.rate_limit set anthropic --rpm 100 --tpm 160000
+"""
+
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+from typing import Any, AsyncGenerator, Generator, TYPE_CHECKING
+import threading
+import asyncio
+import sqlite3
+import time
+import os
+
+if TYPE_CHECKING:
+    from archytas.react import ReActAgent
+    from adhoc_api.tool import AdhocApi
+
+
+here = Path(__file__).parent
+default_limits_path = here / '../../rate_limits.db'
+
+# environment variable pointing trial processes at the shared limits ('off' to disable rate limiting)
+LIMITS_ENV_VAR = 'CURATOR_RATE_LIMITS'
+
+
+@dataclass
+class Limit:
+    requests_per_minute: float
+    tokens_per_minute: float|None = None # no token limit if None
+
+# starting points, meant to be tuned (see `python -m experiments.rate_limit set`) for the account being used
+default_limits = {
+    'openai': Limit(500, 800_000),
+    'anthropic': Limit(50, 80_000),
+    'google': Limit(60, 4_000_000),
+    'api.gdc.cancer.gov': Limit(600),
+    'www.cbioportal.org': Limit(300),
+}
+
+
+def model_provider(model: str) -> str:
+    """which provider serves a model, going by its name"""
+    if model.startswith(('gpt-', 'o1', 'o3', 'o4')):
+        return 'openai'
+    if model.startswith('claude'):
+        return 'anthropic'
+    if model.startswith('gemini'):
+        return 'google'
+    raise ValueError(f'unknown provider for model {model!r}')
+
+
+def estimate_tokens(text: str) -> int:
+    # close enough for budgeting. Actual usage is reported back after the call where the API provides it
+    return len(text) // 4
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS limits (
+    key TEXT PRIMARY KEY,
+    max_rpm REAL NOT NULL,
+    max_tpm REAL,
+    rpm REAL NOT NULL,
+    requests REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0,
+    backed_off_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS usage (
+    key TEXT NOT NULL,
+    minute INTEGER NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    throttled INTEGER NOT NULL DEFAULT 0,
+    waited REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (key, minute)
+);
+'''
+
+
+@dataclass
+class Permit:
+    """
+    A granted request. Set `status` (and `retry_after`, `tokens_used` if known) so the limiter can adapt.
+    Exceptions raised while the permit is held are inspected for a status code instead
+    """
+    key: str
+    tokens: int
+    waited: float
+    status: int|None = None
+    retry_after: float|None = None
+    tokens_used: int|None = None
+
+
+@dataclass
+class Utilization:
+    key: str
+    max_rpm: float
+    rpm: float                  # currently allowed rate, after any backoff
+    requests_last_minute: int
+    tokens_last_minute: int
+    max_tpm: float|None
+    throttled_last_hour: int
+    waited_last_hour: float     # total seconds callers spent waiting for this key
+
+    @property
+    def request_utilization(self) -> float:
+        return self.requests_last_minute / self.max_rpm
+
+    @property
+    def token_utilization(self) -> float|None:
+        return self.tokens_last_minute / self.max_tpm if self.max_tpm else None
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits with additive-increase/multiplicative-decrease adaptation, shared through an SQLite database.
+    Safe to use from multiple threads and processes. Keys without a configured limit are not limited.
+
+    Args:
+        path (Path): the database file. Created (with `limits` as the configuration) if it doesn't exist
+        limits (dict[str, Limit]): limits for any keys the database doesn't have yet
+        burst_seconds (float): how many seconds worth of requests/tokens can be used at once after being idle
+        backoff (float): factor the rate is multiplied by when throttled
+        increase (float): fraction of the max rate added back after each successful request
+        min_fraction (float): the rate never backs off below this fraction of the max
+        default_pause (float): seconds to stop sending after being throttled, if the response didn't say (Retry-After)
+    """
+    def __init__(
+        self,
+        path: Path = default_limits_path,
+        limits: dict[str, Limit] = default_limits,
+        burst_seconds: float = 10,
+        backoff: float = 0.5,
+        increase: float = 0.01,
+        min_fraction: float = 0.05,
+        default_pause: float = 2.0,
+    ):
+        self.path = Path(path).resolve()
+        self.limits = limits
+        self.burst_seconds = burst_seconds
+        self.backoff = backoff
+        self.increase = increase
+        self.min_fraction = min_fraction
+        self.default_pause = default_pause
+        self._local = threading.local()
+        self._connection().executescript(_schema)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Generator[sqlite3.Connection, None, None]:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def set_limit(self, key: str, limit: Limit):
+        """(re)configure the limit for a key, resetting any backoff"""
+        with self._transaction() as conn:
+            conn.execute(
+                '''INSERT INTO limits (key, max_rpm, max_tpm, rpm, requests, tokens, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET max_rpm=excluded.max_rpm, max_tpm=excluded.max_tpm, rpm=excluded.rpm, tokens=0, paused_until=0''',
+                (key, limit.requests_per_minute, limit.tokens_per_minute, limit.requests_per_minute, 0, 0, time.time())
+            )
+
+    def _state(self, conn: sqlite3.Connection, key: str, now: float) -> dict|None:
+        """the bucket for a key, refilled up to `now`"""
+        row = conn.execute('SELECT max_rpm, max_tpm, rpm, requests, tokens, updated_at, paused_until, backed_off_at FROM limits WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            if key not in self.limits:
+                return None
+            limit = self.limits[key]
+            # starts out with a full bucket
+            full_requests = max(1.0, limit.requests_per_minute * self.burst_seconds / 60)
+            full_tokens = (limit.tokens_per_minute or 0) * self.burst_seconds / 60
+            row = (limit.requests_per_minute, limit.tokens_per_minute, limit.requests_per_minute, full_requests, full_tokens, now, 0, 0)
+            conn.execute(
+                'INSERT INTO limits (key, max_rpm, max_tpm, rpm, requests, tokens, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, *row[:6])
+            )
+        state = dict(zip(('max_rpm', 'max_tpm', 'rpm', 'requests', 'tokens', 'updated_at', 'paused_until', 'backed_off_at'), row))
+        # the token rate backs off along with the request rate
+        state['tpm'] = state['max_tpm'] * state['rpm'] / state['max_rpm'] if state['max_tpm'] else None
+        elapsed = max(0.0, now - state['updated_at'])
+        state['requests'] = min(max(1.0, state['rpm'] * self.burst_seconds / 60), state['requests'] + elapsed * state['rpm'] / 60)
+        if state['tpm']:
+            state['tokens'] = min(state['tpm'] * self.burst_seconds / 60, state['tokens'] + elapsed * state['tpm'] / 60)
+        state['updated_at'] = now
+        return state
+
+    def _save(self, conn: sqlite3.Connection, key: str, state: dict):
+        conn.execute(
+            'UPDATE limits SET rpm = ?, requests = ?, tokens = ?, updated_at = ?, paused_until = ?, backed_off_at = ? WHERE key = ?',
+            (state['rpm'], state['requests'], state['tokens'], state['updated_at'], state['paused_until'], state['backed_off_at'], key)
+        )
+
+    def _record_usage(self, conn: sqlite3.Connection, key: str, now: float, requests: int = 0, tokens: int = 0, throttled: int = 0, waited: float = 0.0):
+        minute = int(now // 60)
+        conn.execute(
+            '''INSERT INTO usage (key, minute, requests, tokens, throttled, waited) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(key, minute) DO UPDATE SET requests=requests+excluded.requests, tokens=tokens+excluded.tokens,
+                   throttled=throttled+excluded.throttled, waited=waited+excluded.waited''',
+            (key, minute, requests, tokens, throttled, waited)
+        )
+
+    def try_acquire(self, key: str, tokens: int = 0, waited: float = 0.0) -> float:
+        """take a request (and `tokens` tokens) from the bucket if available. Returns 0 if so, otherwise the seconds to wait"""
+        now = time.time()
+        with self._transaction() as conn:
+            state = self._state(conn, key, now)
+            if state is None:
+                return 0.0
+            wait = state['paused_until'] - now
+            if state['requests'] < 1:
+                wait = max(wait, (1 - state['requests']) * 60 / state['rpm'])
+            if state['tpm'] and tokens > 0:
+                # calls bigger than the whole bucket go through once it's full, and leave it in debt
+                needed = min(tokens, state['tpm'] * self.burst_seconds / 60)
+                if state['tokens'] < needed:
+                    wait = max(wait, (needed - state['tokens']) * 60 / state['tpm'])
+            if wait <= 0:
+                state['requests'] -= 1
+                state['tokens'] -= tokens
+                self._record_usage(conn, key, now, requests=1, tokens=tokens, waited=waited)
+            self._save(conn, key, state)
+        return max(wait, 0.0)
+
+    def acquire(self, key: str, tokens: int = 0) -> float:
+        """block until a request (using about `tokens` tokens) can be sent. Returns the seconds spent waiting"""
+        start = time.time()
+        # re-checked periodically, since the rate can change while waiting (e.g. another process got throttled)
+        while (wait := self.try_acquire(key, tokens, time.time() - start)) > 0:
+            time.sleep(min(wait, 5))
+        return time.time() - start
+
+    async def acquire_async(self, key: str, tokens: int = 0) -> float:
+        start = time.time()
+        while (wait := self.try_acquire(key, tokens, time.time() - start)) > 0:
+            await asyncio.sleep(min(wait, 5))
+        return time.time() - start
+
+    def feedback(self, key: str, status: int|None, retry_after: float|None = None, extra_tokens: int = 0):
+        """
+        Adapt the limit for a key to how a request went.
+        `extra_tokens` corrects the estimate the request was acquired with (positive if it used more than estimated)
+        """
+        now = time.time()
+        throttled = status is not None and (status == 429 or status >= 500)
+        with self._transaction() as conn:
+            state = self._state(conn, key, now)
+            if state is None:
+                return
+            state['tokens'] -= extra_tokens
+            if throttled:
+                # requests in flight when the limit was hit tend to get throttled together, so that only counts once
+                if now - state['backed_off_at'] > self.default_pause:
+                    state['rpm'] = max(state['max_rpm'] * self.min_fraction, state['rpm'] * self.backoff)
+                    state['backed_off_at'] = now
+                state['requests'] = min(state['requests'], 0.0)
+                state['paused_until'] = max(state['paused_until'], now + (retry_after if retry_after is not None else self.default_pause))
+            elif status is not None and status < 400:
+                state['rpm'] = min(state['max_rpm'], state['rpm'] + state['max_rpm'] * self.increase)
+            self._save(conn, key, state)
+            self._record_usage(conn, key, now, tokens=extra_tokens, throttled=int(throttled))
+
+    @contextmanager
+    def limit(self, key: str, tokens: int = 0) -> Generator[Permit, None, None]:
+        """hold a permit for a single request, e.g. `with limiter.limit('openai', tokens=estimate) as permit: ...`"""
+        permit = Permit(key, tokens, self.acquire(key, tokens))
+        try:
+            yield permit
+        except BaseException as e:
+            self._feedback_from_error(permit, e)
+            raise
+        self._feedback_from_permit(permit)
+
+    @asynccontextmanager
+    async def limit_async(self, key: str, tokens: int = 0) -> AsyncGenerator[Permit, None]:
+        permit = Permit(key, tokens, await self.acquire_async(key, tokens))
+        try:
+            yield permit
+        except BaseException as e:
+            self._feedback_from_error(permit, e)
+            raise
+        self._feedback_from_permit(permit)
+
+    def _feedback_from_permit(self, permit: Permit):
+        extra_tokens = permit.tokens_used - permit.tokens if permit.tokens_used is not None else 0
+        self.feedback(permit.key, permit.status if permit.status is not None else 200, permit.retry_after, extra_tokens)
+
+    def _feedback_from_error(self, permit: Permit, e: BaseException):
+        # the openai/anthropic/google clients and requests all put the status somewhere on their errors
+        response = getattr(e, 'response', None)
+        status = getattr(e, 'status_code', None) or getattr(e, 'code', None) or getattr(response, 'status_code', None)
+        if not isinstance(status, int):
+            return
+        self.feedback(permit.key, status, retry_after_seconds(getattr(response, 'headers', None)))
+
+    def utilization(self) -> list[Utilization]:
+        now = time.time()
+        minute = int(now // 60)
+        conn = self._connection()
+        results = []
+        for key, max_rpm, max_tpm, rpm in conn.execute('SELECT key, max_rpm, max_tpm, rpm FROM limits ORDER BY key').fetchall():
+            # sliding window over the last 60 seconds, assuming usage was even across the previous minute
+            requests = tokens = 0.0
+            previous_weight = 1 - (now % 60) / 60
+            for row_minute, row_requests, row_tokens in conn.execute('SELECT minute, requests, tokens FROM usage WHERE key = ? AND minute >= ?', (key, minute - 1)):
+                weight = 1 if row_minute == minute else previous_weight
+                requests += weight * row_requests
+                tokens += weight * row_tokens
+            throttled, waited = conn.execute(
+                'SELECT COALESCE(SUM(throttled), 0), COALESCE(SUM(waited), 0) FROM usage WHERE key = ? AND minute > ?', (key, minute - 60)
+            ).fetchone()
+            results.append(Utilization(key, max_rpm, rpm, round(requests), round(tokens), max_tpm, throttled, waited))
+        # nothing older than an hour is ever looked at
+        conn.execute('DELETE FROM usage WHERE minute <= ?', (minute - 60,))
+        return results
+
+    def report(self) -> str:
+        """table of the current utilization of every limited key"""
+        lines = [f'{"key":<22}{"req/min":>10}{"limit":>9}{"allowed":>9}{"util":>7}{"tok/min":>11}{"util":>7}{"429/5xx (1h)":>14}{"waited (1h)":>13}']
+        for u in self.utilization():
+            token_utilization = f'{u.token_utilization:.0%}' if u.token_utilization is not None else '-'
+            lines.append(
+                f'{u.key:<22}{u.requests_last_minute:>10}{u.max_rpm:>9.0f}{u.rpm:>9.0f}{u.request_utilization:>7.0%}'
+                f'{u.tokens_last_minute:>11}{token_utilization:>7}{u.throttled_last_hour:>14}{u.waited_last_hour:>12.0f}s'
+            )
+        return '\n'.join(lines)
+
+
+def retry_after_seconds(headers: Any) -> float|None:
+    if headers is None:
+        return None
+    value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        # http dates aren't worth parsing here. The default pause applies instead
+        return None
+
+
+@cache
+def _limiter(path: str) -> RateLimiter:
+    return RateLimiter(Path(path))
+
+def rate_limiter_from_env() -> RateLimiter|None:
+    """the limiter shared by this process (the same one used by child processes), or None if rate limiting is off"""
+    path = os.environ.get(LIMITS_ENV_VAR, str(default_limits_path))
+    return None if path == 'off' else _limiter(str(Path(path).resolve()))
+
+
+def set_rate_limits(path: Path|str):
+    """use the given limits database (or 'off') in this process and any child processes"""
+    os.environ[LIMITS_ENV_VAR] = str(Path(path).resolve()) if str(path) != 'off' else 'off'
+
+
+# --- instrumentation for the clients the experiments use --- #
+
+def limit_uaii_agent(agent: Any, limiter: RateLimiter, provider: str):
+    """rate limit the `message` calls of an adhoc_api UAII agent (e.g. a drafter, or the analyzer's OpenAIAgent)"""
+    if getattr(agent, '_rate_limited', False):
+        return
+    original_message = agent.message
+
+    def message(message: str, stream: bool = False, **kwargs):
+        with limiter.limit(provider, tokens=estimate_tokens(message)):
+            return original_message(message, stream=stream, **kwargs)
+
+    agent.message = message
+    agent._rate_limited = True
+
+
+def limit_drafters(adhoc_api: 'AdhocApi', limiter: RateLimiter):
+    """rate limit the drafter agents of an AdhocApi instance, by each drafter's provider"""
+    original_get_agent = adhoc_api._get_agent
+
+    def get_agent(api: str):
+        agent = original_get_agent(api)
+        _, drafter_config = adhoc_api._get_api(api)
+        limit_uaii_agent(agent, limiter, drafter_config['provider'])
+        return agent
+
+    adhoc_api._get_agent = get_agent
+
+
+def limit_agent(agent: 'ReActAgent', limiter: RateLimiter, model: str):
+    """rate limit every call the ReAct agent makes to its model"""
+    provider = model_provider(model)
+    original_ainvoke = agent.model.ainvoke
+
+    async def ainvoke(input, **kwargs):
+        estimate = sum(estimate_tokens(str(message.content)) for message in input)
+        async with limiter.limit_async(provider, tokens=estimate) as permit:
+            result = await original_ainvoke(input, **kwargs)
+            usage = getattr(result, 'usage_metadata', None)
+            if usage:
+                permit.tokens_used = usage.get('total_tokens')
+            return result
+
+    agent.model.ainvoke = ainvoke
+
+
+def limit_requests(limiter: RateLimiter, hosts: tuple[str, ...], max_retries: int = 3):
+    """
+    Rate limit every `requests` call to the given hosts (for this process), by host. Throttled (429) requests are
+    retried after backing off, so the caller only sees the 429 if it keeps happening
+    """
+    import requests
+    from urllib.parse import urlsplit
+
+    global _requests_limited
+    if _requests_limited:
+        return
+    _requests_limited = True
+    original_send = requests.Session.send
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).hostname
+        if host not in hosts:
+            return original_send(self, request, **kwargs)
+        for attempt in range(max_retries + 1):
+            with limiter.limit(host) as permit:
+                response = original_send(self, request, **kwargs)
+                permit.status = response.status_code
+                permit.retry_after = retry_after_seconds(response.headers)
+            if response.status_code != 429 or attempt == max_retries:
+                return response
+            response.close()
+
+    requests.Session.send = send
+
+# patched at most once per process, whatever else wraps `requests` since (e.g. tracing)
+_requests_limited = False
+
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='show (or configure) the shared rate limits')
+    parser.add_argument('--limits', type=Path, default=default_limits_path, help='the shared limits database')
+    subparsers = parser.add_subparsers(dest='command')
+    set_parser = subparsers.add_parser('set', help='configure the limit for a provider or host')
+    set_parser.add_argument('key', help='provider (openai, anthropic, google) or API host')
+    set_parser.add_argument('--rpm', type=float, required=True, help='max requests per minute')
+    set_parser.add_argument('--tpm', type=float, default=None, help='max tokens per minute')
+    watch_parser = subparsers.add_parser('watch', help='print the utilization every few seconds')
+    watch_parser.add_argument('--interval', type=float, default=10)
+    args = parser.parse_args()
+
+    limiter = RateLimiter(args.limits)
+    if args.command == 'set':
+        limiter.set_limit(args.key, Limit(args.rpm, args.tpm))
+    if args.command == 'watch':
+        while True:
+            print(limiter.report() + '\n')
+            time.sleep(args.interval)
+    print(limiter.report())
+
+
+if __name__ == '__main__':
+    main()
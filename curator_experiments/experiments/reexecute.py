@@ -0,0 +1,289 @@
+"""
+Re-running the code a trial captured, without the LLM, to regenerate its csv
+
+Every code chunk a trial ran is in its workdir's trial store. Re-executing a trial replays those chunks in order in a
+fresh python environment (the same one the agent's python tool provides, `exit` shim included) inside a sandbox: a
+subprocess with its own working directory, resource limits, a per-chunk timeout and a wall-clock limit on the whole
+trial. GDC/cBioPortal requests go to the local record/replay server (see http_replay), and in replay mode any other
+network access is refused, so re-execution is fully offline. Trials are re-executed in parallel, one sandbox per core.
+
+The results go to a new workdir (trial store plus regenerated csvs), which can be scored like any other:
+    python -m experiments.reexecute ../workdir_20250225_132405 --out ../workdir_20250225_132405_rerun --workers 8
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from urllib.parse import urlsplit
+import subprocess
+import threading
+import signal
+import json
+import time
+import sys
+import os
+
+from .trial_store import TrialStore, TrialRecord, open_trial_store, store_filename
+from .http_replay import serve_http, default_store_dir, SERVER_ENV_VAR
+
+
+here = Path(__file__).parent
+job_filename = 'job.json'
+result_filename = 'result.json'
+
+# environment variables that aren't passed into the sandbox, since replayed code has no business calling the LLMs
+_secret_suffixes = ('_API_KEY', '_TOKEN', '_SECRET')
+
+
+@dataclass
+class SandboxLimits:
+    """
+    Limits on a re-executed trial
+
+    Args:
+        timeout_seconds (float): wall-clock limit for the whole trial, after which its process (group) is killed
+        chunk_timeout_seconds (float, optional): limit for each chunk, like the python tool's timeout. The next chunk still runs
+        memory_mb (int, optional): address space limit
+        max_file_mb (int, optional): largest file the code may write
+    """
+    timeout_seconds: float = 300
+    chunk_timeout_seconds: float|None = 120
+    memory_mb: int|None = 4096
+    max_file_mb: int|None = 1024
+
+
+@dataclass
+class ReexecutionResult:
+    name: str
+    status: str            # 'finished', 'timeout' (killed at the wall-clock limit) or 'error' (the sandbox process itself failed)
+    seconds: float
+    chunks_run: int
+    chunk_errors: int      # chunks that raised, which they may well have done in the original run too
+    wrote_csv: bool
+    same_csv: bool|None    # whether the csv is byte-for-byte the one from the original run (None if either is missing)
+
+
+class Reexecutor:
+    """
+    Re-executes the trials of a workdir into a new one
+
+    Args:
+        workdir (Path): workdir of the original run
+        out_dir (Path): where the new trial store, csvs and each trial's sandbox directory go
+        limits (SandboxLimits): limits for each trial
+        allow_network (bool): let the code connect anywhere, rather than only to the record/replay server
+    """
+    def __init__(self, workdir: Path, out_dir: Path, limits: SandboxLimits|None = None, allow_network: bool = False):
+        self.workdir = Path(workdir).resolve()
+        self.out_dir = Path(out_dir).resolve()
+        self.limits = limits or SandboxLimits()
+        self.allow_network = allow_network
+        self._processes: set[subprocess.Popen] = set()
+        self._lock = threading.Lock()
+
+    def run(self, names: list[str]|None = None, workers: int|None = None) -> list[ReexecutionResult]:
+        """re-execute the given trials (default: all of them), recording each in the new workdir as it finishes"""
+        source = open_trial_store(self.workdir)
+        names = names if names is not None else source.names()
+        records = {name: source.get(name) for name in names}
+        unknown = [name for name, record in records.items() if record is None]
+        if unknown:
+            raise ValueError(f'no trials named {", ".join(unknown)} in {self.workdir}')
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        store = TrialStore(self.out_dir/store_filename)
+        results = []
+        start = time.time()
+        pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        try:
+            # each thread just babysits a sandbox process
+            futures = {pool.submit(self.run_trial, record): record for record in records.values()}
+            for future in as_completed(futures):
+                record = futures[future]
+                result = future.result()
+                self._record(store, record, result)
+                results.append(result)
+                print(f'[{len(results)}/{len(names)}] {result.name}: {result.status} in {result.seconds:.1f}s ({result.chunks_run} chunks, {result.chunk_errors} raised){"" if result.wrote_csv else ", no csv"}')
+        except KeyboardInterrupt:
+            print('Interrupted. Killing running sandboxes')
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.kill_all()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
+        wrote = sum(result.wrote_csv for result in results)
+        same = sum(bool(result.same_csv) for result in results)
+        comparable = sum(result.same_csv is not None for result in results)
+        print(f'Re-executed {len(results)} trials in {time.time() - start:.0f}s: {wrote} wrote a csv ({same}/{comparable} identical to the original run)')
+        return results
+
+    def run_trial(self, record: TrialRecord) -> ReexecutionResult:
+        """re-execute one trial in a sandbox process, leaving its csv (if it writes one) in the new workdir"""
+        name = record.name
+        sandbox_dir = self.out_dir/'trials'/name
+        sandbox_dir.mkdir(parents=True, exist_ok=True)
+        (sandbox_dir/f'{name}.csv').unlink(missing_ok=True)
+        (sandbox_dir/result_filename).unlink(missing_ok=True)
+        chunks = [chunk for chunk, kind in zip(record.code_chunks, record.kinds) if kind == 'code']
+        job = {'chunks': chunks, 'limits': asdict(self.limits), 'allow_network': self.allow_network}
+        (sandbox_dir/job_filename).write_text(json.dumps(job))
+
+        start = time.time()
+        status = 'finished'
+        with (sandbox_dir/'output.log').open('w') as log:
+            # in its own session, so everything the code started can be killed along with it
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'experiments.reexecute', '--sandbox-job', str(sandbox_dir/job_filename)],
+                cwd=sandbox_dir, env=self._sandbox_env(), stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+            )
+            with self._lock:
+                self._processes.add(process)
+            try:
+                process.wait(self.limits.timeout_seconds)
+            except subprocess.TimeoutExpired:
+                status = 'timeout'
+                _kill(process)
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+        if status == 'finished' and process.returncode != 0:
+            status = 'error'
+
+        chunk_results = json.loads((sandbox_dir/result_filename).read_text()) if (sandbox_dir/result_filename).exists() else []
+        result_path = sandbox_dir/f'{name}.csv'
+        original_path = self.workdir/f'{name}.csv'
+        wrote_csv = result_path.exists()
+        same_csv = result_path.read_bytes() == original_path.read_bytes() if wrote_csv and original_path.exists() else None
+        if wrote_csv:
+            # where the analyzers expect it
+            result_path.replace(self.out_dir/f'{name}.csv')
+        else:
+            (self.out_dir/f'{name}.csv').unlink(missing_ok=True)
+        return ReexecutionResult(
+            name, status, time.time() - start, len(chunk_results), sum(chunk['error'] is not None for chunk in chunk_results),
+            wrote_csv, same_csv
+        )
+
+    def kill_all(self):
+        with self._lock:
+            processes = [*self._processes]
+        for process in processes:
+            _kill(process)
+
+    def _record(self, store: TrialStore, record: TrialRecord, result: ReexecutionResult):
+        """copy the trial into the new workdir's store, with how the re-execution went"""
+        if record.name in store:
+            store.discard_trial(record.name)
+        metadata = {**record.metadata, 'original_status': record.status, 'reexecuted_from': str(self.workdir), 'reexecution': asdict(result)}
+        store.start_trial(record.name, variant=record.variant, query=record.query, metadata=metadata)
+        for chunk, kind in zip(record.code_chunks, record.kinds):
+            store.add_chunk(record.name, chunk, kind)
+        store.finish_trial(record.name, result.status)
+
+    def _sandbox_env(self) -> dict[str, str]:
+        env = {k: v for k, v in os.environ.items() if not k.upper().endswith(_secret_suffixes)}
+        env['PYTHONPATH'] = os.pathsep.join([str(here.parent), *filter(None, [env.get('PYTHONPATH')])])
+        # sandboxes already use every core between them
+        env.update(OMP_NUM_THREADS='1', OPENBLAS_NUM_THREADS='1', MKL_NUM_THREADS='1')
+        return env
+
+
+def _kill(process: subprocess.Popen):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+# --- inside the sandbox process --- #
+
+def _apply_limits(limits: SandboxLimits):
+    import resource
+    if limits.memory_mb is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (limits.memory_mb * 2**20,) * 2)
+    if limits.max_file_mb is not None:
+        resource.setrlimit(resource.RLIMIT_FSIZE, (limits.max_file_mb * 2**20,) * 2)
+    # backstop for code that burns cpu in a way that survives the wall-clock kill (e.g. forked children)
+    resource.setrlimit(resource.RLIMIT_CPU, (int(limits.timeout_seconds) + 1,) * 2)
+
+
+def _refuse_connections(allowed: set[tuple[str, int]]):
+    """make any connection to somewhere other than `allowed` (host, port)s fail, as it would with no network"""
+    import socket
+    original_connect = socket.socket.connect
+    def connect(self, address):
+        if self.family in (socket.AF_INET, socket.AF_INET6) and tuple(address[:2]) not in allowed:
+            raise ConnectionRefusedError(f'network access is disabled while re-executing trials (tried to connect to {address[0]}:{address[1]})')
+        return original_connect(self, address)
+    socket.socket.connect = connect
+
+
+def run_sandbox_job(job_path: Path):
+    """run a trial's code chunks one after another in a single python environment, as the agent's python tool did"""
+    from archytas.tools import PythonTool as OriginalPythonTool
+    from .utils import python_tool_exit, timeout, TimeoutException
+    from .http_replay import route_requests_from_env
+
+    job = json.loads(Path(job_path).read_text())
+    limits = SandboxLimits(**job['limits'])
+    _apply_limits(limits)
+    route_requests_from_env()
+    if not job['allow_network']:
+        server = urlsplit(os.environ.get(SERVER_ENV_VAR, ''))
+        _refuse_connections({(server.hostname, server.port)} if server.hostname else set())
+
+    env = OriginalPythonTool(locals={'exit': python_tool_exit}).env
+    results = []
+    for i, chunk in enumerate(job['chunks']):
+        start = time.time()
+        error = None
+        try:
+            if limits.chunk_timeout_seconds is None:
+                out = env.run_script(chunk)
+            else:
+                with timeout(limits.chunk_timeout_seconds, message='python tool call'):
+                    out = env.run_script(chunk)
+        except TimeoutException as e:
+            out, error = {'stdout': '', 'stderr': ''}, f'TimeoutException: {e}'
+        finally:
+            # the environment only restores stdout/stderr if the code finished
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        if error is None and out['exception'] is not None:
+            error = f'{out["exception"]["type"]}: {out["exception"]["message"]}'
+        print(f'--- chunk {i}{f" ({error})" if error else ""} ---\n{out["stdout"]}{out["stderr"]}', flush=True)
+        results.append({'seconds': time.time() - start, 'error': error})
+        # rewritten after every chunk, so whatever ran before a kill is still reported
+        (Path(job_path).parent/result_filename).write_text(json.dumps(results))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="re-execute the code captured by a workdir's trials to regenerate their csvs, without the LLM")
+    parser.add_argument('workdir', type=Path, nargs='?')
+    parser.add_argument('--out', type=Path, default=None, help='workdir for the results (default: <workdir>_rerun)')
+    parser.add_argument('--trials', nargs='+', default=None, help='names of the trials to re-execute (default: all)')
+    parser.add_argument('--workers', type=int, default=None, help='trials to re-execute at once (default: one per core)')
+    parser.add_argument('--timeout', type=float, default=SandboxLimits.timeout_seconds, help='max seconds per trial')
+    parser.add_argument('--chunk-timeout', type=float, default=SandboxLimits.chunk_timeout_seconds, help='max seconds per code chunk')
+    parser.add_argument('--memory-mb', type=int, default=SandboxLimits.memory_mb, help='address space limit per trial')
+    parser.add_argument('--max-file-mb', type=int, default=SandboxLimits.max_file_mb, help='largest file a trial may write')
+    parser.add_argument('--http', choices=['replay', 'record', 'live'], default='replay', help='serve GDC/cBioPortal responses from the store (offline), record any that are missing, or talk to the APIs directly')
+    parser.add_argument('--http-store', type=Path, default=default_store_dir, help='directory of recorded GDC/cBioPortal responses')
+    parser.add_argument('--sandbox-job', type=Path, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.sandbox_job is not None:
+        run_sandbox_job(args.sandbox_job)
+        return
+    if args.workdir is None:
+        parser.error('a workdir is required')
+
+    limits = SandboxLimits(args.timeout, args.chunk_timeout, args.memory_mb, args.max_file_mb)
+    out_dir = args.out or args.workdir.with_name(f'{args.workdir.name}_rerun')
+    with serve_http(args.http, args.http_store):
+        Reexecutor(args.workdir, out_dir, limits, allow_network=args.http != 'replay').run(args.trials, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,88 +7,472 @@ from archytas.react import ReActAgent, FailedTaskError
 from adhoc_api.tool import AdhocApi, APISpec, DrafterConfig
 from adhoc_api.utils import move_to_isolated_dir
 from pathlib import Path
-from .utils import PythonTool, timeout, TimeoutException, save_to_yaml, CaptureCode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
+from functools import partial
+from typing import Callable, TYPE_CHECKING
+from multiprocessing import get_context
+import argparse
+import hashlib
+import json
+import os
+from .utils import PythonTool, timeout, TimeoutException, save_to_yaml, CaptureCode, redirect_output
+from .trial_store import TrialStore, store_filename
+from .early_stopping import StoppingRule, InOrderStopping, add_stopping_arguments, stopping_rule_from_args
+from .tracing import Tracer, tracing, trace_agent, trace_drafters, trace_requests, format_breakdown
+from .http_replay import serve_http, route_requests_from_env, default_store_dir, SERVER_ENV_VAR, HOSTS
+from .rate_limit import rate_limiter_from_env, set_rate_limits, limit_agent, limit_drafters, limit_requests, default_limits_path
+from .solution_registry import registry_from_env, set_registry, use_prebaked_solutions, default_registry_path
+from .llm_replay import llm_mode, llm_mode_from_env, trace_from_env, instrument_agent, instrument_adhoc_api, replay_api_spec, default_trace_dir, TrialTrace
 from .gdc_cases import gdc_trial_2, gdc_trial_3a, gdc_trial_3b, gdc_trial_3c1, gdc_trial_3c2, gdc_trial_3d
 from .cbio_cases import cbio_trial_4a, cbio_trial_4b, cbio_trial_4c
 
 import pdb
 
+if TYPE_CHECKING:
+    from .analysis_utils import Score
+    from .online_scoring import OnlineScorer
+
 
 here = Path(__file__).parent
 
+# every trial configuration, by name (e.g. for selecting from the command line)
+CASES = {case.__name__: case for case in (
+    gdc_trial_2, gdc_trial_3a, gdc_trial_3b, gdc_trial_3c1, gdc_trial_3c2, gdc_trial_3d,
+    cbio_trial_4a, cbio_trial_4b, cbio_trial_4c,
+)}
+default_agent_model = 'gpt-4o'
+def case_evaluator(case: str, data_dir: Path) -> Callable[[str, list[str]], 'Score']:
+    """the analysis' evaluation function for a case, scoring trials whose csvs are in `data_dir`"""
+    # imported here, since the analysis modules pull in plotting etc. that trial processes don't need
+    if case.startswith('gdc_'):
+        from .gdc_analysis import evaluate_gdc_trial
+        return partial(evaluate_gdc_trial, data_dir=data_dir)
+    if case.startswith('cbio_'):
+        from .cbio_analysis import evaluate_cbio_trial
+        return partial(evaluate_cbio_trial, data_dir=data_dir)
+    raise ValueError(f'no evaluator for case {case!r}')
+
+
+def online_scorer() -> 'OnlineScorer':
+    # like case_evaluator, only imported by the process running the loop and not by every trial process
+    from .online_scoring import OnlineScorer
+    return OnlineScorer()
+
+
+def format_scores(scored: list[Future]) -> str:
+    scores = [future.result() for future in scored]
+    failed = sum(score is None for score in scores)
+    return f'{sum(score.success for score in scores if score is not None)}/{len(scores)} scored trials successful' + (f' ({failed} could not be evaluated)' if failed else '')
+
+
+# appended to each case's query, with {name} filled in with the trial's csv
+query_suffix = ' and save the result to a csv named {name}. Please do not print out the result, only save it to the csv file'
 
 
 def main():
-    with move_to_isolated_dir():
-        #TODO: parameterize this with cmdline args (mainly the api selection)
-        api, drafter_config, query_base = cbio_trial_4b()
+    parser = argparse.ArgumentParser(description='run adhoc api N times with the same query')
+    parser.add_argument('--case', choices=CASES, default='cbio_trial_4b', help='which API variant/query to run (see experiments.sweep to run several)')
+    parser.add_argument('--agent-model', default=default_agent_model, help='model used by the ReAct agent')
+    parser.add_argument('--trials', type=int, default=100, help='number of trials to run')
+    parser.add_argument('--workers', type=int, default=1, help='number of trials to run concurrently, each in its own process')
+    parser.add_argument('--supervised', action='store_true', help='run each trial in a child process that is killed if it overruns the timeout')
+    parser.add_argument('--tool-timeout', type=float, default=None, help='max seconds for a single python tool call')
+    parser.add_argument('--http', choices=['live', 'record', 'replay'], default='live', help='talk to GDC/cBioPortal directly, or record/replay responses through a local server')
+    parser.add_argument('--http-store', type=Path, default=default_store_dir, help='directory of recorded GDC/cBioPortal responses')
+    parser.add_argument('--http-latency', type=float, default=0.0, help='seconds of delay added to each replayed response')
+    parser.add_argument('--llm', choices=['live', 'record', 'replay'], default='live', help='call the agent/drafter LLMs directly, or record/replay their responses')
+    parser.add_argument('--llm-traces', type=Path, default=default_trace_dir, help='directory of recorded LLM calls')
+    parser.add_argument('--rate-limits', default=default_limits_path, help="database of per-provider/host request rate limits shared by every process (see experiments.rate_limit), or 'off'")
+    parser.add_argument('--score', action='store_true', help='score each trial in the background as soon as it finishes, saving the score for the analysis (implied by --early-stop)')
+    parser.add_argument('--prebaked', type=Path, nargs='?', const=default_registry_path, default=None, help='answer drafter requests with a matching prebaked solution from this registry (see experiments.solution_registry) instead of drafting code')
+    add_stopping_arguments(parser)
+    args = parser.parse_args()
+    set_rate_limits(args.rate_limits)
+    if args.prebaked is not None:
+        set_registry(args.prebaked)
+    stopping_rule = stopping_rule_from_args(args)
+
+    with serve_http(args.http, args.http_store, latency=args.http_latency), llm_mode(args.llm, args.llm_traces), move_to_isolated_dir():
+        api, drafter_config, query_base = CASES[args.case]()
         test_loop(
-            num_trials=100,
+            num_trials=args.trials,
             timeout_seconds=600,
             api=api,
             drafter_config=drafter_config,
-            query_base=query_base
+            query_base=query_base,
+            workers=args.workers,
+            supervised=args.supervised,
+            tool_timeout_seconds=args.tool_timeout,
+            agent_model=args.agent_model,
+            evaluate_trial_fn=case_evaluator(args.case, Path.cwd()) if args.score or stopping_rule is not None else None,
+            stopping_rule=stopping_rule
         )
 
 
 
-def test_case(query:str, capture_code:CaptureCode, api: APISpec, drafter_config: DrafterConfig):
-    # Set up AdhocApi with GDC API
-    adhoc_api = AdhocApi(apis=[api], drafter_config=drafter_config)
+class TrialSession:
+    """
+    The parts of a trial that are expensive to set up and can be shared between trials of the same API variant.
+    Mainly the AdhocApi instance, which processes the API documentation and keeps the drafter (and its context cache)
+    warm. Per-trial state (drafter chat history, python environment, agent conversation) is reset by `new_agent`
+    """
+    def __init__(self, api: APISpec, drafter_config: DrafterConfig, tool_timeout_seconds: float|None = None, agent_model: str = default_agent_model):
+        self.variant = api.get('cache_key', api['name'])
+        # recordings made with different agent models must not overwrite each other
+        if agent_model != default_agent_model:
+            self.variant = f'{self.variant}__{agent_model}'
+        self.agent_model = agent_model
+        self.replaying = llm_mode_from_env() == 'replay'
+        if self.replaying:
+            api = replay_api_spec(api, drafter_config)
+        self.adhoc_api = AdhocApi(apis=[api], drafter_config=drafter_config)
+        # nothing is sent to the providers when replaying, so there's nothing to limit
+        self.limiter = rate_limiter_from_env() if not self.replaying else None
+        if self.limiter is not None:
+            limit_drafters(self.adhoc_api, self.limiter)
+        trace_drafters(self.adhoc_api)
+        self.registry = registry_from_env()
+        self.python = PythonTool(code_side_effect=lambda code: None, timeout_seconds=tool_timeout_seconds)
+
+    def new_agent(self, capture_code: CaptureCode, trace: TrialTrace|None = None) -> ReActAgent:
+        """reset everything left over from the previous trial, and make a fresh agent for the next one"""
+        # nothing real is ever created for the drafter when replaying
+        if not self.replaying:
+            for api in self.adhoc_api.apis:
+                AdhocApi._get_agent(self.adhoc_api, api).clear_messages()
+        self.python.reset(code_side_effect=capture_code)
+
+        # Set up archytas agent
+        tools = [self.adhoc_api, self.python]
+        agent = ReActAgent(messages=[], model=self.agent_model, tools=tools, verbose=True, allow_ask_user=False)
+
+        if self.limiter is not None:
+            limit_agent(agent, self.limiter, self.agent_model)
+        if trace is not None:
+            instrument_agent(agent, trace)
+            instrument_adhoc_api(self.adhoc_api, trace)
+        # after the record/replay instrumentation, so drafter requests that match a prebaked solution skip it too
+        if self.registry is not None:
+            use_prebaked_solutions(self.adhoc_api, self.registry)
+        trace_agent(agent)
+        return agent
+
+
+# sessions are kept for the life of the process (i.e. across the trials of the sequential loop, or of a worker)
+_sessions: dict[str, TrialSession] = {}
+
+def get_trial_session(api: APISpec, drafter_config: DrafterConfig, tool_timeout_seconds: float|None = None, agent_model: str = default_agent_model) -> TrialSession:
+    key = hashlib.sha256(json.dumps([api, drafter_config, tool_timeout_seconds, agent_model], sort_keys=True).encode()).hexdigest()
+    if key not in _sessions:
+        _sessions[key] = TrialSession(api, drafter_config, tool_timeout_seconds, agent_model)
+    return _sessions[key]
 
-    python = PythonTool(code_side_effect=capture_code)
 
-    # Set up archytas agent
-    tools = [adhoc_api, python]
-    agent = ReActAgent(messages=[], model='gpt-4o', tools=tools, verbose=True, allow_ask_user=False)
+def test_case(query:str, capture_code:CaptureCode, api: APISpec, drafter_config: DrafterConfig, tool_timeout_seconds: float|None = None, agent_model: str = default_agent_model):
+    # send API requests through the record/replay server if one is running (which then does the rate limiting itself)
+    route_requests_from_env()
+    limiter = rate_limiter_from_env()
+    if limiter is not None and SERVER_ENV_VAR not in os.environ:
+        limit_requests(limiter, HOSTS)
+    trace_requests()
+
+    # Set up AdhocApi with GDC API (reused from the previous trial if possible)
+    session = get_trial_session(api, drafter_config, tool_timeout_seconds, agent_model)
+
+    # record/replay the LLM calls if that was turned on
+    trace = trace_from_env(session.variant, f'trial_{capture_code.i}')
+    agent = session.new_agent(capture_code, trace)
 
     try:
         answer = agent.react(query)
         print(answer)
-    except (FailedTaskError, TimeoutException) as e:
+    except FailedTaskError as e:
         print(f"Error: {e}")
+    finally:
+        if trace is not None:
+            print(trace.summary())
             
 
 
-def test_loop(num_trials: int, timeout_seconds: int, api: APISpec, drafter_config: DrafterConfig, query_base: str):
+def test_loop(
+    num_trials: int,
+    timeout_seconds: int,
+    api: APISpec,
+    drafter_config: DrafterConfig,
+    query_base: str,
+    workers: int = 1,
+    supervised: bool = False,
+    tool_timeout_seconds: float|None = None,
+    agent_model: str = default_agent_model,
+    evaluate_trial_fn: Callable[[str, list[str]], 'Score']|None = None,
+    stopping_rule: StoppingRule|None = None
+):
+    """
+    Run `num_trials` trials of the query (in this process, or in worker processes if `workers` > 1 or `supervised`).
+    With an `evaluate_trial_fn`, each trial is scored in the background as it finishes and the score saved to the
+    trial store. With a `stopping_rule` as well, the run ends as soon as the scores so far satisfy it
+    """
+    if stopping_rule is not None and evaluate_trial_fn is None:
+        raise ValueError('early stopping needs an evaluate_trial_fn to score trials with')
+
     # query to test repeatability of
-    query_template = query_base + ' and save the result to a csv named {name}. Please do not print out the result, only save it to the csv file'
-
-    # if ctrl-c occurs 2x in a row, exit program
-    interrupted_prev = False 
-
-    # keep track of code snippets executed
-    capture_code = CaptureCode()
-    
-    # Trials Loop
-    for i in range(num_trials):
-        interrupted_cur = False
-        print('='*80)
-        print(f"Trial {i}")
-        capture_code.set_i(i)
-        
-        # attempt to run the test case
-        try:
-            with timeout(timeout_seconds):
-                test_case(query_template.format(name=f'trial_{i}.csv'), capture_code=capture_code, api=api, drafter_config=drafter_config)
+    query_template = query_base + query_suffix
+
+    # every code snippet executed is recorded in the trial store as it happens
+    store = TrialStore(Path(store_filename))
+    metadata = trial_metadata(api, drafter_config, agent_model)
+
+    if workers > 1 or supervised:
+        parallel_test_loop(num_trials, timeout_seconds, api, drafter_config, query_template, workers, supervised, tool_timeout_seconds, agent_model, evaluate_trial_fn, stopping_rule)
+    else:
+        # if ctrl-c occurs 2x in a row, exit program
+        interrupted_prev = False 
+
+        # keep track of code snippets executed
+        capture_code = CaptureCode(sink=store.add_chunk)
+
+        # trials are scored while the next one runs, so the rule may only be satisfied after that one has started
+        scorer = online_scorer() if evaluate_trial_fn is not None else None
+        scored: list[Future] = []
+        def on_score(name: str, score: 'Score|None'):
+            if stopping_rule is not None and score is not None and stopping_rule.decision() is None:
+                stopping_rule.update(score.success)
         
-        # handle exceptions
-        except (Exception, KeyboardInterrupt) as e:
-            print(f"Error: {e}")
-            capture_code.code[f'trial_{i}'].append(f"Error: {e}")
-            if isinstance(e, KeyboardInterrupt):
-                interrupted_cur = True
-
-        # save anything captured to yaml
-        finally:
-            save_to_yaml({f'trial_{i}': capture_code.code[f'trial_{i}']}, Path('captured_code.yaml'), append=True)
+        # Trials Loop
+        for i in range(num_trials):
+            if stopping_rule is not None and (reason := stopping_rule.decision()) is not None:
+                print(f"Stopping early after {i} trials: {reason}. {stopping_rule.summary()}")
+                break
+            interrupted_cur = False
             print('='*80)
+            print(f"Trial {i}")
+            capture_code.set_i(i)
+            query = query_template.format(name=f'trial_{i}.csv')
+            store.start_trial(f'trial_{i}', variant=api.get('cache_key'), query=query, metadata=metadata)
+            
+            # attempt to run the test case
+            status = 'finished'
+            tracer = Tracer()
+            try:
+                with tracing(tracer), tracer.span(f'trial_{i}', 'trial'), timeout(timeout_seconds):
+                    test_case(query, capture_code=capture_code, api=api, drafter_config=drafter_config, tool_timeout_seconds=tool_timeout_seconds, agent_model=agent_model)
+            
+            # handle exceptions
+            except (Exception, KeyboardInterrupt, TimeoutException) as e:
+                print(f"Error: {e}")
+                capture_code.error(e)
+                status = error_status(e)
+                if isinstance(e, KeyboardInterrupt):
+                    interrupted_cur = True
+
+            finally:
+                store.finish_trial(f'trial_{i}', status)
+                store.add_spans(f'trial_{i}', tracer.spans)
+                print(f'trial_{i} latency: {format_breakdown(tracer.spans)}')
+                print('='*80)
+
+            # if we interrupted twice in a row, exit the program
+            if interrupted_cur and interrupted_prev:
+                print("Exiting program")
+                break
+            interrupted_prev = interrupted_cur
+
+            if scorer is not None and not interrupted_cur:
+                scored.append(scorer.submit(evaluate_trial_fn, Path.cwd(), f'trial_{i}', on_score))
+
+        if scorer is not None:
+            scorer.close()
+            print(format_scores(scored))
+
+    # human readable copy of everything captured
+    save_to_yaml(store.code(), Path('captured_code.yaml'))
+
+
+def trial_metadata(api: APISpec, drafter_config: DrafterConfig, agent_model: str = default_agent_model) -> dict:
+    return {'api': api['name'], 'cache_key': api.get('cache_key'), 'drafter_config': drafter_config, 'agent_model': agent_model}
+
+
+def error_status(e: BaseException) -> str:
+    if isinstance(e, TimeoutException):
+        return 'timeout'
+    if isinstance(e, KeyboardInterrupt):
+        return 'interrupted'
+    return 'error'
+
+
+
+def run_isolated_trial(
+    i: int,
+    query: str,
+    api: APISpec,
+    drafter_config: DrafterConfig,
+    timeout_seconds: int,
+    tool_timeout_seconds: float|None = None,
+    agent_model: str = default_agent_model,
+    run_dir: Path|None = None
+) -> str:
+    """
+    Run a single trial in its own subdirectory of `run_dir` (default: the current directory), recording it in the run's
+    trial store. Executed inside a worker (or supervised child) process by parallel_test_loop and the sweep runner.
+    Returns the trial's final status
+    """
+    run_dir = Path(run_dir).resolve() if run_dir is not None else Path.cwd()
+    store = TrialStore(run_dir/store_filename)
+    store.start_trial(f'trial_{i}', variant=api.get('cache_key'), query=query, metadata=trial_metadata(api, drafter_config, agent_model))
+    capture_code = CaptureCode(sink=store.add_chunk)
+    capture_code.set_i(i)
+
+    # each trial gets its own directory so files written by the agent don't collide
+    trial_dir = run_dir/'trials'/f'trial_{i}'
+    trial_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(trial_dir)
+    status = 'finished'
+    tracer = Tracer()
+    try:
+        # agent output from concurrent trials would be unreadable if interleaved, so log each trial separately
+        with redirect_output(trial_dir/'output.log'):
+            try:
+                with tracing(tracer), tracer.span(f'trial_{i}', 'trial'), timeout(timeout_seconds):
+                    test_case(query, capture_code=capture_code, api=api, drafter_config=drafter_config, tool_timeout_seconds=tool_timeout_seconds, agent_model=agent_model)
+            except (Exception, KeyboardInterrupt, TimeoutException) as e:
+                print(f"Error: {e}")
+                capture_code.error(e)
+                status = error_status(e)
+    finally:
+        os.chdir(run_dir)
+        collect_trial_result(run_dir, i)
+        store.finish_trial(f'trial_{i}', status)
+        store.add_spans(f'trial_{i}', tracer.spans)
+
+    return status
+
+
+def collect_trial_result(run_dir: Path, i: int):
+    """move the result of an isolated trial up to the run directory where the analyzers expect it"""
+    result_path = run_dir/'trials'/f'trial_{i}'/f'trial_{i}.csv'
+    if result_path.exists():
+        result_path.replace(run_dir/f'trial_{i}.csv')
+
+
+def run_supervised_trial(
+    i: int,
+    query: str,
+    api: APISpec,
+    drafter_config: DrafterConfig,
+    timeout_seconds: int,
+    tool_timeout_seconds: float|None = None,
+    agent_model: str = default_agent_model,
+    grace_seconds: float = 30
+) -> str:
+    """
+    Run a single trial in a child process, and kill the process if it runs past the deadline.
+    The trial's own timeout gets the first chance to stop it cleanly, and the process is killed `grace_seconds` later.
+    The child records code chunks in the trial store as they are run, so anything captured before the kill is kept.
+    """
+    ctx = get_context('spawn')
+    process = ctx.Process(
+        target=run_isolated_trial,
+        args=(i, query, api, drafter_config, timeout_seconds, tool_timeout_seconds, agent_model),
+        daemon=True
+    )
+    process.start()
+    try:
+        process.join(timeout_seconds + grace_seconds)
+    finally:
+        killed = process.is_alive()
+        if killed:
+            process.terminate()
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+            process.join()
+
+    if not killed:
+        return 'finished' if process.exitcode == 0 else 'error'
+
+    print(f"Trial {i} exceeded its {timeout_seconds}s timeout. Killed it")
+    run_dir = Path.cwd()
+    collect_trial_result(run_dir, i)
+    store = TrialStore(run_dir/store_filename)
+    store.add_chunk(f'trial_{i}', f"Error: trial killed after exceeding the {timeout_seconds} second timeout", 'error')
+    store.finish_trial(f'trial_{i}', 'killed')
+    return 'killed'
+
+
+def parallel_test_loop(
+    num_trials: int,
+    timeout_seconds: int,
+    api: APISpec,
+    drafter_config: DrafterConfig,
+    query_template: str,
+    workers: int,
+    supervised: bool = False,
+    tool_timeout_seconds: float|None = None,
+    agent_model: str = default_agent_model,
+    evaluate_trial_fn: Callable[[str, list[str]], 'Score']|None = None,
+    stopping_rule: StoppingRule|None = None
+):
+    if supervised:
+        # each thread just babysits a child process, so threads are enough here
+        pool = ThreadPoolExecutor(max_workers=workers)
+        run_trial = run_supervised_trial
+    else:
+        # spawn (rather than fork) so every worker starts with a clean interpreter
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+        run_trial = run_isolated_trial
+
+    with pool:
+        futures = {
+            pool.submit(run_trial, i, query_template.format(name=f'trial_{i}.csv'), api, drafter_config, timeout_seconds, tool_timeout_seconds, agent_model): i
+            for i in range(num_trials)
+        }
+
+        scorer = online_scorer() if evaluate_trial_fn is not None else None
+        scored: list[Future] = []
+        ordered = InOrderStopping(stopping_rule, range(num_trials)) if stopping_rule is not None else None
+
+        def report(future):
+            if future.cancelled():
+                return
+            i = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                # the worker itself died, so record that against the trial
+                status = 'error'
+                store = TrialStore(Path(store_filename))
+                store.add_chunk(f'trial_{i}', f"Error: {e}", 'error')
+                store.finish_trial(f'trial_{i}', status)
+            spans = TrialStore(Path(store_filename)).spans(f'trial_{i}').get(f'trial_{i}', [])
+            print(f"Finished trial {i} ({status}): {format_breakdown(spans)}")
+            if scorer is not None and status != 'interrupted':
+                scored.append(scorer.submit(evaluate_trial_fn, Path.cwd(), f'trial_{i}', lambda name, score: on_score(i, score)))
+            elif ordered is not None:
+                ordered.update(i, None)
+
+        # trials finish out of order (quick failures first), so the rule is fed their outcomes in trial order
+        def on_score(i: int, score: 'Score|None'):
+            if ordered is None:
+                return
+            reason = ordered.update(i, score.success if score is not None else None)
+            if reason is not None:
+                cancelled = sum(future.cancel() for future in futures)
+                print(f"Stopping early: {reason}. {stopping_rule.summary()}. Cancelled {cancelled} trials that hadn't started")
+
+        try:
+            for future in as_completed(futures):
+                report(future)
+
+        # on ctrl-c, drop any trials that haven't started, but let the running ones record what they captured
+        except KeyboardInterrupt:
+            print("Interrupted. Cancelling remaining trials (ctrl-c again to exit immediately)")
+            pending = [future for future in futures if not future.done() and not future.cancel()]
+            for future in as_completed(pending):
+                report(future)
 
-        # if we interrupted twice in a row, exit the program
-        if interrupted_cur and interrupted_prev:
-            print("Exiting program")
-            break
-        interrupted_prev = interrupted_cur
+        if scorer is not None:
+            scorer.close()
+            print(format_scores(scored))
 
 
 
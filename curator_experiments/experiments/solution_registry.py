@@ -0,0 +1,433 @@
+"""
+Registry of solution templates: the prebaked solutions (see `solved_tasks.py`), with what they do and how to call them
+
+Each template points at a function in `prebaked_solutions` and has a description, its parameters and some example
+queries it solves. The registry indexes the text with TF-IDF (unigrams and bigrams) and the code with the same AST
+subtree fingerprints `code_similarity` uses, so it can answer locally, in milliseconds, whether a query (or a piece of
+drafted code) is already covered by a template.
+
+With `use_prebaked_solutions`, requests to the drafter to write code for a goal a template already solves are answered
+with the template's usage instead, which skips the drafter call (and usually most of the agent's trial and error):
+    python -m experiments.run_trials --case gdc_trial_2 --prebaked
+To see what a query would match:
+    python -m experiments.solution_registry "find cases of lymphoblastic leukemia with a JAK1 mutation"
+"""
+
+from dataclasses import dataclass, field, asdict
+from functools import cached_property
+from pathlib import Path
+from typing import Any, TYPE_CHECKING
+import math
+import ast
+import re
+import os
+
+import numpy as np
+import yaml
+from scipy import sparse
+
+from .code_similarity import subtree_hashes
+
+if TYPE_CHECKING:
+    from adhoc_api.tool import AdhocApi
+
+
+here = Path(__file__).parent
+solutions_root = here / '..'
+default_registry_path = solutions_root / 'prebaked_solutions/registry.yaml'
+
+# environment variable pointing trial processes at the registry to answer drafter requests from
+REGISTRY_ENV_VAR = 'CURATOR_PREBAKED_SOLUTIONS'
+
+
+@dataclass
+class SolutionTemplate:
+    """
+    A solved task, as a function in `prebaked_solutions`
+
+    Args:
+        name (str): unique name of the template
+        api (str): name of the API it's for (as in the API spec, e.g. 'Genomics Data Commons')
+        description (str): what it does, in plain English
+        module (str): module the function is in, e.g. 'prebaked_solutions.gdc'
+        function (str): name of the function
+        parameters (dict[str, str]): parameter name -> description
+        examples (list[str]): queries it solves
+        usage (str): example code calling it
+    """
+    name: str
+    api: str
+    description: str
+    module: str
+    function: str
+    parameters: dict[str, str] = field(default_factory=dict)
+    examples: list[str] = field(default_factory=list)
+    usage: str = ''
+
+    @property
+    def import_line(self) -> str:
+        return f'from {self.module} import {self.function}'
+
+    def source(self) -> str:
+        """source code of the function (read from the module file, without importing it)"""
+        path = solutions_root / (self.module.replace('.', '/') + '.py')
+        text = path.read_text()
+        for node in ast.parse(text).body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == self.function:
+                return ast.get_source_segment(text, node)
+        raise ValueError(f'{self.function} not found in {path}')
+
+    @property
+    def placeholders(self) -> list[str]:
+        return list(dict.fromkeys(re.findall(r'\{(\w+)\}', self.description)))
+
+    def fill_description(self, query: str) -> dict[str, str]|None:
+        """
+        If the description has {parameter} placeholders (as promoted templates do) and the query is an instance of it,
+        the text the query has in place of each placeholder. None otherwise
+
+        >>> SolutionTemplate('t', 'GDC', 'find cases with a {gene} mutation in {disease}', 'm', 'f').fill_description(
+        ...     'Find cases with a TP53 mutation in breast carcinoma and save the result to a csv named x.csv')
+        {'gene': 'TP53', 'disease': 'breast carcinoma'}
+        """
+        parts = re.split(r'\{(\w+)\}', self.description.strip())
+        if len(parts) == 1:
+            return None
+        # a placeholder can appear more than once (e.g. each gene of a list), with its values joined
+        groups: dict[str, list[str]] = {}
+        pattern = ''
+        for i, part in enumerate(parts):
+            if i % 2:
+                group = f'{part}__{len(groups.setdefault(part, []))}'
+                groups[part].append(group)
+                pattern += rf'(?P<{group}>.+?)'
+            elif part.strip():
+                pattern += r'\s+'.join(map(re.escape, part.split()))
+        # a placeholder at the very end runs up to the end of the task (e.g. up to the instructions for saving the
+        # result, as in run_trials.query_suffix). Otherwise anything may follow the description
+        end = _task_end if not parts[-1].strip() else r'(?:\W|$)'
+        match = re.match(rf'\s*{pattern}{end}', query, re.IGNORECASE | re.DOTALL)
+        if match is None:
+            return None
+        return {name: ', '.join(match.group(group).strip() for group in names) for name, names in groups.items()}
+
+    def call(self, arguments: dict[str, str]|None = None, output_path: str|None = None) -> str|None:
+        """
+        The usage, with what the query has for each placeholder (and the file it asks for, for templates with an
+        `output_path`) in place of the example values, e.g. '*lymphoblastic leukemia*' -> '*breast carcinoma*'.
+        None if any of them can't be passed to the function safely
+        """
+        # templates without placeholders (e.g. the hand written ones) are used as their usage shows
+        unchanged = None if self.placeholders else self.usage
+        if set(arguments or {}) != set(self.placeholders):
+            return unchanged
+        try:
+            call = ast.parse(self.usage.strip(), mode='eval').body
+            defaults = {k.arg: ast.literal_eval(k.value) for k in call.keywords}
+        except (SyntaxError, ValueError, AttributeError):
+            return unchanged
+        if not isinstance(call, ast.Call) or call.args or None in defaults or not (arguments or 'output_path' in defaults):
+            return unchanged
+        values = dict(defaults)
+        for name, text in (arguments or {}).items():
+            if name not in defaults or (value := _argument_value(text, defaults[name])) is None:
+                return None
+            values[name] = value
+        if output_path is not None and 'output_path' in defaults:
+            values['output_path'] = output_path
+        return f'{ast.unparse(call.func)}(' + ', '.join(f'{name}={value!r}' for name, value in values.items()) + ')'
+
+    def as_draft(self, arguments: dict[str, str]|None = None, output_path: str|None = None) -> str|None:
+        """
+        how the template is handed to the agent in place of drafted code, called with the query's values.
+        None if they can't be filled in (see `call`)
+        """
+        usage = self.call(arguments, output_path)
+        if usage is None:
+            return None
+        lines = [f'# prebaked solution "{self.name}": {self.description.strip()}']
+        lines.extend(f'#   {name}: {description}' for name, description in self.parameters.items())
+        lines.append(self.import_line)
+        if usage:
+            lines.append(usage.strip())
+        return '\n'.join(lines)
+
+
+# where the task in a query ends, and e.g. instructions for saving its result start
+_task_end = r'\s*(?:[.;]?\s*$|[.;]\s|,?\s*(?:and\s+)?(?:save|write|store|output)\b)'
+
+
+def _argument_value(text: str, default: Any) -> Any:
+    """a value from the query in the form of the example value it replaces, or None if it can't be put in that form"""
+    text = text.strip()
+    if not text or '\n' in text or len(text) > 200:
+        return None
+    if isinstance(default, (list, tuple)):
+        items = [item for item in re.split(r'\s*,\s*(?:and\s+)?|\s+and\s+', text) if item]
+        values = [_argument_value(item, default[0] if default else '') for item in items]
+        return tuple(values) if values and None not in values else None
+    if isinstance(default, str):
+        # same wildcards as the example, e.g. GDC's '*lymphoblastic leukemia*'
+        text = text.strip('*')
+        return '*' * default.startswith('*') + text + '*' * (len(default) > 1 and default.endswith('*'))
+    if isinstance(default, (int, float)) and not isinstance(default, bool):
+        try:
+            return type(default)(text)
+        except ValueError:
+            return None
+    return None
+
+
+def output_name(query: str) -> str|None:
+    """the file a query asks for the result to be saved to, e.g. 'trial_3.csv'"""
+    names = re.findall(r'(?<![\w./-])([\w.-]+\.(?:csv|tsv|parquet|json|xlsx))\b', query)
+    return names[-1] if names else None
+
+
+@dataclass
+class Match:
+    template: SolutionTemplate
+    score: float # 0 (nothing in common) to 1
+    arguments: dict[str, str]|None = None # what the query has for each of the template's placeholders, if it's an instance of its description
+
+
+# --- text index --- #
+
+stopwords = frozenset('''
+a an and any are as at be by for from in into is it its of on or that the their them these this those to with
+all find get give me my please save show result results csv file using use via what which who whose
+'''.split())
+
+def tokenize(text: str) -> list[str]:
+    """lowercase words without stopwords, crudely singularized, plus bigrams of adjacent words"""
+    words = []
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        if word in stopwords:
+            continue
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        words.append(word)
+    return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+
+class TfidfIndex:
+    """cosine similarity of TF-IDF vectors (sublinear tf, smoothed idf)"""
+    def __init__(self, documents: list[str]):
+        self.vocab: dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        for row, document in enumerate(documents):
+            for term, count in _term_counts(tokenize(document)).items():
+                rows.append(row)
+                cols.append(self.vocab.setdefault(term, len(self.vocab)))
+                counts.append(count)
+        shape = (len(documents), max(len(self.vocab), 1))
+        tf = sparse.csr_matrix((1 + np.log(np.array(counts, dtype=np.float64)), (rows, cols)), shape=shape)
+        document_frequency = np.bincount(np.array(cols, dtype=np.int64), minlength=shape[1])
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+        # terms no document has are as rare as it gets
+        self.unseen_idf = math.log(1 + len(documents)) + 1
+        matrix = tf.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        self.matrix = sparse.diags(1 / np.where(norms > 0, norms, 1)) @ matrix
+
+    def scores(self, query: str) -> np.ndarray:
+        counts = _term_counts(tokenize(query))
+        weights = {term: (1 + math.log(count)) * (self.idf[self.vocab[term]] if term in self.vocab else self.unseen_idf) for term, count in counts.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        if norm == 0:
+            return np.zeros(self.matrix.shape[0])
+        vector = np.zeros(self.matrix.shape[1])
+        for term, weight in weights.items():
+            if term in self.vocab:
+                vector[self.vocab[term]] = weight / norm
+        return self.matrix @ vector
+
+
+def _term_counts(terms: list[str]) -> dict[str, int]:
+    counts: dict[str, int] = {}
+    for term in terms:
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+
+# --- the registry --- #
+
+class SolutionRegistry:
+    """
+    The templates saved in a registry file, indexed for search
+
+    Args:
+        path (Path): the registry file (yaml list of templates). Empty if it doesn't exist yet
+    """
+    def __init__(self, path: Path = default_registry_path):
+        self.path = Path(path)
+        entries = yaml.safe_load(self.path.read_text()) if self.path.exists() else None
+        self.templates = [SolutionTemplate(**entry) for entry in entries or []]
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def __contains__(self, name: str) -> bool:
+        return any(template.name == name for template in self.templates)
+
+    def get(self, name: str) -> SolutionTemplate:
+        for template in self.templates:
+            if template.name == name:
+                return template
+        raise KeyError(name)
+
+    def add(self, template: SolutionTemplate):
+        """add a template, replacing any with the same name. Call `save` to keep it"""
+        self.templates = [t for t in self.templates if t.name != template.name] + [template]
+        self.__dict__.pop('_text_index', None)
+        self.__dict__.pop('_fingerprints', None)
+
+    def save(self):
+        self.path.write_text(yaml.dump([asdict(t) for t in self.templates], Dumper=_BlockDumper, sort_keys=False, allow_unicode=True))
+
+    @cached_property
+    def _text_index(self) -> tuple[TfidfIndex, np.ndarray]:
+        # each example (and the description) is matched on its own, since a query is about as long as one of them
+        owners, texts = [], []
+        for i, template in enumerate(self.templates):
+            for text in _searchable_texts(template):
+                owners.append(i)
+                texts.append(text)
+        return TfidfIndex(texts), np.array(owners, dtype=np.int64)
+
+    @cached_property
+    def _fingerprints(self) -> list[set[int]]:
+        return [subtree_hashes([t.source()]) for t in self.templates]
+
+    def search(self, query: str, api: str|None = None, k: int = 5) -> list[Match]:
+        """
+        The `k` templates whose text best matches the query, best first (only those for `api` if given).
+        A query that fills in the placeholders of a template's description is a perfect match
+        """
+        if not self.templates:
+            return []
+        index, owners = self._text_index
+        scores = np.zeros(len(self.templates))
+        np.maximum.at(scores, owners, index.scores(query))
+        matches = []
+        for template, score in zip(self.templates, scores):
+            if api is not None and not _same_api(template.api, api):
+                continue
+            arguments = template.fill_description(query)
+            matches.append(Match(template, 1.0 if arguments is not None else round(float(score), 4), arguments))
+        return sorted(matches, key=lambda m: m.score, reverse=True)[:k]
+
+    def lookup(self, query: str, api: str|None = None, threshold: float = 0.6) -> Match|None:
+        """the template that solves the query, if any is a close enough match"""
+        best = self.search(query, api, k=1)
+        return best[0] if best and best[0].score >= threshold else None
+
+    def similar_code(self, code_chunks: list[str], threshold: float = 0.0) -> list[Match]:
+        """templates whose code is structurally similar to the given code (jaccard of AST subtree hashes), best first"""
+        fingerprint = subtree_hashes(code_chunks)
+        matches = []
+        for template, other in zip(self.templates, self._fingerprints):
+            union = len(fingerprint | other)
+            score = len(fingerprint & other) / union if union else 0.0
+            if score >= threshold:
+                matches.append(Match(template, round(score, 4)))
+        return sorted(matches, key=lambda m: m.score, reverse=True)
+
+
+def _searchable_texts(template: SolutionTemplate) -> list[str]:
+    parameters = ' '.join(f'{name.replace("_", " ")} {description}' for name, description in template.parameters.items())
+    return [f'{template.description}\n{parameters}', *template.examples]
+
+def _same_api(a: str, b: str) -> bool:
+    return a.strip().lower() == b.strip().lower()
+
+
+class _BlockDumper(yaml.SafeDumper):
+    pass
+
+def _represent_str(dumper: yaml.SafeDumper, value: str):
+    # code and long descriptions stay readable in the file
+    return dumper.represent_scalar('tag:yaml.org,2002:str', value, style='|' if '\n' in value else None)
+
+_BlockDumper.add_representer(str, _represent_str)
+
+
+# --- answering drafter requests --- #
+
+WRITE_CODE_PREFIX = 'WRITE_CODE: '
+
+
+class _PrebakedDrafter:
+    """stands in for a drafter agent, answering requests to write code from the registry when a template matches"""
+    def __init__(self, agent: Any, api: str, registry: SolutionRegistry, threshold: float):
+        self._agent = agent
+        self._api = api
+        self._registry = registry
+        self._threshold = threshold
+
+    def message(self, message: str, stream: bool = False, **kwargs):
+        if message.startswith(WRITE_CODE_PREFIX):
+            goal = message[len(WRITE_CODE_PREFIX):]
+            match = self._registry.lookup(goal, self._api, self._threshold)
+            draft = match.template.as_draft(match.arguments, output_name(goal)) if match is not None else None
+            if draft is not None:
+                print(f'Using prebaked solution {match.template.name} (score {match.score})')
+                return f'```python\n{draft}\n```'
+            if match is not None:
+                print(f"Not using prebaked solution {match.template.name} (score {match.score}), since the task's values can't be filled in")
+        return self._agent.message(message, stream=stream, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._agent, name)
+
+
+def use_prebaked_solutions(adhoc_api: 'AdhocApi', registry: SolutionRegistry, threshold: float = 0.6):
+    """
+    Answer the drafter's write-code requests with a matching prebaked solution, instead of sending them to the drafter.
+    Meant to be applied after any other drafter instrumentation (e.g. record/replay), so a match skips that too
+    """
+    current = adhoc_api._get_agent
+    inner = getattr(current, '_prebaked_inner', current)
+
+    def get_agent(api: str):
+        return _PrebakedDrafter(inner(api), api, registry, threshold)
+
+    get_agent._prebaked_inner = inner
+    # so re-instrumenting for the next trial (see `instrument_adhoc_api`) doesn't end up wrapping this
+    get_agent._original = getattr(inner, '_original', inner)
+    adhoc_api._get_agent = get_agent
+
+
+def registry_from_env() -> SolutionRegistry|None:
+    """the registry a parent process asked trials to use (see `set_registry`), if any"""
+    path = os.environ.get(REGISTRY_ENV_VAR)
+    return SolutionRegistry(Path(path)) if path else None
+
+def set_registry(path: Path|str):
+    """use the given registry to answer drafter requests in this process and any child processes"""
+    os.environ[REGISTRY_ENV_VAR] = str(Path(path).resolve())
+
+
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='show which prebaked solutions match a query')
+    parser.add_argument('query')
+    parser.add_argument('--registry', type=Path, default=default_registry_path)
+    parser.add_argument('--api', default=None, help='only consider templates for this API')
+    parser.add_argument('-k', type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.time()
+    registry = SolutionRegistry(args.registry)
+    loaded = time.time()
+    matches = registry.search(args.query, args.api, args.k)
+    searched = time.time()
+    for match in matches:
+        print(f'{match.score:.3f}  {match.template.name} ({match.template.api}): {match.template.description.strip()}')
+    print(f'{len(registry)} templates, loaded in {(loaded - start)*1000:.1f}ms, searched in {(searched - loaded)*1000:.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Run the whole matrix of trial cases × agent models × trial counts as a single sweep
+
+Trials from every cell of the matrix are interleaved (trial 0 of every cell, then trial 1, ...) and run concurrently
+in a shared pool of worker processes, as long as the providers each trial talks to (its agent's and its drafter's)
+have capacity left. Each cell gets its own workdir inside the sweep directory, laid out the same as a workdir from
+run_trials, so the analyzers can be pointed at it directly:
+    sweep_20250320_101500/
+        sweep.json                                  # the matrix, for resuming
+        gdc_trial_2__gpt-4o__100/trials.db, trial_0.csv, ...
+        cbio_trial_4b__gpt-4o__100/...
+
+A sweep that was interrupted (or crashed) picks up where it left off. Trials that never finished are re-run from scratch:
+    python -m experiments.sweep --cases gdc_trial_2 gdc_trial_3a cbio_trial_4b --agent-models gpt-4o o3-mini --trials 100 --workers 8
+    python -m experiments.sweep --resume sweep_20250320_101500 --workers 8
+
+With --score, each trial is scored in the background as it finishes (see online_scoring). With --early-stop, each cell
+stops getting new trials once its success rate is known well enough (see early_stopping)
+"""
+
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from multiprocessing import get_context
+from collections import Counter, deque
+from dataclasses import dataclass, asdict, replace
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+import threading
+import argparse
+import shutil
+import json
+import time
+
+from adhoc_api.tool import APISpec, DrafterConfig
+from .run_trials import CASES, default_agent_model, query_suffix, run_isolated_trial, case_evaluator, online_scorer, format_scores
+from .early_stopping import StoppingRule, InOrderStopping, add_stopping_arguments, stopping_rule_from_args
+from .trial_store import TrialStore, store_filename
+from .http_replay import serve_http, default_store_dir
+from .llm_replay import llm_mode, default_trace_dir
+from .rate_limit import model_provider, set_rate_limits, default_limits_path
+from .utils import save_to_yaml
+
+if TYPE_CHECKING:
+    from .analysis_utils import Score
+
+
+manifest_filename = 'sweep.json'
+
+# statuses of trials that don't need to be run again when resuming
+done_statuses = {'finished', 'timeout', 'error', 'killed', 'imported'}
+
+# max trials talking to each provider at once. Every trial uses both its agent's and its drafter's provider
+default_concurrency = {'openai': 8, 'anthropic': 4, 'google': 4}
+
+
+@dataclass(frozen=True)
+class SweepCell:
+    case: str
+    agent_model: str
+    num_trials: int
+
+    @property
+    def name(self) -> str:
+        return f'{self.case}__{self.agent_model}__{self.num_trials}'
+
+
+class ProviderLimits:
+    """
+    Bookkeeping for how many trials are using each provider, and how many were started in the last minute
+
+    Args:
+        concurrency (dict[str, int]): max trials using each provider at once. Providers not listed are unlimited
+        starts_per_minute (dict[str, float]): max trials using each provider started in any 60 second window
+    """
+    def __init__(self, concurrency: dict[str, int], starts_per_minute: dict[str, float]|None = None):
+        for provider, limit in [*concurrency.items(), *(starts_per_minute or {}).items()]:
+            if limit <= 0:
+                raise ValueError(f'limit for {provider} must be positive, got {limit}')
+        self.concurrency = concurrency
+        self.starts_per_minute = starts_per_minute or {}
+        self.active: Counter[str] = Counter()
+        self.starts: dict[str, deque[float]] = {provider: deque() for provider in self.starts_per_minute}
+
+    def can_start(self, providers: set[str]) -> bool:
+        now = time.time()
+        for provider in providers:
+            if self.active[provider] >= self.concurrency.get(provider, float('inf')):
+                return False
+            if provider in self.starts:
+                starts = self.starts[provider]
+                while starts and starts[0] <= now - 60:
+                    starts.popleft()
+                if len(starts) >= self.starts_per_minute[provider]:
+                    return False
+        return True
+
+    def start(self, providers: set[str]):
+        for provider in providers:
+            self.active[provider] += 1
+            if provider in self.starts:
+                self.starts[provider].append(time.time())
+
+    def finish(self, providers: set[str]):
+        for provider in providers:
+            self.active[provider] -= 1
+
+
+class Sweep:
+    """
+    A matrix of trial configurations run together, with one workdir per cell
+
+    Args:
+        sweep_dir (Path): directory holding the workdir of each cell
+        cells (list[SweepCell]): the configurations to run
+        timeout_seconds (int): max seconds per trial
+        tool_timeout_seconds (float, optional): max seconds for a single python tool call
+    """
+    def __init__(self, sweep_dir: Path, cells: list[SweepCell], timeout_seconds: int = 600, tool_timeout_seconds: float|None = None):
+        self.sweep_dir = Path(sweep_dir).resolve()
+        self.cells = cells
+        self.timeout_seconds = timeout_seconds
+        self.tool_timeout_seconds = tool_timeout_seconds
+        unknown = {cell.case for cell in cells} - CASES.keys()
+        if unknown:
+            raise ValueError(f'unknown cases: {", ".join(sorted(unknown))}')
+        self.cases: dict[str, tuple[APISpec, DrafterConfig, str]] = {case: CASES[case]() for case in {cell.case for cell in cells}}
+
+    @classmethod
+    def resume(cls, sweep_dir: Path) -> 'Sweep':
+        """the sweep previously started in `sweep_dir`"""
+        manifest = json.loads((Path(sweep_dir)/manifest_filename).read_text())
+        cells = [SweepCell(**cell) for cell in manifest['cells']]
+        return cls(sweep_dir, cells, manifest['timeout_seconds'], manifest['tool_timeout_seconds'])
+
+    def save_manifest(self):
+        self.sweep_dir.mkdir(parents=True, exist_ok=True)
+        manifest = {'cells': [asdict(cell) for cell in self.cells], 'timeout_seconds': self.timeout_seconds, 'tool_timeout_seconds': self.tool_timeout_seconds}
+        (self.sweep_dir/manifest_filename).write_text(json.dumps(manifest, indent=4))
+
+    def cell_dir(self, cell: SweepCell) -> Path:
+        return self.sweep_dir/cell.name
+
+    def providers(self, cell: SweepCell) -> set[str]:
+        _, drafter_config, _ = self.cases[cell.case]
+        drafter_configs = drafter_config if isinstance(drafter_config, list) else [drafter_config]
+        return {model_provider(cell.agent_model), *(config['provider'] for config in drafter_configs)}
+
+    def pending_trials(self) -> list[tuple[SweepCell, int]]:
+        """
+        Every trial that still has to run, interleaved across cells. Anything recorded by a trial that didn't finish
+        (e.g. the sweep was killed in the middle of it) is thrown away so it starts over cleanly
+        """
+        pending = []
+        for cell in self.cells:
+            cell_dir = self.cell_dir(cell)
+            cell_dir.mkdir(parents=True, exist_ok=True)
+            store = TrialStore(cell_dir/store_filename)
+            statuses = store.statuses()
+            for i in range(cell.num_trials):
+                name = f'trial_{i}'
+                if statuses.get(name, None) in done_statuses:
+                    continue
+                if name in statuses:
+                    store.discard_trial(name)
+                    (cell_dir/f'{name}.csv').unlink(missing_ok=True)
+                    # including the csv a killed attempt left in its own directory, which would otherwise be taken as the new attempt's
+                    shutil.rmtree(cell_dir/'trials'/name, ignore_errors=True)
+                pending.append((i, cell))
+        return [(cell, i) for i, cell in sorted(pending, key=lambda item: (item[0], self.cells.index(item[1])))]
+
+    def stopping_rules(self, stopping: StoppingRule) -> dict[SweepCell, StoppingRule]:
+        """a fresh copy of the rule for each cell, already updated with any trials done before resuming"""
+        from .online_scoring import score_and_save
+        rules = {}
+        for cell in self.cells:
+            rules[cell] = rule = replace(stopping)
+            store = TrialStore(self.cell_dir(cell)/store_filename)
+            evaluate = case_evaluator(cell.case, self.cell_dir(cell))
+            for name, status in store.statuses().items():
+                if status in done_statuses and rule.decision() is None:
+                    # only trials that weren't scored while the sweep was running are evaluated again
+                    score = score_and_save(evaluate, self.cell_dir(cell), name)
+                    if score is not None:
+                        rule.update(score.success)
+        return rules
+
+    def run(self, workers: int, limits: ProviderLimits, stopping: StoppingRule|None = None, score: bool = False):
+        """
+        Run every pending trial. With `score` (implied by `stopping`), each trial is scored in the background as it
+        finishes, and with `stopping` a cell stops getting new trials once its scores satisfy the rule
+        """
+        self.save_manifest()
+        pending = self.pending_trials()
+        total = sum(cell.num_trials for cell in self.cells)
+        progress = Progress(total=total, done=total - len(pending), remaining=len(pending))
+        print(f'Sweep of {len(self.cells)} configurations in {self.sweep_dir}: {progress.done}/{total} trials already done')
+
+        rules = self.stopping_rules(stopping) if stopping is not None else {}
+        # trials of a cell finish out of order (quick failures first), so each rule is fed their outcomes in trial order
+        ordered = {cell: InOrderStopping(rule, [i for c, i in pending if c == cell]) for cell, rule in rules.items()}
+        # cells are stopped from the scoring thread, while the main thread is starting trials
+        lock = threading.Lock()
+        def stop_cell(cell: SweepCell, reason: str):
+            with lock:
+                dropped = [item for item in pending if item[0] == cell]
+                pending[:] = [item for item in pending if item[0] != cell]
+                progress.skip(len(dropped))
+            skipped = f'. Skipping its {len(dropped)} remaining trials' if dropped else ''
+            print(f'Stopping {cell.name} early: {reason}. {rules[cell].summary()}{skipped}')
+        for cell, rule in rules.items():
+            if (reason := rule.decision()) is not None:
+                stop_cell(cell, reason)
+
+        scorer = online_scorer() if score or rules else None
+        scored: list[Future] = []
+        def on_score(cell: SweepCell, i: int, score: 'Score|None'):
+            if cell in ordered and (reason := ordered[cell].update(i, score.success if score is not None else None)) is not None:
+                stop_cell(cell, reason)
+
+        # spawn (rather than fork) so every worker starts with a clean interpreter
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            running: dict[Future, tuple[SweepCell, int]] = {}
+
+            def report(future: Future):
+                cell, i = running.pop(future)
+                limits.finish(self.providers(cell))
+                try:
+                    status = future.result()
+                except Exception as e:
+                    # the worker itself died, so record that against the trial
+                    status = 'error'
+                    store = TrialStore(self.cell_dir(cell)/store_filename)
+                    store.add_chunk(f'trial_{i}', f"Error: {e}", 'error')
+                    store.finish_trial(f'trial_{i}', status)
+                with lock:
+                    progress.update()
+                print(f'{progress} | {cell.name} trial_{i}: {status} | {len(running)} running')
+
+                if scorer is not None and status != 'interrupted':
+                    scored.append(scorer.submit(
+                        case_evaluator(cell.case, self.cell_dir(cell)), self.cell_dir(cell), f'trial_{i}',
+                        lambda name, score: on_score(cell, i, score)
+                    ))
+                else:
+                    on_score(cell, i, None)
+
+            try:
+                while pending or running:
+                    # start whatever the limits allow, skipping over (rather than waiting behind) trials that can't start yet
+                    with lock:
+                        for cell, i in [*pending]:
+                            if len(running) >= workers:
+                                break
+                            providers = self.providers(cell)
+                            if not limits.can_start(providers):
+                                continue
+                            limits.start(providers)
+                            pending.remove((cell, i))
+                            api, drafter_config, query_base = self.cases[cell.case]
+                            query = (query_base + query_suffix).format(name=f'trial_{i}.csv')
+                            future = pool.submit(
+                                run_isolated_trial, i, query, api, drafter_config, self.timeout_seconds,
+                                self.tool_timeout_seconds, cell.agent_model, self.cell_dir(cell)
+                            )
+                            running[future] = (cell, i)
+
+                    if not running:
+                        # waiting on a start rate limit
+                        time.sleep(1)
+                        continue
+                    done, _ = wait([*running], timeout=5, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report(future)
+
+            # on ctrl-c, drop any trials that haven't started, but let the running ones record what they captured
+            except KeyboardInterrupt:
+                print(f"Interrupted. Waiting for {len(running)} running trials to finish (ctrl-c again to exit immediately). Resume with --resume {self.sweep_dir}")
+                with lock:
+                    pending.clear()
+                while running:
+                    done, _ = wait([*running], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        report(future)
+
+        if scorer is not None:
+            scorer.close()
+            print(format_scores(scored))
+        self.summarize(rules)
+
+    def summarize(self, rules: dict[SweepCell, StoppingRule]|None = None):
+        """save the human readable copy of each cell's trials, and print how they went"""
+        rules = rules or {}
+        for cell in self.cells:
+            cell_dir = self.cell_dir(cell)
+            store = TrialStore(cell_dir/store_filename)
+            save_to_yaml(store.code(), cell_dir/'captured_code.yaml')
+            counts = Counter(store.statuses().values())
+            scored = f' | {rules[cell].summary()}' if cell in rules else ''
+            print(f'{cell.name}: ' + ', '.join(f'{count} {status}' for status, count in counts.most_common()) + scored)
+
+
+@dataclass
+class Progress:
+    total: int
+    done: int
+    remaining: int
+
+    def __post_init__(self):
+        self.started_at = time.time()
+        self.completed = 0 # in this session, which is what the ETA is based on
+
+    def update(self):
+        self.done += 1
+        self.remaining -= 1
+        self.completed += 1
+
+    def skip(self, n: int):
+        """trials that won't be run after all"""
+        self.total -= n
+        self.remaining -= n
+
+    def __str__(self) -> str:
+        elapsed = time.time() - self.started_at
+        eta = format_duration(elapsed / self.completed * self.remaining) if self.completed else '?'
+        return f'[{self.done}/{self.total}] {format_duration(elapsed)} elapsed, ETA {eta}'
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m' if hours else f'{minutes}m{seconds:02d}s'
+
+
+def parse_limits(values: list[str]) -> dict[str, float]:
+    """parse limits given as provider=number"""
+    limits = {}
+    for value in values:
+        provider, _, limit = value.partition('=')
+        try:
+            limits[provider] = float(limit)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'expected provider=number, got {value!r}') from None
+    return limits
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run every combination of trial case, agent model and trial count, resuming an earlier sweep if asked')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=[*CASES], help='trial cases to run (default: all)')
+    parser.add_argument('--agent-models', nargs='+', default=[default_agent_model], help='models for the ReAct agent')
+    parser.add_argument('--trials', nargs='+', type=int, default=[100], help='number of trials per configuration')
+    parser.add_argument('--resume', type=Path, default=None, help='continue the sweep in this directory (its configurations are used instead of --cases/--agent-models/--trials)')
+    parser.add_argument('--workers', type=int, default=4, help='max trials running at once across the whole sweep')
+    parser.add_argument('--concurrency', nargs='*', default=[], help='max concurrent trials per provider, e.g. openai=8 google=2 (defaults: ' + ', '.join(f'{p}={n}' for p, n in default_concurrency.items()) + ')')
+    parser.add_argument('--starts-per-minute', nargs='*', default=[], help='max trials started per minute per provider, e.g. anthropic=10')
+    parser.add_argument('--rate-limits', default=default_limits_path, help="database of per-provider/host request rate limits shared by every process (see experiments.rate_limit), or 'off'")
+    parser.add_argument('--score', action='store_true', help='score each trial in the background as soon as it finishes, saving the score for the analysis (implied by --early-stop)')
+    add_stopping_arguments(parser)
+    parser.add_argument('--timeout', type=int, default=600, help='max seconds per trial')
+    parser.add_argument('--tool-timeout', type=float, default=None, help='max seconds for a single python tool call')
+    parser.add_argument('--http', choices=['live', 'record', 'replay'], default='live', help='talk to GDC/cBioPortal directly, or record/replay responses through a local server')
+    parser.add_argument('--http-store', type=Path, default=default_store_dir, help='directory of recorded GDC/cBioPortal responses')
+    parser.add_argument('--llm', choices=['live', 'record', 'replay'], default='live', help='call the agent/drafter LLMs directly, or record/replay their responses')
+    parser.add_argument('--llm-traces', type=Path, default=default_trace_dir, help='directory of recorded LLM calls')
+    args = parser.parse_args()
+
+    if args.resume is not None:
+        sweep = Sweep.resume(args.resume)
+    else:
+        cells = [SweepCell(case, model, n) for case in args.cases for model in args.agent_models for n in args.trials]
+        sweep_dir = Path(f'sweep_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
+        sweep = Sweep(sweep_dir, cells, args.timeout, args.tool_timeout)
+
+    concurrency = {**default_concurrency, **{provider: int(n) for provider, n in parse_limits(args.concurrency).items()}}
+    limits = ProviderLimits(concurrency, parse_limits(args.starts_per_minute))
+    set_rate_limits(args.rate_limits)
+    with serve_http(args.http, args.http_store), llm_mode(args.llm, args.llm_traces):
+        sweep.run(args.workers, limits, stopping_rule_from_args(args), score=args.score)
+
+
+if __name__ == '__main__':
+    main()
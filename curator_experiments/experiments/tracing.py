@@ -0,0 +1,234 @@
+"""
+Timing spans for everything a trial spends its time on
+
+While a trial runs, a span is recorded for each agent step (LLM call, with token counts where the provider reports
+them), tool call, drafter call and HTTP request. Spans are kept in the workdir's trial store alongside the trial,
+and can be exported for viewing in chrome://tracing / https://ui.perfetto.dev, or as JSONL for other tools:
+    python -m experiments.tracing ../workdir_20250311_125333 --chrome trace.json --jsonl spans.jsonl
+
+Drafter calls happen inside the AdhocApi tool calls, and HTTP requests usually inside python tool calls, so those
+spans overlap the tool spans they were made from.
+"""
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, TYPE_CHECKING
+import threading
+import json
+import time
+
+from .trial_store import Span, TrialStore, open_trial_store
+
+if TYPE_CHECKING:
+    from archytas.react import ReActAgent
+    from adhoc_api.tool import AdhocApi
+
+
+# in the order they're shown in breakdowns and traces
+categories = ('agent', 'tool', 'drafter', 'http')
+
+
+class Tracer:
+    """collects the spans of a single trial"""
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, category: str, **attributes) -> Generator[dict, None, None]:
+        """time the body of the context. Yields the span's attributes, so more can be added (e.g. token counts) once known"""
+        start = time.time()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes['error'] = type(e).__name__
+            raise
+        finally:
+            with self._lock:
+                self.spans.append(Span(name, category, start, time.time(), attributes))
+
+
+# trials in a process run one at a time, and anything they do (including in threads they start) belongs to the current one
+_current: Tracer|None = None
+
+@contextmanager
+def tracing(tracer: Tracer) -> Generator[Tracer, None, None]:
+    """make `tracer` the one that instrumented code records to for the duration of the context"""
+    global _current
+    previous, _current = _current, tracer
+    try:
+        yield tracer
+    finally:
+        _current = previous
+
+@contextmanager
+def span(name: str, category: str, **attributes) -> Generator[dict, None, None]:
+    """record a span to the current tracer, if there is one"""
+    if _current is None:
+        yield attributes
+        return
+    with _current.span(name, category, **attributes) as attributes:
+        yield attributes
+
+
+# --- instrumentation for the clients the trials use --- #
+
+class _TracedTool:
+    """stands in for one of the agent's tools, timing each call"""
+    def __init__(self, name: str, tool):
+        self._name = name
+        self._tool = tool
+        self.__self__ = getattr(tool, '__self__', None)
+
+    async def run(self, *args, **kwargs):
+        with span(self._name, 'tool'):
+            return await self._tool.run(*args, **kwargs)
+
+    def __getattr__(self, name: str):
+        return getattr(self._tool, name)
+
+
+def trace_agent(agent: 'ReActAgent'):
+    """record a span for every model call and tool call the ReAct agent makes"""
+    original_ainvoke = agent.model.ainvoke
+
+    async def ainvoke(input, **kwargs):
+        with span('agent step', 'agent', messages=len(input)) as attributes:
+            result = await original_ainvoke(input, **kwargs)
+            usage = getattr(result, 'usage_metadata', None)
+            if usage:
+                attributes.update(input_tokens=usage.get('input_tokens'), output_tokens=usage.get('output_tokens'))
+            return result
+
+    agent.model.ainvoke = ainvoke
+    agent.tools = {name: _TracedTool(name, tool) for name, tool in agent.tools.items()}
+
+
+def trace_drafters(adhoc_api: 'AdhocApi'):
+    """record a span for every message sent to the drafter agents of an AdhocApi instance"""
+    original_get_agent = adhoc_api._get_agent
+    traced = set()
+
+    def get_agent(api: str):
+        agent = original_get_agent(api)
+        if id(agent) not in traced:
+            traced.add(id(agent))
+            original_message = agent.message
+
+            def message(message: str, stream: bool = False, **kwargs):
+                # the drafters don't report token usage, so sizes are the best there is
+                with span(f'drafter {api}', 'drafter', model=getattr(agent, 'model', None), prompt_chars=len(message)) as attributes:
+                    response = original_message(message, stream=stream, **kwargs)
+                    if isinstance(response, str):
+                        attributes['response_chars'] = len(response)
+                    return response
+
+            agent.message = message
+        return agent
+
+    adhoc_api._get_agent = get_agent
+
+
+def trace_requests():
+    """record a span for every request made with the `requests` library (patched once per process)"""
+    import requests
+    from urllib.parse import urlsplit
+
+    global _requests_traced
+    if _requests_traced:
+        return
+    _requests_traced = True
+    original_send = requests.Session.send
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        with span(f'{request.method} {parts.hostname}{parts.path}', 'http', url=request.url) as attributes:
+            response = original_send(self, request, **kwargs)
+            # not len(response.content), which would read the whole body of a streamed response here
+            attributes.update(status=response.status_code, response_bytes=response.headers.get('Content-Length'))
+            return response
+
+    requests.Session.send = send
+
+_requests_traced = False
+
+
+# --- summaries and exports --- #
+
+def latency_breakdown(spans: list[Span]) -> dict[str, tuple[float, int]]:
+    """total seconds and number of spans per category, plus the trial's total (from its 'trial' span, if any)"""
+    breakdown = {category: (0.0, 0) for category in categories}
+    for s in spans:
+        seconds, count = breakdown.get(s.category, (0.0, 0))
+        breakdown[s.category] = (seconds + s.duration, count + 1)
+    return breakdown
+
+
+def format_breakdown(spans: list[Span]) -> str:
+    breakdown = latency_breakdown(spans)
+    parts = []
+    if breakdown.get('trial', (0, 0))[1]:
+        parts.append(f'total {breakdown["trial"][0]:.1f}s')
+    for category in categories:
+        seconds, count = breakdown[category]
+        if count:
+            parts.append(f'{category} {seconds:.1f}s ({count})')
+    tokens = sum((s.attributes.get('input_tokens') or 0) + (s.attributes.get('output_tokens') or 0) for s in spans if s.category == 'agent')
+    if tokens:
+        parts.append(f'{tokens} agent tokens')
+    return ' | '.join(parts) if parts else 'no spans recorded'
+
+
+def to_chrome_trace(spans_by_trial: dict[str, list[Span]]) -> dict:
+    """spans in the Chrome trace event format. Each trial is shown as a process, with a row per category"""
+    events = []
+    tids = {category: i for i, category in enumerate(('trial', *categories))}
+    for pid, (trial, spans) in enumerate(spans_by_trial.items()):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': trial}})
+        for category, tid in tids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': category}})
+        for s in spans:
+            events.append({
+                'name': s.name, 'cat': s.category, 'ph': 'X', 'pid': pid, 'tid': tids.get(s.category, len(tids)),
+                'ts': s.start * 1e6, 'dur': s.duration * 1e6, 'args': s.attributes,
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_jsonl(spans_by_trial: dict[str, list[Span]], path: Path):
+    with open(path, 'w') as f:
+        for trial, spans in spans_by_trial.items():
+            for s in spans:
+                f.write(json.dumps({'trial': trial, 'name': s.name, 'category': s.category, 'start': s.start, 'end': s.end, 'duration': s.duration, **s.attributes}, default=str) + '\n')
+
+
+def trial_latencies(store: TrialStore) -> dict[str, dict[str, float]]:
+    """seconds spent per category (and in total) for every trial that has spans"""
+    return {
+        trial: {category: seconds for category, (seconds, _) in latency_breakdown(spans).items()}
+        for trial, spans in store.spans().items()
+    }
+
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='export the timing spans recorded for the trials in a workdir')
+    parser.add_argument('workdir', type=Path)
+    parser.add_argument('--chrome', type=Path, default=None, help='write a Chrome trace (for chrome://tracing or ui.perfetto.dev) here')
+    parser.add_argument('--jsonl', type=Path, default=None, help='write every span as a line of JSON here')
+    args = parser.parse_args()
+
+    spans_by_trial = open_trial_store(args.workdir).spans()
+    for trial, spans in spans_by_trial.items():
+        print(f'{trial}: {format_breakdown(spans)}')
+    if args.chrome is not None:
+        args.chrome.write_text(json.dumps(to_chrome_trace(spans_by_trial), default=str))
+        print(f'Wrote Chrome trace to {args.chrome}')
+    if args.jsonl is not None:
+        write_jsonl(spans_by_trial, args.jsonl)
+        print(f'Wrote spans to {args.jsonl}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Append-only store of trial records, kept in an SQLite database (trials.db) in the workdir
+
+Every code chunk (and error) a trial produces is written as it happens, along with timestamps and trial metadata.
+SQLite in WAL mode lets several trial processes write to the same store at once while the analyzers read from it,
+and a crash mid-trial can't corrupt anything that was already recorded.
+
+Older workdirs only have captured_code.yaml. `open_trial_store` imports it into a new store the first time the
+workdir is opened.
+"""
+
+from dataclasses import dataclass, field
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator, Literal
+import threading
+import sqlite3
+import json
+import time
+import yaml
+
+
+store_filename = 'trials.db'
+
+ChunkKind = Literal['code', 'error']
+
+@dataclass
+class TrialRecord:
+    name: str
+    code_chunks: list[str] = field(default_factory=list) # code and error chunks in the order they happened (same as captured_code.yaml)
+    kinds: list[ChunkKind] = field(default_factory=list)
+    status: str|None = None
+    variant: str|None = None
+    query: str|None = None
+    started_at: float|None = None
+    finished_at: float|None = None
+    metadata: dict = field(default_factory=dict)
+
+
+@dataclass
+class Span:
+    """a timed operation within a trial, e.g. an agent step or an HTTP request (see experiments.tracing)"""
+    name: str
+    category: str
+    start: float
+    end: float
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS trials (
+    name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    variant TEXT,
+    query TEXT,
+    status TEXT,
+    started_at REAL,
+    finished_at REAL,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    trial TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (trial, seq)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    trial TEXT NOT NULL,
+    evaluator TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    score TEXT NOT NULL,
+    evaluated_at REAL NOT NULL,
+    PRIMARY KEY (trial, evaluator)
+);
+CREATE TABLE IF NOT EXISTS spans (
+    trial TEXT NOT NULL,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    attributes TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS spans_trial ON spans (trial, start);
+'''
+
+
+class TrialStore:
+    """
+    Trial records for a single run. Safe to use from multiple threads and processes at once.
+
+    Args:
+        path (Path): the database file. Created if it doesn't exist
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path).resolve()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(_schema)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads, so each thread gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def start_trial(self, name: str, *, variant: str|None = None, query: str|None = None, metadata: dict|None = None):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                '''INSERT INTO trials (name, position, variant, query, status, started_at, metadata)
+                   VALUES (?, (SELECT COALESCE(MAX(position) + 1, 0) FROM trials), ?, ?, 'running', ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET
+                       variant=COALESCE(excluded.variant, variant),
+                       query=COALESCE(excluded.query, query),
+                       status='running',
+                       metadata=CASE WHEN excluded.metadata = '{}' THEN metadata ELSE excluded.metadata END''',
+                (name, variant, query, time.time(), json.dumps(metadata or {}))
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def add_chunk(self, name: str, text: str, kind: ChunkKind = 'code'):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # chunks for trials that were never started still get recorded
+            conn.execute(
+                '''INSERT OR IGNORE INTO trials (name, position, started_at)
+                   VALUES (?, (SELECT COALESCE(MAX(position) + 1, 0) FROM trials), ?)''',
+                (name, time.time())
+            )
+            conn.execute(
+                '''INSERT INTO chunks (trial, seq, kind, text, created_at)
+                   VALUES (?, (SELECT COALESCE(MAX(seq) + 1, 0) FROM chunks WHERE trial = ?), ?, ?, ?)''',
+                (name, name, kind, text, time.time())
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def finish_trial(self, name: str, status: str = 'finished'):
+        self._connection().execute('UPDATE trials SET status = ?, finished_at = ? WHERE name = ?', (status, time.time(), name))
+
+    def discard_trial(self, name: str):
+        """remove a trial and everything it recorded, e.g. to re-run it from scratch"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for table, column in (('chunks', 'trial'), ('scores', 'trial'), ('spans', 'trial'), ('trials', 'name')):
+                conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (name,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def statuses(self) -> dict[str, str|None]:
+        """map from trial name to its status, without loading any chunks"""
+        return dict(self._connection().execute('SELECT name, status FROM trials ORDER BY position'))
+
+    def names(self) -> list[str]:
+        return [name for name, in self._connection().execute('SELECT name FROM trials ORDER BY position')]
+
+    def __contains__(self, name: str) -> bool:
+        return self._connection().execute('SELECT 1 FROM trials WHERE name = ?', (name,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM trials').fetchone()[0]
+
+    def get(self, name: str) -> TrialRecord|None:
+        """random access to a single trial by name"""
+        records = [*self._iter_records('WHERE t.name = ?', (name,))]
+        return records[0] if records else None
+
+    def __iter__(self) -> Iterator[TrialRecord]:
+        """stream every trial, in the order they were started"""
+        return self._iter_records()
+
+    def _iter_records(self, where: str = '', params: tuple = ()) -> Iterator[TrialRecord]:
+        rows = self._connection().execute(
+            f'''SELECT t.name, t.variant, t.query, t.status, t.started_at, t.finished_at, t.metadata, c.kind, c.text
+                FROM trials t LEFT JOIN chunks c ON c.trial = t.name
+                {where}
+                ORDER BY t.position, c.seq''',
+            params
+        )
+        for name, group in groupby(rows, key=lambda row: row[0]):
+            group = [*group]
+            _, variant, query, status, started_at, finished_at, metadata, _, _ = group[0]
+            record = TrialRecord(name, status=status, variant=variant, query=query, started_at=started_at, finished_at=finished_at, metadata=json.loads(metadata))
+            for *_, kind, text in group:
+                if kind is not None:
+                    record.code_chunks.append(text)
+                    record.kinds.append(kind)
+            yield record
+
+    def code(self) -> dict[str, list[str]]:
+        """map from trial name to its code chunks, i.e. the contents of captured_code.yaml"""
+        return {record.name: record.code_chunks for record in self}
+
+    def get_score(self, name: str, evaluator: str) -> tuple[str, dict]|None:
+        """(content hash, score fields) last saved for a trial by the given evaluator, if any"""
+        row = self._connection().execute(
+            'SELECT content_hash, score FROM scores WHERE trial = ? AND evaluator = ?', (name, evaluator)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def put_score(self, name: str, evaluator: str, content_hash: str, score: dict):
+        self._connection().execute(
+            '''INSERT INTO scores (trial, evaluator, content_hash, score, evaluated_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(trial, evaluator) DO UPDATE SET
+                   content_hash=excluded.content_hash, score=excluded.score, evaluated_at=excluded.evaluated_at''',
+            (name, evaluator, content_hash, json.dumps(score), time.time())
+        )
+
+    def scores(self, evaluator: str) -> dict[str, dict]:
+        """every saved score from the given evaluator, regardless of whether the trial has changed since"""
+        rows = self._connection().execute('SELECT trial, score FROM scores WHERE evaluator = ?', (evaluator,))
+        return {name: json.loads(score) for name, score in rows}
+
+    def scored_since(self, evaluator: str, since: float) -> list[str]:
+        """trials whose score from the given evaluator was saved at or after the time `since`"""
+        rows = self._connection().execute('SELECT trial FROM scores WHERE evaluator = ? AND evaluated_at >= ?', (evaluator, since))
+        return [name for name, in rows]
+
+    def add_spans(self, name: str, spans: list[Span]):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO spans (trial, name, category, start, end, attributes) VALUES (?, ?, ?, ?, ?, ?)',
+                [(name, span.name, span.category, span.start, span.end, json.dumps(span.attributes, default=str)) for span in spans]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def spans(self, name: str|None = None) -> dict[str, list[Span]]:
+        """map from trial name to its spans in the order they started (for every trial, or just the given one)"""
+        where, params = ('WHERE s.trial = ?', (name,)) if name is not None else ('', ())
+        rows = self._connection().execute(
+            f'''SELECT s.trial, s.name, s.category, s.start, s.end, s.attributes
+                FROM spans s JOIN trials t ON t.name = s.trial
+                {where}
+                ORDER BY t.position, s.start''',
+            params
+        )
+        return {
+            trial: [Span(span_name, category, start, end, json.loads(attributes)) for _, span_name, category, start, end, attributes in group]
+            for trial, group in groupby(rows, key=lambda row: row[0])
+        }
+
+    def import_yaml(self, path: Path) -> int:
+        """import the trials from a captured_code.yaml file. Returns the number of trials imported"""
+        trials = load_captured_code(path)
+        for name, code_chunks in trials.items():
+            if name in self:
+                continue
+            self.start_trial(name, metadata={'imported_from': str(path)})
+            for chunk in code_chunks:
+                self.add_chunk(name, chunk, 'error' if chunk.startswith('Error: ') else 'code')
+            self.finish_trial(name, 'imported')
+        return len(trials)
+
+
+def load_captured_code(path: Path) -> dict[str, list[str]]:
+    """read a captured_code.yaml file, recovering as much as possible if an interrupted append left it malformed"""
+    text = Path(path).read_text()
+    try:
+        trials = yaml.safe_load(text) or {}
+    except yaml.YAMLError as e:
+        print(f'WARNING: {path} is not valid yaml ({e.__class__.__name__}). Parsing it line by line instead')
+        trials = _parse_captured_code(text)
+    # replace any NoneTypes with []
+    return {k: v if v is not None else [] for k, v in trials.items()}
+
+
+def _parse_captured_code(text: str) -> dict[str, list[str] | None]:
+    """parser for the exact layout written by utils.save_to_yaml"""
+    trials: dict[str, list[str] | None] = {}
+    chunk: list[str] | None = None
+    def flush():
+        if chunk is not None:
+            code = '\n'.join(chunk).rstrip('\n')
+            trials[trial].append(code + '\n' if code else '')
+    trial = None
+    for line in text.splitlines():
+        if line and not line.startswith(' ') and line.endswith(':'):
+            flush()
+            trial, chunk = line[:-1], None
+            trials[trial] = []
+        elif trial is not None and line == '  - |':
+            flush()
+            chunk = []
+        elif chunk is not None and (line.startswith('    ') or not line.strip()):
+            chunk.append(line[4:])
+    flush()
+    return trials
+
+
+def open_trial_store(workdir: Path) -> TrialStore:
+    """open the trial store of a workdir, importing its captured_code.yaml if it doesn't have a store yet"""
+    path = workdir/store_filename
+    yaml_path = workdir/'captured_code.yaml'
+    is_new = not path.exists()
+    store = TrialStore(path)
+    if is_new and yaml_path.exists():
+        n = store.import_yaml(yaml_path)
+        print(f'Imported {n} trials from {yaml_path} into {path}')
+    return store
@@ -11,9 +11,15 @@ class PythonTool:
     """
     Tool for running python code. If the user asks you to write code, you can run it here.
     """
-    def __init__(self, code_side_effect: Callable[[str], None]):
+    def __init__(self, code_side_effect: Callable[[str], None], timeout_seconds: float|None = None):
         self.tool = OriginalPythonTool(locals={'exit': python_tool_exit})
         self.side_effect = code_side_effect
+        self.timeout_seconds = timeout_seconds
+    def reset(self, code_side_effect: Callable[[str], None]|None = None):
+        """start over with a fresh python environment (e.g. for the next trial)"""
+        self.tool = OriginalPythonTool(locals={'exit': python_tool_exit})
+        if code_side_effect is not None:
+            self.side_effect = code_side_effect
     @tool()
     def run(self, code: str) -> str:
         """
@@ -29,40 +35,119 @@ class PythonTool:
             str: The stdout output of the code
         """
         self.side_effect(code)
-        return self.tool.run(code)
+        stdout, stderr = sys.stdout, sys.stderr
+
+        # per-call deadline. Report it to the agent as a regular tool error, but let any enclosing (trial) timeout through
+        deadline = None
+        try:
+            if self.timeout_seconds is None:
+                return self.tool.run(code)
+            with timeout(self.timeout_seconds, message='python tool call') as deadline:
+                return self.tool.run(code)
+        except TimeoutException as e:
+            if deadline is None or not deadline.expired:
+                raise
+            raise Exception(f"{e}. The code was stopped before it finished.")
+        finally:
+            # the underlying tool resets stdout/stderr to sys.__stdout__/sys.__stderr__ when the code finishes (and not
+            # at all if it was stopped), so put back whatever the caller had, e.g. a redirect_stdout
+            sys.stdout, sys.stderr = stdout, stderr
 
 
 
 # context manager for quitting if the process takes too long
+import signal
+import sys
 import threading
+import time
 from contextlib import contextmanager
-class TimeoutException(Exception): ...
+from dataclasses import dataclass
+# derived from BaseException so that the timeout can't be swallowed by `except Exception` in agent/tool code
+class TimeoutException(BaseException): ...
 def raise_timeout(seconds:float, message:str|None=None):
     msg = f"Operation timed out after {seconds} seconds"
     if message:
         msg += f" with message: {message}"
     raise TimeoutException(msg)
+@dataclass
+class Deadline:
+    seconds: float
+    expired: bool = False
 @contextmanager
 def timeout(seconds:float, *, message:str|None=None, verbose:bool=False):
     if verbose:
         print('creating new timeout')
-    timer = threading.Timer(interval=seconds, function=raise_timeout, args=(seconds, message))
-    timer.start()
+    deadline = Deadline(seconds)
+
+    # signals are only delivered to the main thread. Elsewhere fall back to a timer, which can't interrupt the caller
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'SIGALRM'):
+        timer = threading.Timer(interval=seconds, function=raise_timeout, args=(seconds, message))
+        timer.start()
+        try:
+            yield deadline
+        finally:
+            timer.cancel()
+        return
+
+    # if an enclosing timeout will go off first, leave it in charge
+    outer_remaining, _ = signal.getitimer(signal.ITIMER_REAL)
+    if outer_remaining and outer_remaining <= seconds:
+        yield deadline
+        return
+
+    def on_alarm(signum, frame):
+        deadline.expired = True
+        raise_timeout(seconds, message)
+
+    start = time.monotonic()
+    outer_handler = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
     try:
-        yield
+        yield deadline
     finally:
-        timer.cancel()
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, outer_handler)
+        # re-arm the enclosing timeout with whatever time it had left
+        if outer_remaining:
+            signal.setitimer(signal.ITIMER_REAL, max(outer_remaining - (time.monotonic() - start), 1e-3))
+
+
+# context manager for sending all output (including from C extensions and subprocesses) to a file
+import os
+from pathlib import Path
+@contextmanager
+def redirect_output(path: Path):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    with path.open('a') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
 
 
 from collections import defaultdict
 class CaptureCode:
-    def __init__(self):
+    def __init__(self, sink: Callable[[str, str, str], None]|None = None):
         self.i = 0
         self.code = defaultdict(list)
+        self.sink = sink # optionally record each chunk as it is captured: sink(trial_name, chunk, kind)
     def set_i(self, i):
         self.i = i
-    def __call__(self, code):
+    def __call__(self, code, kind='code'):
         self.code[f'trial_{self.i}'].append(code)
+        if self.sink is not None:
+            self.sink(f'trial_{self.i}', code, kind)
+    def error(self, e: BaseException):
+        self(f"Error: {e}", kind='error')
 
 
 
@@ -0,0 +1,9 @@
+"""
+Prebaked solutions: reusable, tested code for tasks that have already been solved (see `solved_tasks.py`), so the
+agent can call them instead of drafting the same requests again. e.g.
+
+```python
+from prebaked_solutions.gdc import save_gdc_query, all_of, equals, one_of
+save_gdc_query('ssm_occurrences', 'jak1.csv', filters=all_of(equals('case.disease_type', '*lymphoblastic leukemia*'), one_of('ssm.consequence.transcript.gene.symbol', ['JAK1'])))
+```
+"""
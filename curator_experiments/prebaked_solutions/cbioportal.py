@@ -0,0 +1,209 @@
+"""
+Fetching molecular data (e.g. expression z-scores) for a few genes across many cBioPortal studies
+
+The sample lists of all the studies are looked up at once, then `/molecular-profiles/{id}/molecular-data/fetch`
+requests go out over a shared connection pool, a bounded number at a time. Requests are made per chunk of samples,
+and the chunk size adapts as it goes: it grows while responses come back quickly and shrinks when they're slow or
+fail. Results are collected column by column and turned into the long and wide tables once at the end.
+
+Usage (the STAT5 expression across AML studies example):
+```python
+from prebaked_solutions.cbioportal import fetch_molecular_data
+
+profiles = {
+    'aml_target_gdc': 'aml_target_gdc_mrna_seq_tpm_Zscores',
+    'aml_ohsu_2022': 'aml_ohsu_2022_mrna_median_Zscores',
+}
+study_info = {
+    'aml_target_gdc': {'study_name': 'TARGET-AML (GDC)', 'measurement_type': 'TPM'},
+    'aml_ohsu_2022': {'study_name': 'OHSU AML 2022', 'measurement_type': 'RPKM'},
+}
+long, wide = fetch_molecular_data(profiles, {6776: 'STAT5A', 6777: 'STAT5B'}, study_info=study_info, value_name='zscore')
+long.to_csv('stat5_all_studies.csv', index=False)
+wide.to_csv('stat5_all_studies_wide.csv', index=False)
+```
+"""
+
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+import threading
+import time
+
+import pandas as pd
+import requests
+
+from .utils import pooled_session
+
+
+CBIOPORTAL_API_URL = 'https://www.cbioportal.org/api'
+
+
+class ChunkSizer:
+    """
+    How many samples to ask for per request. Moves toward the size that takes about `target_seconds`
+    (at most doubling each time), and halves when a request fails or times out.
+    """
+    def __init__(self, initial: int = 200, minimum: int = 10, maximum: int = 5000, target_seconds: float = 2.0):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self._lock = threading.Lock()
+
+    def succeeded(self, samples: int, seconds: float):
+        # only full sized chunks say anything about how big they could be (the last chunk of a study is usually smaller)
+        if samples < self.size:
+            return
+        ideal = samples * self.target_seconds / max(seconds, 1e-3)
+        with self._lock:
+            self.size = int(min(self.maximum, 2 * self.size, max(self.minimum, (self.size + ideal) / 2)))
+
+    def failed(self, samples: int):
+        with self._lock:
+            self.size = max(self.minimum, min(self.size, samples // 2))
+
+
+def get_sample_ids(
+    study_ids: list[str],
+    category: str = 'all_cases_with_mrna_rnaseq_data',
+    workers: int = 8,
+    session: requests.Session|None = None,
+) -> dict[str, list[str]]:
+    """
+    The ids of the samples in each study's sample list of the given category, looked up concurrently.
+    Studies without such a list are left out
+    """
+    session = session or pooled_session(workers)
+
+    def study_samples(study_id: str) -> list[str]|None:
+        response = session.get(f'{CBIOPORTAL_API_URL}/studies/{study_id}/sample-lists')
+        response.raise_for_status()
+        sample_list = next((sl['sampleListId'] for sl in response.json() if sl['category'] == category), None)
+        if sample_list is None:
+            return None
+        response = session.get(f'{CBIOPORTAL_API_URL}/sample-lists/{sample_list}/sample-ids')
+        response.raise_for_status()
+        return response.json()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cbioportal') as pool:
+        results = dict(zip(study_ids, pool.map(study_samples, study_ids)))
+    for study_id, samples in results.items():
+        if samples is None:
+            print(f'{study_id} has no {category} sample list')
+    return {study_id: samples for study_id, samples in results.items() if samples is not None}
+
+
+@dataclass
+class _Chunk:
+    study_id: str
+    sample_ids: list[str]
+    attempts: int = 0
+
+
+def _fetch_chunk(session: requests.Session, profile_id: str, entrez_ids: list[int], chunk: _Chunk, timeout: float) -> tuple[list[dict], float]:
+    start = time.time()
+    response = session.post(
+        f'{CBIOPORTAL_API_URL}/molecular-profiles/{profile_id}/molecular-data/fetch',
+        json={'sampleIds': chunk.sample_ids, 'entrezGeneIds': entrez_ids},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return response.json(), time.time() - start
+
+
+def fetch_molecular_data(
+    profiles: dict[str, str],
+    genes: dict[int, str],
+    sample_ids: dict[str, list[str]]|None = None,
+    sample_list_category: str = 'all_cases_with_mrna_rnaseq_data',
+    study_info: dict[str, dict[str, Any]]|None = None,
+    value_name: str = 'value',
+    workers: int = 8,
+    sizer: ChunkSizer|None = None,
+    max_attempts: int = 4,
+    timeout: float = 60,
+    session: requests.Session|None = None,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Fetch the values of some genes in a molecular profile of each study.
+    Returns the long table (one row per study/sample/gene) and the wide one (one row per sample, one column per gene).
+
+    Args:
+        profiles (dict[str, str]): study id -> molecular profile id, e.g. 'aml_ohsu_2022' -> 'aml_ohsu_2022_mrna_median_Zscores'
+        genes (dict[int, str]): entrez gene id -> gene symbol
+        sample_ids (dict[str, list[str]], optional): study id -> samples to fetch. Looked up with `get_sample_ids` if None
+        sample_list_category (str): which sample list to take the samples from, if `sample_ids` isn't given
+        study_info (dict[str, dict], optional): study id -> extra columns for that study's rows, e.g. {'study_name': ...}
+        value_name (str): name of the value column, e.g. 'zscore'
+        workers (int): number of requests in flight at once
+        sizer (ChunkSizer, optional): samples per request. Starts at 200 and adapts if None
+        max_attempts (int): how many times a chunk is tried (split smaller each time) before giving up
+        timeout (float): seconds to wait for each request
+        session (requests.Session, optional): session to reuse. A new pooled one if None
+    """
+    session = session or pooled_session(workers)
+    sizer = sizer or ChunkSizer()
+    study_info = study_info or {}
+    if sample_ids is None:
+        sample_ids = get_sample_ids(list(profiles), sample_list_category, workers, session)
+    entrez_ids = list(genes)
+
+    # samples are cut into chunks as they're sent, so each chunk uses the latest size
+    remaining = deque((study_id, samples) for study_id, samples in sample_ids.items() if study_id in profiles and samples)
+    retries: deque[_Chunk] = deque()
+    def next_chunk() -> _Chunk|None:
+        if retries:
+            return retries.popleft()
+        if not remaining:
+            return None
+        study_id, samples = remaining.popleft()
+        if len(samples) > sizer.size:
+            remaining.appendleft((study_id, samples[sizer.size:]))
+        return _Chunk(study_id, samples[:sizer.size])
+
+    columns: dict[str, list] = {'study_id': [], 'sample_id': [], 'entrez_gene_id': [], value_name: []}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cbioportal') as pool:
+        in_flight: dict[Future, _Chunk] = {}
+        def fill():
+            while len(in_flight) < workers and (chunk := next_chunk()) is not None:
+                in_flight[pool.submit(_fetch_chunk, session, profiles[chunk.study_id], entrez_ids, chunk, timeout)] = chunk
+        fill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    rows, seconds = future.result()
+                except (requests.Timeout, requests.ConnectionError, requests.exceptions.RetryError) as e:
+                    # most likely too big a request. Try again in halves
+                    chunk.attempts += 1
+                    if chunk.attempts >= max_attempts:
+                        raise
+                    sizer.failed(len(chunk.sample_ids))
+                    half = max(1, len(chunk.sample_ids) // 2)
+                    retries.extend(_Chunk(chunk.study_id, chunk.sample_ids[i:i+half], chunk.attempts) for i in range(0, len(chunk.sample_ids), half))
+                    print(f'Retrying {len(chunk.sample_ids)} samples of {chunk.study_id} in chunks of {half} after {type(e).__name__}')
+                    continue
+                sizer.succeeded(len(chunk.sample_ids), seconds)
+                for row in rows:
+                    columns['study_id'].append(chunk.study_id)
+                    columns['sample_id'].append(row['sampleId'])
+                    columns['entrez_gene_id'].append(row['entrezGeneId'])
+                    columns[value_name].append(row['value'])
+            fill()
+
+    long = pd.DataFrame(columns)
+    long[value_name] = pd.to_numeric(long[value_name], errors='coerce')
+    long.insert(1, 'gene', long.pop('entrez_gene_id').map(genes))
+    long = long.sort_values(['study_id', 'sample_id', 'gene'], kind='stable', ignore_index=True)
+    wide = long.pivot_table(index=['study_id', 'sample_id'], columns='gene', values=value_name).reset_index()
+    wide.columns.name = None
+
+    # study columns go in after pivoting, since studies without any info would be dropped from the pivot
+    info_columns = list(dict.fromkeys(name for info in study_info.values() for name in info))
+    for table in (long, wide):
+        for i, name in enumerate(info_columns):
+            table.insert(1 + i, name, table['study_id'].map(lambda study_id: study_info.get(study_id, {}).get(name)))
+    return long, wide
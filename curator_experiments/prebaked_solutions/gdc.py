@@ -0,0 +1,250 @@
+"""
+Querying the GDC API (https://api.gdc.cancer.gov) without hand-rolling the requests
+
+Every hit matching the filters is fetched, not just the first page: pages are requested a few at a time over one
+pooled session, in a stable sort order so concurrent pages can't overlap. Hits are flattened as they arrive (nested
+fields become dotted columns, as with `pandas.json_normalize`) and spilled to a temporary file, then written out in
+chunks, so memory stays flat however many hits there are.
+
+Usage:
+```python
+from prebaked_solutions.gdc import save_gdc_query, all_of, equals, one_of
+
+filters = all_of(
+    equals('case.disease_type', '*lymphoblastic leukemia*'),
+    one_of('ssm.consequence.transcript.gene.symbol', ['JAK1']),
+)
+fields = ['ssm_id', 'ssm.genomic_dna_change', 'case.submitter_id', 'case.case_id']
+save_gdc_query('ssm_occurrences', 'ssm_occurrences_JAK1.csv', filters=filters, fields=fields)
+
+# or to work with the hits directly
+for hit in iter_gdc_hits('cases', filters=equals('project.project_id', 'TARGET-AML'), fields=['case_id']):
+    ...
+```
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterator, Literal
+import importlib.util
+import tempfile
+import json
+
+import pandas as pd
+import requests
+
+from .utils import pooled_session
+
+
+GDC_API_URL = 'https://api.gdc.cancer.gov'
+
+# unique field of each endpoint, for a stable order across pages
+sort_fields = {
+    'cases': 'case_id',
+    'files': 'file_id',
+    'projects': 'project_id',
+    'annotations': 'annotation_id',
+    'genes': 'gene_id',
+    'ssms': 'ssm_id',
+    'ssm_occurrences': 'ssm_occurrence_id',
+    'cnvs': 'cnv_id',
+    'cnv_occurrences': 'cnv_occurrence_id',
+}
+
+
+# --- filters --- #
+
+def equals(field: str, value: Any) -> dict:
+    """`field` equals `value` (strings can use * wildcards, e.g. '*leukemia*')"""
+    return {'op': '=', 'content': {'field': field, 'value': value}}
+
+def one_of(field: str, values: list) -> dict:
+    """`field` is any of `values`"""
+    return {'op': 'in', 'content': {'field': field, 'value': list(values)}}
+
+def all_of(*filters: dict) -> dict:
+    return {'op': 'and', 'content': list(filters)}
+
+def any_of(*filters: dict) -> dict:
+    return {'op': 'or', 'content': list(filters)}
+
+
+# --- fetching --- #
+
+def _fetch_page(session: requests.Session, url: str, body: dict, offset: int, size: int) -> dict:
+    response = session.post(url, json={**body, 'from': offset, 'size': size})
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_gdc_hits(
+    endpoint: str,
+    filters: dict|None = None,
+    fields: list[str]|None = None,
+    expand: list[str]|None = None,
+    sort: str|None = None,
+    page_size: int = 1000,
+    workers: int = 4,
+    max_hits: int|None = None,
+    session: requests.Session|None = None,
+) -> Iterator[dict]:
+    """
+    Every hit of a query to a GDC endpoint (e.g. 'cases', 'ssm_occurrences'), in order.
+
+    Args:
+        endpoint (str): the endpoint to query
+        filters (dict, optional): GDC filters, e.g. built with `equals`/`one_of`/`all_of`
+        fields (list[str], optional): fields to return. The endpoint's defaults if None
+        expand (list[str], optional): groups of fields to return, e.g. ['diagnoses']
+        sort (str, optional): e.g. 'case_id:asc'. Defaults to the endpoint's unique id, which keeps pages from overlapping
+        page_size (int): hits per request
+        workers (int): number of pages requested at once
+        max_hits (int, optional): stop after this many hits
+        session (requests.Session, optional): session to reuse. A new pooled one if None
+    """
+    url = f'{GDC_API_URL}/{endpoint}'
+    body: dict[str, Any] = {'format': 'JSON'}
+    if filters is not None:
+        body['filters'] = filters
+    if fields is not None:
+        body['fields'] = ','.join(fields)
+    if expand is not None:
+        body['expand'] = ','.join(expand)
+    sort = sort or (f'{sort_fields[endpoint]}:asc' if endpoint in sort_fields else None)
+    if sort is not None:
+        body['sort'] = sort
+    if session is None:
+        session = pooled_session(workers)
+
+    # the first page says how many more there are
+    first = _fetch_page(session, url, body, 0, page_size if max_hits is None else min(page_size, max_hits))
+    for warning, message in first.get('warnings', {}).items():
+        print(f'GDC warning ({warning}): {message}')
+    total = first['data']['pagination']['total']
+    if max_hits is not None:
+        total = min(total, max_hits)
+    yield from first['data']['hits'][:total]
+
+    # later pages are fetched `workers` at a time, and yielded in order as they come in
+    offsets = iter(range(page_size, total, page_size))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gdc') as pool:
+        def submit(offset: int):
+            return pool.submit(_fetch_page, session, url, body, offset, min(page_size, total - offset))
+        pending = deque(submit(offset) for offset in islice(offsets, workers))
+        try:
+            while pending:
+                page = pending.popleft().result()
+                for offset in islice(offsets, 1):
+                    pending.append(submit(offset))
+                yield from page['data']['hits']
+        finally:
+            # e.g. the caller stopped iterating early
+            for future in pending:
+                future.cancel()
+
+
+# --- flattening and saving --- #
+
+def flatten_hit(hit: dict, prefix: str = '') -> dict[str, Any]:
+    """
+    Nested fields become dotted columns, e.g. {'case': {'case_id': ...}} -> {'case.case_id': ...}, as with
+    `pandas.json_normalize`. Lists (e.g. of diagnoses) are kept as JSON strings
+    """
+    row = {}
+    for key, value in hit.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            row.update(flatten_hit(value, f'{name}.'))
+        elif isinstance(value, list):
+            row[name] = json.dumps(value)
+        else:
+            row[name] = value
+    return row
+
+
+def _kind(value: Any) -> str:
+    # bool first, since it's a subclass of int
+    for kind in (bool, int, float):
+        if isinstance(value, kind):
+            return kind.__name__
+    return 'str'
+
+def _dtype(kinds: set[str]) -> str:
+    """one dtype per column, so every parquet chunk has the same schema"""
+    if kinds == {'bool'}:
+        return 'boolean'
+    if kinds == {'int'}:
+        return 'Int64'
+    if kinds and kinds <= {'int', 'float'}:
+        return 'Float64'
+    return 'string'
+
+
+def save_gdc_query(
+    endpoint: str,
+    path: Path|str,
+    filters: dict|None = None,
+    fields: list[str]|None = None,
+    format: Literal['csv', 'parquet']|None = None,
+    chunk_rows: int = 10_000,
+    **kwargs,
+) -> int:
+    """
+    Save every hit of a query to a GDC endpoint as a table, one flattened hit per row. Returns the number of rows.
+
+    Args:
+        endpoint (str): the endpoint to query, e.g. 'ssm_occurrences'
+        path (Path|str): the output file. For parquet, a directory of part files (read back with `pd.read_parquet(path)`)
+        filters (dict, optional): GDC filters, e.g. built with `equals`/`one_of`/`all_of`
+        fields (list[str], optional): fields to return. The endpoint's defaults if None
+        format ('csv'|'parquet', optional): guessed from the path's suffix if None (csv unless it's .parquet).
+            parquet needs pyarrow (or fastparquet) installed
+        chunk_rows (int): rows written at a time
+        **kwargs: passed on to `iter_gdc_hits` (e.g. expand, page_size, workers, max_hits)
+    """
+    path = Path(path)
+    format = format or ('parquet' if path.suffix == '.parquet' else 'csv')
+    # checked before querying, rather than failing after every hit was fetched
+    if format == 'parquet' and not any(importlib.util.find_spec(engine) for engine in ('pyarrow', 'fastparquet')):
+        raise ImportError(f'saving {path} as parquet needs pyarrow or fastparquet (`pip install pyarrow`). Save to a .csv instead, or install one')
+    columns: dict[str, set[str]] = {} # column -> kinds of values seen, in the order the columns were first seen
+    rows = 0
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as spill:
+        # hits can have different fields, so the full set of columns is only known after the last one
+        for hit in iter_gdc_hits(endpoint, filters=filters, fields=fields, **kwargs):
+            row = flatten_hit(hit)
+            for name, value in row.items():
+                kinds = columns.setdefault(name, set())
+                if value is not None:
+                    kinds.add(_kind(value))
+            spill.write(json.dumps(row) + '\n')
+            rows += 1
+
+        # without any hits, the requested fields are the columns
+        if not columns:
+            columns = {name: set() for name in fields or []}
+
+        spill.seek(0)
+        chunks = (
+            pd.DataFrame([json.loads(line) for line in lines], columns=list(columns))
+            for lines in iter(lambda: list(islice(spill, chunk_rows)), [])
+        )
+        if format == 'csv':
+            with open(path, 'w', newline='') as f:
+                pd.DataFrame(columns=list(columns)).to_csv(f, index=False)
+                for chunk in chunks:
+                    chunk.to_csv(f, index=False, header=False)
+        else:
+            dtypes = {name: _dtype(kinds) for name, kinds in columns.items()}
+            path.mkdir(parents=True, exist_ok=True)
+            for i, chunk in enumerate(chunks):
+                chunk.astype(dtypes).to_parquet(path/f'part-{i:05}.parquet', index=False)
+            # with no hits, an empty part with the columns, so there's still a table to read back
+            if rows == 0:
+                pd.DataFrame(columns=list(columns)).astype(dtypes).to_parquet(path/'part-00000.parquet', index=False)
+
+    print(f'saved {rows} hits from {endpoint} to {path}')
+    return rows
@@ -0,0 +1,19 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def pooled_session(pool_size: int = 8, retries: int = 3) -> requests.Session:
+    """A session with a connection pool big enough for `pool_size` concurrent requests, retrying throttled/failed requests"""
+    retry = Retry(
+        total=retries,
+        read=0, # slow responses are left to the caller, e.g. to split the request up
+        backoff_factor=1,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None, # queries are POSTed, but they're only reads
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session